@@ -0,0 +1,288 @@
+#!/usr/bin/env python2
+
+# fastpathbench.py - Conformance check and benchmark of the COMPOUND
+# fast paths and COMPOUND templates in nfs4lib
+#
+# Copyright (C) 2001 Cendio Systems AB (http://www.cendio.se)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# For every fast path shape, the COMPOUND4args from the fast encoder
+# must be byte for byte the same as from the generated types, and the
+# fast decoder must give the same result as the generic decoding of a
+# COMPOUND4res packed by the generated types. Then both ways are
+# timed. No server is needed. Exits with status 1 if any check fails.
+
+import sys
+import getopt
+import nfs4lib
+from nfs4constants import *
+from nfs4types import *
+from xdrbench import measure
+
+USAGE = """\
+Usage: %s [options]
+options:
+-h, --help                   display this help and exit
+-m, --min-time=SECONDS       minimum time for each measurement (default 0.05)
+-r, --repeat=N               take the best of N measurements (default 3)
+"""
+
+FH = "\x01\x02\x03\x04fh-of-twenty-bytes"
+
+
+def make_client():
+    ncl = nfs4lib.PartialNFS4Client()
+    ncl.addpackers()
+    return ncl
+
+def compound_res(ncl, resops):
+    return COMPOUND4res(ncl, NFS4_OK, "", resops)
+
+def putfh_res(ncl):
+    return nfs_resop4(ncl, resop=OP_PUTFH, opputfh=PUTFH4res(ncl, NFS4_OK))
+
+
+#
+# The shapes. Each gives the operations for the generic encoding, a
+# function doing the fast encoding, a COMPOUND4res for the reply, a
+# function picking the result from the generic decoding, and the fast
+# decoder.
+#
+
+def read_shape(ncl):
+    stateid = stateid4(ncl, 1, "other-twelve")
+    data = "x" * 4093
+    resok = READ4resok(ncl, 1, data)
+    res = compound_res(ncl, [putfh_res(ncl),
+                             nfs_resop4(ncl, resop=OP_READ,
+                                        opread=READ4res(ncl, NFS4_OK, resok))])
+    return ([ncl.putfh_op(FH), ncl.read(stateid, 4711, 4096)],
+            lambda: nfs4lib.fast_encode_read(FH, stateid, 4711, 4096),
+            res,
+            lambda res: (res.resarray[1].arm.arm.eof,
+                         res.resarray[1].arm.arm.data),
+            nfs4lib.fast_decode_read)
+
+def write_shape(ncl):
+    stateid = stateid4(ncl, 1, "other-twelve")
+    data = "y" * 4095
+    resok = WRITE4resok(ncl, len(data), UNSTABLE4, "verifier")
+    res = compound_res(ncl, [putfh_res(ncl),
+                             nfs_resop4(ncl, resop=OP_WRITE,
+                                        opwrite=WRITE4res(ncl, NFS4_OK, resok))])
+    return ([ncl.putfh_op(FH), ncl.write(data, stateid, 4711, UNSTABLE4)],
+            lambda: nfs4lib.fast_encode_write(FH, stateid, 4711, data,
+                                              UNSTABLE4),
+            res,
+            lambda res: (res.resarray[1].arm.arm.count,
+                         res.resarray[1].arm.arm.committed,
+                         res.resarray[1].arm.arm.writeverf),
+            nfs4lib.fast_decode_write)
+
+def getattr_shape(ncl):
+    attrlist = [FATTR4_TYPE, FATTR4_CHANGE, FATTR4_SIZE, FATTR4_FILEID,
+                FATTR4_MODE, FATTR4_NUMLINKS]
+    values = {FATTR4_TYPE: NF4REG, FATTR4_CHANGE: 17L, FATTR4_SIZE: 4711L,
+              FATTR4_FILEID: 42L, FATTR4_MODE: 0644, FATTR4_NUMLINKS: 1}
+    resok = GETATTR4resok(ncl, nfs4lib.dict2fattr(values, ncl))
+    res = compound_res(ncl, [putfh_res(ncl),
+                             nfs_resop4(ncl, resop=OP_GETATTR,
+                                        opgetattr=GETATTR4res(ncl, NFS4_OK, resok))])
+    return ([ncl.putfh_op(FH), ncl.getattr(attrlist)],
+            lambda: nfs4lib.fast_encode_getattr(FH,
+                                                nfs4lib.list2attrmask(attrlist)),
+            res,
+            lambda res: nfs4lib.fattr2dict(res.resarray[1].arm.arm.obj_attributes),
+            nfs4lib.fast_decode_getattr)
+
+def lookup_shape(ncl):
+    newfh = "\x05\x06new-filehandle"
+    res = compound_res(ncl, [putfh_res(ncl),
+                             nfs_resop4(ncl, resop=OP_LOOKUP,
+                                        oplookup=LOOKUP4res(ncl, NFS4_OK)),
+                             nfs_resop4(ncl, resop=OP_GETFH,
+                                        opgetfh=GETFH4res(ncl, NFS4_OK,
+                                                          GETFH4resok(ncl, newfh)))])
+    return ([ncl.putfh_op(FH), ncl.lookup_op("name"), ncl.getfh_op()],
+            lambda: nfs4lib.fast_encode_lookup(FH, "name"),
+            res,
+            lambda res: res.resarray[-1].arm.arm.object,
+            nfs4lib.fast_decode_lookup)
+
+SHAPES = [("PUTFH+READ", read_shape),
+          ("PUTFH+WRITE", write_shape),
+          ("PUTFH+GETATTR", getattr_shape),
+          ("PUTFH+LOOKUP+GETFH", lookup_shape)]
+
+
+def check(name, ncl, shape, log=sys.stderr):
+    """Compare the fast and generic encoding and decoding. Returns
+    the number of differences."""
+    (argarray, fast_encode, res, generic_result, fast_decode) = shape
+    errors = 0
+    packer = ncl.packer
+    packer.reset()
+    COMPOUND4args(ncl, tag="", minorversion=0, argarray=argarray).pack()
+    if packer.get_buffer() != fast_encode():
+        print >> log, "%-20s encoding differs" % name
+        errors = errors + 1
+
+    packer.reset()
+    res.pack()
+    reply = packer.get_buffer()
+    ncl.unpacker.reset(reply)
+    generic = COMPOUND4res(ncl)
+    generic.unpack()
+    fast = fast_decode(reply, 0)
+    if fast is None:
+        print >> log, "%-20s fast decoder rejected the reply" % name
+        errors = errors + 1
+    elif fast[1] != len(reply):
+        print >> log, "%-20s fast decoder ended at %d of %d" % \
+              (name, fast[1], len(reply))
+        errors = errors + 1
+    elif fast[0] != generic_result(generic):
+        print >> log, "%-20s decoding differs: %r, generic %r" % \
+              (name, fast[0], generic_result(generic))
+        errors = errors + 1
+
+    # A failed COMPOUND must be left to the generic code
+    packer.reset()
+    COMPOUND4res(ncl, NFS4ERR_STALE, "",
+                 [nfs_resop4(ncl, resop=OP_PUTFH,
+                             opputfh=PUTFH4res(ncl, NFS4ERR_STALE))]).pack()
+    if fast_decode(packer.get_buffer(), 0) is not None:
+        print >> log, "%-20s fast decoder accepted an error" % name
+        errors = errors + 1
+    return errors
+
+def bench(name, ncl, shape, min_time, repeat, log=sys.stderr):
+    """Time encoding plus decoding, the generic and the fast way.
+    Returns (generic ops/s, fast ops/s)."""
+    (argarray, fast_encode, res, generic_result, fast_decode) = shape
+    packer = ncl.packer
+    unpacker = ncl.unpacker
+    packer.reset()
+    res.pack()
+    reply = packer.get_buffer()
+
+    def generic(ncl=ncl, packer=packer, unpacker=unpacker, argarray=argarray,
+                reply=reply, generic_result=generic_result):
+        packer.reset()
+        COMPOUND4args(ncl, tag="", minorversion=0, argarray=argarray).pack()
+        unpacker.reset(reply)
+        res = COMPOUND4res(ncl)
+        res.unpack()
+        nfs4lib.check_result(res)
+        generic_result(res)
+
+    def fast(fast_encode=fast_encode, fast_decode=fast_decode, reply=reply):
+        fast_encode()
+        fast_decode(reply, 0)
+
+    generic_ops = measure(generic, min_time, repeat)
+    fast_ops = measure(fast, min_time, repeat)
+    print >> log, "%-20s generic %10.0f fast %10.0f ops/s  %5.1fx" % \
+          (name, generic_ops, fast_ops, fast_ops / generic_ops)
+    return (generic_ops, fast_ops)
+
+#
+# COMPOUND templates
+#
+
+PATH = ["usr", "share", "doc", "pynfs"]
+
+def template_ops(ncl):
+    """The prefix and the trailing operations of the template check"""
+    prefix = [ncl.putrootfh_op()] + ncl.lookup_path(PATH)
+    return (prefix, [ncl.lookup_op("README"), ncl.getattr([FATTR4_SIZE])])
+
+def check_template(ncl, log=sys.stderr):
+    """Compare the encoding of a CompoundTemplate with the generic one.
+    Returns the number of differences."""
+    (prefix, extra) = template_ops(ncl)
+    template = ncl.template(prefix)
+    errors = 0
+    for ops in [[], extra]:
+        ncl.packer.reset()
+        COMPOUND4args(ncl, tag="", minorversion=0, argarray=prefix + ops).pack()
+        if ncl.packer.get_buffer() != template.encode(ops):
+            print >> log, "%-20s encoding with %d extra operations differs" % \
+                  ("template", len(ops))
+            errors = errors + 1
+    return errors
+
+def bench_template(ncl, min_time, repeat, log=sys.stderr):
+    """Time encoding the COMPOUND, the generic way and with a template.
+    Returns (generic ops/s, template ops/s)."""
+    packer = ncl.packer
+    path = PATH
+
+    def generic(ncl=ncl, packer=packer, path=path):
+        # Like the tools do: build and encode all operations
+        packer.reset()
+        argarray = [ncl.putrootfh_op()] + ncl.lookup_path(path) + \
+                   [ncl.lookup_op("README"), ncl.getattr([FATTR4_SIZE])]
+        COMPOUND4args(ncl, tag="", minorversion=0, argarray=argarray).pack()
+
+    template = ncl.template([ncl.putrootfh_op()] + ncl.lookup_path(path))
+    def fast(ncl=ncl, template=template):
+        template.encode([ncl.lookup_op("README"), ncl.getattr([FATTR4_SIZE])])
+
+    generic_ops = measure(generic, min_time, repeat)
+    template_ops = measure(fast, min_time, repeat)
+    print >> log, "%-20s generic %10.0f template %7.0f ops/s  %5.1fx" % \
+          ("PUTROOTFH+LOOKUPx5", generic_ops, template_ops,
+           template_ops / generic_ops)
+    return (generic_ops, template_ops)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "hm:r:",
+                                   ["help", "min-time=", "repeat="])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, e
+        print >> sys.stderr, USAGE % argv[0]
+        sys.exit(2)
+
+    min_time = 0.05
+    repeat = 3
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print USAGE % argv[0]
+            sys.exit(0)
+        elif o in ("-m", "--min-time"):
+            min_time = float(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+
+    ncl = make_client()
+    errors = 0
+    for (name, make_shape) in SHAPES:
+        errors = errors + check(name, ncl, make_shape(ncl))
+    errors = errors + check_template(ncl)
+    if errors:
+        print >> sys.stderr, "%d fast path checks failed" % errors
+        sys.exit(1)
+    print >> sys.stderr, "All fast paths agree with the generic code"
+
+    for (name, make_shape) in SHAPES:
+        bench(name, ncl, make_shape(ncl), min_time, repeat)
+    bench_template(ncl, min_time, repeat)
+
+if __name__ == "__main__":
+    main()
@@ -33,10 +33,11 @@ import getopt
 import re
 import os
 import time
+import mmap
 
 USAGE = """\
 Usage: %s [nfs://]host[:[port]]<directory> [-u|-t] [-d debuglevel]
-       [-c string] 
+       [-c string] [-n connections] [-m]
 options:
 -h, --help                   display this help and exit
 -u, --udp                    use UDP as transport
@@ -44,6 +45,10 @@ options:
 -d level, --debuglevel level set debuglevel
 -p, --pythonmode             enable Python interpreter mode
 -c, --commandstring string   execute semicolon separated commands
+-n N, --connections N        stripe get and put of big files over N
+                             connections (default 1)
+-m, --mmap                   get and put through an mmap of the local file,
+                             without copies in Python (one connection)
     --uid=<uid>              Use custom <uid> with AUTH_UNIX security
     --gid=<gid>              Use custom <gid> with AUTH_UNIX security
 
@@ -53,6 +58,8 @@ nfs4client uses the RPC security flavor AUTH_UNIX.
 
 VERSION = "0.0"
 BUFSIZE = 4096
+# Files of at least this size are striped, with --connections
+STRIPE_MIN_SIZE = 1024*1024
 
 # Load readline & completer
 try:
@@ -125,9 +132,11 @@ else:
 
 class ClientApp(cmd.Cmd):
     def __init__(self, ncl, directory, pythonmode,
-                 debuglevel):
+                 debuglevel, connections=1, use_mmap=0):
         cmd.Cmd.__init__(self)
         self.ncl = ncl
+        self.connections = connections
+        self.use_mmap = use_mmap
         
         self.completer = Completer()
         self.completer.pythonmode = pythonmode
@@ -146,6 +155,48 @@ class ClientApp(cmd.Cmd):
         self.ncl.debugtags = (self.debuglevel and 1)
         self.ncl.init_connection()
 
+    def _stripe(self, remote, size):
+        """Stripe the I/O of remote over several connections, if size
+        is big enough"""
+        if self.connections > 1 and size >= STRIPE_MIN_SIZE:
+            remote.connections = self.connections
+
+    def _get_mmap(self, remote, local, size):
+        """Read size bytes of remote straight into an mmap of local, an
+        open file, which is resized to what was read. Returns the
+        number of bytes read."""
+        local.truncate(size)
+        m = mmap.mmap(local.fileno(), size)
+        try:
+            chunk = nfs4lib.transfer_size([self.ncl], remote.fh,
+                                          FATTR4_MAXREAD)
+            n = self.ncl.do_readinto(remote.fh, remote.stateid, m, 0, chunk)
+        finally:
+            m.close()
+        if n < size:
+            local.truncate(n)
+        return n
+
+    def _put_mmap(self, remote, local, size):
+        """Write size bytes of local, an open file, to remote, straight
+        from an mmap of it"""
+        m = mmap.mmap(local.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            chunk = nfs4lib.transfer_size([self.ncl], remote.fh,
+                                          FATTR4_MAXWRITE)
+            self.ncl.do_writefrom(remote.fh, remote.stateid, m, 0, chunk)
+        finally:
+            m.close()
+
+    def _print_stats(self, stats):
+        """Print the per-connection statistics of a striped transfer"""
+        if not self.debuglevel or not stats or len(stats) < 2:
+            return
+        for i in range(len(stats)):
+            (calls, bytes, rate) = stats[i]
+            print "connection %d: %d calls, %d bytes, %.0f bytes/s" % \
+                  (i, calls, bytes, rate)
+
     def _set_prompt(self):
         self.prompt = self.baseprompt % nfs4lib.comps2unixpath(self.ncl.cwd)
         
@@ -184,16 +235,8 @@ class ClientApp(cmd.Cmd):
             print "%s is a directory (try rmdir instead)" % line
             return
 
-        dircomps = pathcomps[:-1]
-        lookupops = self.ncl.lookup_path(dircomps)
-        operations = [self.ncl.putrootfh_op()] + lookupops
-
-        objname = pathcomps[-1]
-        operations.append(self.ncl.remove_op(objname))
-
         try:
-            res = self.ncl.compound(operations)
-            nfs4lib.check_result(res)
+            self.ncl.do_remove(pathcomps)
         except nfs4lib.BadCompoundRes, r:
             print "remove failed:", r
             return
@@ -270,17 +313,23 @@ class ClientApp(cmd.Cmd):
             remote = nfs4lib.NFS4OpenFile(self.ncl)
             try:
                 remote.open(file)
-                local = open(basename, "w")
+                size = self.ncl.do_getattr(remote.fh, [FATTR4_SIZE])["size"]
+                local = open(basename, "w+b")
+                if self.use_mmap and size:
+                    # The file may have grown; the rest is read below
+                    remote.seek(self._get_mmap(remote, local, size))
+                    local.seek(0, 2)
+                else:
+                    self._stripe(remote, size)
                 while 1:
-                    # Read large chunks
                     data = remote.read(BUFSIZE*64)
                     if not data:
                         break
-                    
                     local.write(data)
                 
                 remote.close()
                 local.close()
+                self._print_stats(remote.connection_stats()[0])
             except nfs4lib.BadCompoundRes, r:
                 print "Error fetching file:", r
         print
@@ -446,6 +495,14 @@ class ClientApp(cmd.Cmd):
         try:
             local = open(local_name)
             remote.open(remote_name, "w")
+            size = os.path.getsize(local_name)
+            if self.use_mmap and size:
+                self._put_mmap(remote, local, size)
+                # The file may have grown; the rest is written below
+                local.seek(size)
+                remote.seek(size)
+            else:
+                self._stripe(remote, size)
 
             while 1:
                 data = local.read(BUFSIZE*64)
@@ -456,6 +513,7 @@ class ClientApp(cmd.Cmd):
 
             remote.close()
             local.close()
+            self._print_stats(remote.connection_stats()[1])
         except nfs4lib.BadCompoundRes, r:
             print "Error fetching file:", r
         print
@@ -479,16 +537,8 @@ class ClientApp(cmd.Cmd):
             print "%s is not a directory (try rm instead)" % line
             return
 
-        dircomps = pathcomps[:-1]
-        lookupops = self.ncl.lookup_path(dircomps)
-        operations = [self.ncl.putrootfh_op()] + lookupops
-
-        objname = pathcomps[-1]
-        operations.append(self.ncl.remove_op(objname))
-
         try:
-            res = self.ncl.compound(operations)
-            nfs4lib.check_result(res)
+            self.ncl.do_remove(pathcomps)
         except nfs4lib.BadCompoundRes, r:
             print "remove failed:", r
             return
@@ -628,10 +678,10 @@ if __name__ == "__main__":
 
     # Let getopt parse the arguments
     try:
-        opts, args = my_getopt(sys.argv[1:], "hutd:pc:",
+        opts, args = my_getopt(sys.argv[1:], "hutd:pc:n:m",
                                ["help", "udp", "tcp", "debuglevel=",
                                 "pythonmode", "commandstring=",
-                                "uid=", "gid="])
+                                "connections=", "mmap", "uid=", "gid="])
     except getopt.GetoptError, e:
         print >> sys.stderr, e
         usage()
@@ -641,6 +691,8 @@ if __name__ == "__main__":
     debuglevel = 0
     pythonmode = 0
     commandstring = None
+    connections = 1
+    use_mmap = 0
     kwargs = {}
 
     for o, a in opts:
@@ -661,6 +713,16 @@ if __name__ == "__main__":
             pythonmode = 1
         if o in ("-c", "--commandstring"):
             commandstring = a
+        if o in ("-n", "--connections"):
+            try:
+                connections = int(a)
+            except ValueError:
+                connections = 0
+            if connections < 1:
+                print "Invalid number of connections"
+                sys.exit()
+        if o in ("-m", "--mmap"):
+            use_mmap = 1
         if o == "--uid":
             kwargs["uid"] = int(a)
         if o == "--gid":
@@ -686,7 +748,8 @@ if __name__ == "__main__":
             directory = "/"
 
     ncl = nfs4lib.create_client(host, port, transport, **kwargs)
-    c = ClientApp(ncl, directory, pythonmode, debuglevel)
+    c = ClientApp(ncl, directory, pythonmode, debuglevel, connections,
+                  use_mmap)
 
     commands = []
     if commandstring:
@@ -18,14 +18,27 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-# TODO: 
-# Implement buffering in NFS4OpenFile.
+from __future__ import generators
 
 __pychecker__ = 'no-callinit no-reimport'
 
 NFS_PORT = 2049
 
 BUFSIZE = 4096
+# Largest datagram rpc.RawUDPClient will send or receive
+UDP_MAXSIZE = 8192
+# Room for the RPC and COMPOUND headers around the data of a READ
+# reply or WRITE call
+TRANSFER_OVERHEAD = 512
+# Default number of outstanding calls per connection in ParallelReader
+# and WriteBehind
+PARALLEL_WINDOW = 8
+# Default size of the replies of getattr_many, and of its calls when
+# the transport has no limit
+BULK_CALL_SIZE = 8192
+BULK_REPLY_SIZE = 8192
+# Assumed encoded size of attributes without a fixed size
+ATTR_SIZE_ESTIMATE = 64
 
 import rpc
 from nfs4constants import *
@@ -33,7 +46,11 @@ from nfs4types import *
 import nfs4packer
 import random
 import array
+import struct
+import xdrlib
 import socket
+import select
+import time
 import os
 import re
 
@@ -47,6 +64,11 @@ if not hasattr(os, "getgid"):
 if not hasattr(os, "getgroups"):
     os.getgroups = lambda: []
 
+# Errors from decoding a malformed fattr4. Caching is best-effort, so
+# attributes which fail to decode are not cached, and the result is
+# left for the caller to judge.
+ATTR_DECODE_ERRORS = (EOFError, xdrlib.Error, struct.error)
+
 # All NFS errors are subclasses of NFSException
 class NFSException(rpc.RPCException):
     pass
@@ -86,6 +108,16 @@ class EmptyCompoundRes(NFSException):
     def __str__(self):
         return "empty COMPOUND result"
 
+class CompoundTooLarge(NFSException):
+    """COMPOUND call does not fit within the transport's size limit"""
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+
+    def __str__(self):
+        return "COMPOUND call is %d bytes, limit is %d" % (self.size, self.limit)
+
+
 class ChDirError(NFSException):
     def __init__(self, dir):
         self.dir = dir
@@ -115,6 +147,18 @@ class PartialNFS4Client:
         # Owners
         self.default_owner = os.getenv("USER", "pynfs-user")
         self._active_owners = {}
+        # Largest RPC call the transport can carry, or None for no limit
+        self.max_call_size = None
+        # Attributes from the replies, by filehandle
+        self.attrcache = AttrCache()
+        # Filehandles by path
+        self.dcache = DentryCache()
+        # Names known not to exist
+        self.negcache = NegativeCache(self.attrcache)
+        # Directory listings, by filehandle
+        self.dircache = DirCache()
+        # (cred, verf, encoded call header) for fast_call
+        self.fast_header = None
 
     def mkcred(self):
 	if self.cred == None:
@@ -146,11 +190,20 @@ class PartialNFS4Client:
             tag = str(get_callstack())
 
         compoundargs = COMPOUND4args(self, argarray=argarray, tag=tag, minorversion=minorversion)
+        if self.max_call_size is not None:
+            size = self.callheader_size() + compoundargs.xdr_size()
+            if size > self.max_call_size:
+                raise CompoundTooLarge(size, self.max_call_size)
         res = COMPOUND4res(self)
 
-        # Save sent operations for later checks
-        sent_operations = [op.argop for op in argarray]
         self.make_call(NFSPROC4_COMPOUND, None, compoundargs.pack, res.unpack)
+        self.finish_compound(argarray, res)
+        return res
+
+    def finish_compound(self, argarray, res):
+        """Check the result res of a COMPOUND of the operations
+        argarray, and update the caches from it"""
+        sent_operations = [op.argop for op in argarray]
         recv_operations = [op.resop for op in res.resarray]
 
         # The same numbers & the same operations should be returned,
@@ -165,8 +218,360 @@ class PartialNFS4Client:
         # Check response sanity
         verify_compound_result(res)
 
-        
-        return res
+        self.cache_results(argarray, res)
+
+    def cache_results(self, argarray, res):
+        """Update the caches from the results of a COMPOUND.
+        Attributes are cached for objects whose filehandle is known
+        from PUTFH or GETFH, or from the dentry cache when the path is
+        known from PUTROOTFH and LOOKUP. They are forgotten when an
+        operation modifies them. Directory listings are updated from
+        the change_info4 of the operations."""
+        cache = self.attrcache
+        # Current filehandle and path, if known, and attributes of the
+        # current object from before its filehandle was known
+        fh = None
+        path = None
+        attrs = None
+        saved = (None, None, None)
+        for i in range(len(res.resarray)):
+            resop = res.resarray[i]
+            if resop.arm.status != NFS4_OK:
+                break
+            op = resop.resop
+            if op == OP_PUTFH:
+                fh = argarray[i].opputfh.object
+                path = None
+                attrs = None
+            elif op in [OP_PUTROOTFH, OP_LOOKUP, OP_LOOKUPP]:
+                if op == OP_PUTROOTFH:
+                    path = []
+                elif path is None:
+                    pass
+                elif op == OP_LOOKUP:
+                    path = path + [argarray[i].oplookup.objname]
+                else:
+                    path = path[:-1]
+                fh = None
+                if path is not None:
+                    fh = self.dcache.peek_fresh(path)
+                attrs = None
+            elif op == OP_GETFH:
+                fh = resop.arm.arm.object
+                if path is not None:
+                    self.dcache.add(path, fh)
+                if attrs:
+                    cache.update(fh, attrs)
+            elif op == OP_GETATTR:
+                try:
+                    attrs = fattr2dict(resop.arm.arm.obj_attributes)
+                except ATTR_DECODE_ERRORS:
+                    attrs = None
+                if fh is not None and attrs is not None:
+                    cache.update(fh, attrs)
+            elif op == OP_SAVEFH:
+                saved = (fh, path, attrs)
+            elif op == OP_RESTOREFH:
+                (fh, path, attrs) = saved
+            elif op in [OP_WRITE, OP_SETATTR]:
+                if fh is not None:
+                    cache.invalidate(fh)
+                attrs = None
+            elif op == OP_REMOVE:
+                name = argarray[i].opremove.target
+                self.dcache.forget_child(fh, name)
+                self.dir_changed(fh, resop.arm.arm.cinfo, [name])
+                attrs = None
+            elif op == OP_LINK:
+                # The saved object gets another link
+                if saved[0] is not None:
+                    cache.invalidate(saved[0])
+                saved = (saved[0], saved[1], None)
+                self.dir_changed(fh, resop.arm.arm.cinfo, [],
+                                 argarray[i].oplink.newname)
+                attrs = None
+            elif op == OP_RENAME:
+                args = argarray[i].oprename
+                resok = resop.arm.arm
+                self.dcache.forget_child(saved[0], args.oldname)
+                self.dcache.forget_child(fh, args.newname)
+                entry = self.dircache.find(saved[0], args.oldname)
+                newattrs = None
+                if entry is not None:
+                    newattrs = entry.attrs
+                if saved[0] == fh:
+                    self.dir_changed(fh, resok.target_cinfo,
+                                     [args.oldname, args.newname],
+                                     args.newname, newattrs)
+                else:
+                    self.dir_changed(saved[0], resok.source_cinfo, [args.oldname])
+                    self.dir_changed(fh, resok.target_cinfo, [args.newname],
+                                     args.newname, newattrs)
+                saved = (saved[0], saved[1], None)
+                attrs = None
+            elif op in [OP_CREATE, OP_OPEN]:
+                # The directory may change, and the new object becomes
+                # the current one
+                name = None
+                if op == OP_CREATE:
+                    name = argarray[i].opcreate.objname
+                elif argarray[i].opopen.claim.claim == CLAIM_NULL:
+                    name = argarray[i].opopen.claim.file
+                if name is None:
+                    self.dir_changed(fh, resop.arm.arm.cinfo)
+                else:
+                    self.dir_changed(fh, resop.arm.arm.cinfo, [name], name)
+                fh = None
+                if path is not None and name is not None:
+                    path = path + [name]
+                else:
+                    path = None
+                attrs = None
+            elif op == OP_READDIR:
+                self.cache_entries(resop.arm.arm.reply.entries)
+            elif op in [OP_PUTPUBFH, OP_OPENATTR]:
+                fh = None
+                path = None
+                attrs = None
+
+    def dir_changed(self, dirfh, cinfo, removed=[], added=None, attrs=None):
+        """Update the caches for a change by this client of the
+        directory dirfh, described by the change_info4 cinfo. removed
+        is a list of names which no longer exist, and added a name
+        which does, with the attributes attrs (a fattr4) if known."""
+        self.negcache.forget_dir(dirfh)
+        if dirfh is None:
+            self.dircache.clear()
+            return
+        self.attrcache.invalidate(dirfh)
+        if cinfo.atomic:
+            self.attrcache.update(dirfh, {"change": cinfo.after})
+        entry = None
+        if added is not None:
+            if attrs is None:
+                attrs = fattr4(self, list2attrmask([]), "")
+            entry = entry4(self, 0, added, attrs, [])
+        self.dircache.changed(dirfh, cinfo, removed, entry)
+
+    def cache_entries(self, entries):
+        """Cache the attributes of READDIR entries which include the
+        filehandle. Entries whose attributes fail to decode are
+        skipped."""
+        while entries:
+            entry = entries[0]
+            entries = entry.nextentry
+            try:
+                attrs = fattr2dict(entry.attrs)
+            except ATTR_DECODE_ERRORS:
+                continue
+            if attrs.has_key("filehandle"):
+                self.attrcache.update(attrs["filehandle"], attrs)
+
+    def send_compound(self, argarray, tag="", minorversion=0):
+        """Send a COMPOUND call without waiting for the reply, so that
+        several calls can be outstanding. Returns the xid. The reply is
+        received with recv_compound."""
+        if not tag and self.debugtags:
+            tag = str(get_callstack())
+
+        compoundargs = COMPOUND4args(self, argarray=argarray, tag=tag, minorversion=minorversion)
+        return self.send_call(NFSPROC4_COMPOUND, None, compoundargs.pack)
+
+    def recv_compound(self, wanted=None):
+        """Receive the reply to a call sent with send_compound, with an
+        xid in wanted if given (see rpc.Client.recv_reply). Returns a
+        tuple (xid, COMPOUND4res)."""
+        xid = self.recv_reply(wanted)
+        res = COMPOUND4res(self)
+        res.unpack()
+        try:
+            self.unpacker.done()
+        except xdrlib.Error:
+            raise rpc.RPCUnextractedData()
+        verify_compound_result(res)
+        return (xid, res)
+
+    #
+    # Fast paths. COMPOUNDs of the most common shapes, encoded and
+    # decoded with the fast_encode_* and fast_decode_* functions. 
+    #
+
+    def raw_call(self, args):
+        """Return a COMPOUND call with the encoded COMPOUND4args args,
+        with a new xid"""
+        self.lastxid = xid = self.lastxid + 1
+        cred = self.mkcred()
+        verf = self.mkverf()
+        if self.fast_header is None or self.fast_header[0] is not cred or \
+               self.fast_header[1] is not verf:
+            # The call header, without the xid
+            packer = rpc.Packer()
+            packer.pack_callheader(0, self.prog, self.vers,
+                                   NFSPROC4_COMPOUND, cred, verf)
+            self.fast_header = (cred, verf, packer.get_buffer()[4:])
+        return struct.pack(">L", xid) + self.fast_header[2] + args
+
+    def raw_compound(self, args):
+        """Send a COMPOUND call with the encoded COMPOUND4args args, and
+        wait for the reply. The unpacker is left at the COMPOUND4res."""
+        call = self.raw_call(args)
+        if self.max_call_size is not None and len(call) > self.max_call_size:
+            raise CompoundTooLarge(len(call), self.max_call_size)
+        self.packer.reset()
+        self.packer.pack_fopaque(len(call), call)
+        self.do_call()
+
+    def fast_call(self, args, decode):
+        """Send a COMPOUND with the encoded COMPOUND4args args, and
+        return the result of decode. If decode cannot handle the reply,
+        because the COMPOUND failed or the reply has another shape, it
+        is decoded the generic way, and BadCompoundRes or
+        InvalidCompoundRes raised."""
+        self.raw_compound(args)
+        return self.fast_result(decode)
+
+    def fast_result(self, decode):
+        """Like fast_call, for a reply already in the unpacker"""
+        unpacker = self.unpacker
+        buffer = unpacker.get_buffer()
+        try:
+            result = decode(buffer, unpacker.get_position())
+        except struct.error:
+            result = None
+        if result is None:
+            res = COMPOUND4res(self)
+            res.unpack()
+            verify_compound_result(res)
+            check_result(res)
+            raise InvalidCompoundRes("unexpected reply to fast path")
+        (value, end) = result
+        if end != len(buffer):
+            raise rpc.RPCUnextractedData()
+        return value
+
+    def template(self, prefix_ops, tag="", minorversion=0):
+        """Return a CompoundTemplate for COMPOUNDs starting with the
+        operations prefix_ops"""
+        return CompoundTemplate(self, prefix_ops, tag, minorversion)
+
+    def fast_read(self, fh, stateid, offset, count):
+        """PUTFH and READ. Returns (eof, data)"""
+        return self.fast_call(fast_encode_read(fh, stateid, offset, count),
+                              fast_decode_read)
+
+    def fast_write(self, fh, stateid, offset, data, stable=FILE_SYNC4):
+        """PUTFH and WRITE. Returns (count, committed, writeverf)"""
+        try:
+            return self.fast_call(fast_encode_write(fh, stateid, offset,
+                                                    data, stable),
+                                  fast_decode_write)
+        finally:
+            self.attrcache.invalidate(fh)
+
+    def read_into(self, fh, stateid, offset, count, buffer, pos=0):
+        """PUTFH and READ of at most count bytes, into buffer at pos.
+        buffer is like for do_readinto. Returns (eof, number of bytes).
+        This copies the data; TCPNFS4Client receives it straight into
+        buffer."""
+        (eof, data) = self.fast_read(fh, stateid, offset, count)
+        # The server may return more than we asked for
+        data = data[:min(count, len(buffer) - pos)]
+        copy_into(buffer, pos, data)
+        return (eof, len(data))
+
+    def write_from(self, fh, stateid, offset, buffer, pos, count,
+                   stable=FILE_SYNC4):
+        """PUTFH and WRITE of count bytes of buffer from pos. buffer
+        can be a string, an array of bytes or an mmap object. Returns
+        like fast_write. This copies the data; TCPNFS4Client sends it
+        straight from buffer."""
+        data = str(rpc.readonly_view(buffer, pos, count))
+        return self.fast_write(fh, stateid, offset, data, stable)
+
+    def fast_getattr(self, fh, attrlist):
+        """PUTFH and GETATTR of attrlist (a list of attribute constants).
+        Returns a dictionary like fattr2dict."""
+        attrs = self.fast_call(fast_encode_getattr(fh, list2attrmask(attrlist)),
+                               fast_decode_getattr)
+        self.attrcache.update(fh, attrs)
+        return attrs
+
+    def fast_lookup(self, dirfh, name):
+        """PUTFH, LOOKUP and GETFH. Returns the filehandle of name in
+        dirfh."""
+        return self.fast_call(fast_encode_lookup(dirfh, name),
+                              fast_decode_lookup)
+
+    def clone(self):
+        """Return a new client with its own connection to the same
+        server, which shares the client state (clientid, owners etc)
+        with this one."""
+        ncl = self.__class__(self.host, self.port, self.uid, self.gid)
+        ncl.clientid = self.clientid
+        ncl.verifier = self.verifier
+        ncl.cwd = self.cwd[:]
+        ncl.debugtags = self.debugtags
+        ncl.default_owner = self.default_owner
+        ncl._active_owners = self._active_owners
+        ncl.attrcache = self.attrcache
+        ncl.dcache = self.dcache
+        ncl.negcache = self.negcache
+        ncl.dircache = self.dircache
+        return ncl
+
+    def path_compound(self, pathcomps, operations):
+        """A COMPOUND call with operations on the object pathcomps. The
+        operations are preceded by PUTFH of the deepest cached prefix of
+        the path (or PUTROOTFH) and LOOKUPs of the rest. GETFHs of the
+        object and its directory are added, unless they were cached, and
+        their results are cached. If the cached filehandle is stale, the
+        call is retried from the root.
+
+        If the negative lookup cache knows that the path does not exist,
+        BadCompoundRes is raised without a call."""
+        while 1:
+            (start, fh) = self.dcache.lookup_prefix(pathcomps)
+            # GETFHs to cache, as (path, index)
+            getfhs = []
+            if fh is None:
+                # Learn the root filehandle on the way
+                prefix = [self.putrootfh_op(), self.getfh_op()]
+                getfhs.append(([], 1))
+            else:
+                prefix = [self.putfh_op(fh)]
+            # Index of the component each LOOKUP is for
+            lookups = {}
+            if start < len(pathcomps):
+                if fh is not None and self.negcache.lookup(fh, pathcomps[start]):
+                    raise BadCompoundRes(OP_LOOKUP, NFS4ERR_NOENT)
+                for i in range(start, len(pathcomps)):
+                    if i == len(pathcomps) - 1 and i > start:
+                        prefix.append(self.getfh_op())
+                        getfhs.append((pathcomps[:i], len(prefix) - 1))
+                    lookups[len(prefix)] = i
+                    prefix.append(self.lookup_op(pathcomps[i]))
+                prefix.append(self.getfh_op())
+                getfhs.append((pathcomps, len(prefix) - 1))
+            res = self.compound(prefix + operations)
+            if fh is not None and res.status in [NFS4ERR_STALE, NFS4ERR_FHEXPIRED]:
+                self.dcache.forget(pathcomps[:start])
+                continue
+            for (path, index) in getfhs:
+                if len(res.resarray) > index and res.resarray[index].arm.status == NFS4_OK:
+                    self.dcache.add(path, res.resarray[index].arm.arm.object)
+            # Remember names which LOOKUP did not find, if the
+            # filehandle of the directory is known
+            i = lookups.get(len(res.resarray) - 1)
+            if res.status == NFS4ERR_NOENT and i is not None:
+                dirfh = self.dcache.peek_fresh(pathcomps[:i])
+                if dirfh is not None:
+                    self.negcache.add(dirfh, pathcomps[i])
+            return res
+
+    def compound_size(self, argarray, tag="", minorversion=0):
+        """Encoded size of a COMPOUND call, including the RPC header"""
+        compoundargs = COMPOUND4args(self, argarray=argarray, tag=tag, minorversion=minorversion)
+        return self.callheader_size() + compoundargs.xdr_size()
 
     #
     # Utility methods
@@ -223,15 +628,9 @@ class PartialNFS4Client:
     def try_cd(self, dir):
         # FIXME: Better error messages. 
         candidate_cwd = unixpath2comps(dir, self.cwd)
-        lookupops = self.lookup_path(candidate_cwd)
-        operations = [self.putrootfh_op()] + lookupops
-        getattrop = self.getattr([FATTR4_TYPE])
-        operations.append(getattrop)
 
         try:
-            res = self.compound(operations)
-            check_result(res)
-            obj_type = opaque2long(res.resarray[-1].arm.arm.obj_attributes.attr_vals)
+            obj_type = self.get_ftype(candidate_cwd)
             if not obj_type == NF4DIR:
                 raise ChDirError(dir)
             
@@ -518,14 +917,114 @@ class PartialNFS4Client:
     # def do_create
     # def do_delegpurge
     # def do_delegreturn
-    # def do_getattr
+
+    def do_getattr(self, fh, attrlist):
+        """Get the attributes attrlist (a list of attribute constants)
+        of fh, from the attribute cache if possible. Returns a dictionary
+        like fattr2dict."""
+        table = get_attrcodec().table
+        names = [table[bitnum][0] for bitnum in attrlist]
+        attrs = self.attrcache.lookup(fh, names)
+        if attrs is None:
+            attrs = self.fast_getattr(fh, attrlist)
+        return attrs
+
+    def getattr_many(self, objects, attrlist, callsize=None, replysize=None):
+        """Get the attributes attrlist (a list of attribute constants)
+        of many objects, given as filehandles or lists of path
+        components. PUTFH and GETATTR pairs for as many objects as fit
+        within callsize and replysize bytes are sent in each COMPOUND.
+        Returns a list with a dictionary like fattr2dict for every
+        object, or the error code for objects which failed."""
+        if callsize is None:
+            callsize = self.max_call_size or BULK_CALL_SIZE
+        if replysize is None:
+            replysize = BULK_REPLY_SIZE
+        callsize = callsize - self.callheader_size() - TRANSFER_OVERHEAD
+        replysize = replysize - TRANSFER_OVERHEAD
+        getattrop = self.getattr(attrlist)
+        getattrsize = getattrop.xdr_size()
+        # Results of PUTFH and GETATTR, and the attribute values
+        attrsize = 8 + 8 + getattrsize
+        table = get_attrcodec().table
+        for attr in attrlist:
+            entry = table.get(attr)
+            if entry is not None and entry[3] is not None:
+                attrsize = attrsize + entry[3]
+            else:
+                attrsize = attrsize + ATTR_SIZE_ESTIMATE
+        results = [None] * len(objects)
+        first = 0
+        while first < len(objects):
+            operations = []
+            # Index of the first operation of every object
+            starts = []
+            callbytes = 0
+            replybytes = 0
+            for obj in objects[first:]:
+                ops = self.getattr_ops(obj, getattrop)
+                size = getattrsize
+                for op in ops[:-1]:
+                    size = size + op.xdr_size()
+                # Results of PUTROOTFH, LOOKUP and GETFH
+                replied = attrsize + 8 * (len(ops) - 2)
+                if len(ops) > 2:
+                    replied = replied + 4 + NFS4_FHSIZE
+                if starts and (callbytes + size > callsize or
+                               replybytes + replied > replysize):
+                    break
+                starts.append(len(operations))
+                operations.extend(ops)
+                callbytes = callbytes + size
+                replybytes = replybytes + replied
+            starts.append(len(operations))
+
+            res = self.compound(operations)
+            done = len(starts) - 1
+            for i in range(len(starts) - 1):
+                last = starts[i + 1] - 1
+                if len(res.resarray) > last and \
+                       res.resarray[last].arm.status == NFS4_OK:
+                    resok = res.resarray[last].arm.arm
+                    results[first + i] = fattr2dict(resok.obj_attributes)
+                else:
+                    # The COMPOUND stopped here. Continue after this
+                    # object.
+                    results[first + i] = res.resarray[-1].arm.status
+                    done = i + 1
+                    break
+            first = first + done
+        return results
+
+    def getattr_ops(self, obj, getattrop):
+        """Operations for getattr_many: GETATTR of a filehandle or path"""
+        if type(obj) == type(""):
+            return [self.putfh_op(obj), getattrop]
+        fh = self.dcache.lookup(obj)
+        if fh is not None:
+            return [self.putfh_op(fh), getattrop]
+        # GETFH, so that the filehandle is cached for the next time
+        return [self.putrootfh_op()] + self.lookup_path(obj) + \
+               [self.getfh_op(), getattrop]
     
+    def exists(self, pathcomps):
+        """Return false if pathcomps does not exist. Uses the dentry
+        and negative lookup caches, so repeated checks are cheap."""
+        try:
+            self.do_getfh(pathcomps)
+        except BadCompoundRes, e:
+            if e.errcode == NFS4ERR_NOENT:
+                return 0
+            raise
+        return 1
+
     def do_getfh(self, pathcomps):
         """Get filehandle"""
-        lookupops = self.lookup_path(pathcomps)
-        operations = [self.putrootfh_op()] + lookupops
-        operations.append(self.getfh_op())
-        res = self.compound(operations)
+        fh = self.dcache.lookup(pathcomps)
+        if fh is not None:
+            return fh
+        # path_compound ends with GETFH
+        res = self.path_compound(pathcomps, [])
         check_result(res)
         return res.resarray[-1].arm.arm.object
     
@@ -535,12 +1034,7 @@ class PartialNFS4Client:
     # def do_locku
     def do_lookup(self, cfh, component):
         """Lookup"""
-        operations = [self.putfh_op(cfh)] 
-        operations.append(self.lookup_op(component))
-        operations.append(self.getfh_op())
-        res = self.compound(operations)
-        check_result(res)
-        return res.resarray[-1].arm.arm.object
+        return self.fast_lookup(cfh, component)
     
     # def do_lookupp
     # def do_nverify
@@ -553,129 +1047,119 @@ class PartialNFS4Client:
     # def do_putrootfh
 
     def do_read(self, stateid, fh, offset=0, size=None):
-        putfhop = self.putfh_op(fh)
-
-        data = ""
-        while 1:
-            readop = self.read(stateid, count=BUFSIZE, offset=offset)
-            res = self.compound([putfhop, readop])
-            check_result(res)
-            data += res.resarray[1].arm.arm.data
-            
-            if res.resarray[1].arm.arm.eof:
+        return "".join(self.iter_read(fh, stateid, offset, size))
+
+    def iter_read(self, fh, stateid, offset=0, size=None, chunk=BUFSIZE):
+        """Read from offset until end of file, or until size bytes are
+        read. Yields the data of each READ, which asks for at most chunk
+        bytes."""
+        while size is None or size > 0:
+            count = chunk
+            if size is not None:
+                count = min(count, size)
+            (eof, data) = self.fast_read(fh, stateid, offset, count)
+            if size is not None:
+                # The server may return more than we asked for
+                data = data[:size]
+                size = size - len(data)
+            if data:
+                yield data
+            if eof or not data:
                 break
-
-            # Have we got as much as we were asking for?
-            if size and (len(data) >= size):
+            offset = offset + len(data)
+
+    def do_read_parallel(self, fh, stateid, offset=0, size=None,
+                         window=PARALLEL_WINDOW, connections=1):
+        """Like do_read, but with window READs outstanding on each of
+        connections connections. Returns a tuple (data, ParallelReader),
+        where the reader holds the throughput statistics."""
+        ncls = [self]
+        for unused in range(connections - 1):
+            ncls.append(self.clone())
+        reader = ParallelReader(ncls, fh, stateid, offset, size, window)
+        try:
+            data = "".join(reader.chunks())
+        finally:
+            for ncl in ncls[1:]:
+                ncl.close()
+        return (data, reader)
+
+    def do_readinto(self, fh, stateid, buffer, offset=0, chunk=BUFSIZE):
+        """Read from offset into buffer, until it is full or end of file
+        is reached. buffer can be an array of bytes, or anything which
+        supports slice assignment with strings, like an mmap object.
+        Returns the number of bytes read."""
+        pos = 0
+        while pos < len(buffer):
+            count = min(chunk, len(buffer) - pos)
+            (eof, count) = self.read_into(fh, stateid, offset + pos, count,
+                                          buffer, pos)
+            pos = pos + count
+            if eof or not count:
                 break
-
-            offset += BUFSIZE
-
-        if size:
-            return data[:size]
-        else:
-            return data
-
-    def do_read_fast(self, fh, offset=0, size=None):
-        """Fast implementation of do_read"""
-        # FIXME: broken. 
-
-        def fast_pack(args):
-            (ncl, fh, offset) = args
-            # No compound tag; zerolength opaque. 
-            ncl.packer.pack_uint(0)
-            # Minor version
-            ncl.packer.pack_uint32_t(0)
-
-            # Number of operations
-            ncl.packer.pack_uint(2)
-
-            # PUTFH
-            ncl.packer.pack_nfs_opnum4(OP_PUTFH)
-            ncl.packer.pack_opaque(fh)
-
-            # READ
-            ncl.packer.pack_nfs_opnum4(OP_READ)
-            ncl.packer.pack_stateid4(0)
-            ncl.packer.pack_offset4(offset)
-            ncl.packer.pack_count4(BUFSIZE)
-
-        def fast_unpack(ncl):
-            status = ncl.unpacker.unpack_nfsstat4()
-            if status:
-                raise BadCompoundRes(OP_READ, status)
-                
-            # Tag
-            ncl.unpacker.unpack_opaque()
-
-            # resarray
-            unused = ncl.unpacker.unpack_uint()
-
-            # PUTFH result
-            unused_argop = ncl.unpacker.unpack_nfs_opnum4()
-            status = ncl.unpacker.unpack_nfsstat4()
-
-            # READ result
-            unused_argop = ncl.unpacker.unpack_nfs_opnum4()
-            status = ncl.unpacker.unpack_nfsstat4()
-            eof = ncl.unpacker.unpack_bool()
-            data = ncl.unpacker.unpack_opaque()
-            
-            return (eof, data)
-            
-        def custom_make_call(ncl, proc, pack_func, unpack_func,
-                             pack_args=None, unpack_args=None):
-            """customized rpc.make_call with possible argument to unpack_func"""
-            if pack_func is None and pack_args is not None:
-                raise TypeError("non-null pack_args with null pack_func")
-            ncl.start_call(proc)
-            if pack_func:
-                    pack_func(pack_args)
-            ncl.do_call()
-            if unpack_func:
-                    result = unpack_func(unpack_args)
-            else:
-                    result = None
-            ncl.unpacker.done()
-            return result
-
-
-        data = ""
-
+        return pos
+
+    def do_writefrom(self, fh, stateid, buffer, offset=0, chunk=BUFSIZE):
+        """Write all of buffer at offset, in UNSTABLE4 WRITEs of at most
+        chunk bytes, and COMMIT. buffer is like for write_from. If the
+        write verifier changes, which means that the server has
+        restarted, everything is written again. Returns the number of
+        bytes written."""
         while 1:
-            (eof, got_data) = custom_make_call(self, 1, fast_pack, fast_unpack,
-                                               (self, fh, offset), self)
-            data += got_data
-            
-            if eof:
-                break
-
-            # Have we got as much as we were asking for?
-            if size and (len(data) >= size):
-                break
-
-            offset += BUFSIZE
-
-        if size:
-            return data[:size]
-        else:
-            return data
+            # Verifiers of the WRITEs which need a COMMIT
+            verifiers = {}
+            pos = 0
+            while pos < len(buffer):
+                count = min(chunk, len(buffer) - pos)
+                (count, committed, verf) = self.write_from(fh, stateid,
+                                                           offset + pos,
+                                                           buffer, pos, count,
+                                                           UNSTABLE4)
+                if not count:
+                    raise InvalidCompoundRes("WRITE wrote nothing")
+                if committed == UNSTABLE4:
+                    verifiers[verf] = 1
+                pos = pos + count
+            if not verifiers:
+                return pos
+            res = self.compound([self.putfh_op(fh), self.commit_op(0, 0)])
+            check_result(res)
+            if verifiers.keys() == [res.resarray[1].arm.arm.writeverf]:
+                return pos
 
+    def do_read_fast(self, fh, offset=0, size=None):
+        """Old interface of do_read, without a stateid. Reads with the
+        anonymous stateid."""
+        stateid = stateid4(self, 0, "\0" * 12)
+        return "".join(self.iter_read(fh, stateid, offset, size))
 
     def do_readdir(self, fh, attr_request=[]):
 	# Since we may not get whole directory listing in one readdir request,
 	# loop until we do. For each request result, create a flat list
 	# with <entry4> objects. 
+	#
+	# Listings are cached, and used while the change attribute of
+	# the directory is the same. 
+	if self.dircache.peek(fh) is not None:
+	    change = self.do_getattr(fh, [FATTR4_CHANGE]).get("change")
+	    entries = self.dircache.lookup(fh, change, attr_request)
+	    if entries is not None:
+		return entries
 	cookie = 0
 	cookieverf = ""
 	entries = []
+	change = None
 	while 1:
-	    putfhop = self.putfh_op(fh)
-	    readdirop = self.readdir(cookie, cookieverf, attr_request=attr_request)
-	    res = self.compound([putfhop, readdirop])
+	    operations = [self.putfh_op(fh)]
+	    if not cookie:
+		operations.append(self.getattr([FATTR4_CHANGE]))
+	    operations.append(self.readdir(cookie, cookieverf, attr_request=attr_request))
+	    res = self.compound(operations)
 	    check_result(res)
+	    if not cookie:
+		change = fattr2dict(res.resarray[1].arm.arm.obj_attributes).get("change")
 
-            reply = res.resarray[1].arm.arm.reply
+            reply = res.resarray[-1].arm.arm.reply
             if not reply.entries:
                 break
 
@@ -688,22 +1172,115 @@ class PartialNFS4Client:
 		    break
 		entry = entry.nextentry[0]
 	    
-	    if res.resarray[1].arm.arm.reply.eof:
+	    if res.resarray[-1].arm.arm.reply.eof:
 		break
 
             cookie = entry.cookie
-	    cookieverf = res.resarray[1].arm.arm.cookieverf
+	    cookieverf = res.resarray[-1].arm.arm.cookieverf
 
+	if change is not None:
+	    self.dircache.add(fh, change, attr_request, entries)
 	return entries
 
+    def do_readdir_columns(self, fh, attrs, dircount=4096, maxcount=4096):
+        """Read a whole directory, like do_readdir, but decode the
+        attributes attrs (a list of attribute constants) of all entries
+        into columns, without creating entry4 objects or attribute
+        dictionaries. Returns a DirColumns object."""
+        columns = DirColumns(attrs)
+        attr_request = list2attrmask(attrs)
+        cookie = 0
+        cookieverf = ""
+        while 1:
+            tag = ""
+            if self.debugtags:
+                tag = str(get_callstack())
+            operations = [self.putfh_op(fh),
+                          self.readdir(cookie, cookieverf, dircount, maxcount,
+                                       attr_request)]
+            compoundargs = COMPOUND4args(self, argarray=operations, tag=tag,
+                                         minorversion=0)
+            unpack = lambda self=self, columns=columns: \
+                     self.unpack_readdir_columns(columns)
+            result = self.make_call(NFSPROC4_COMPOUND, None,
+                                    compoundargs.pack, unpack)
+            (res, last_cookie, cookieverf, eof) = result
+            if res:
+                # The call failed
+                verify_compound_result(res)
+                check_result(res)
+            if eof or last_cookie is None:
+                break
+            cookie = last_cookie
+
+        columns.finish()
+        return columns
+
+    def unpack_readdir_columns(self, columns):
+        """Unpack the COMPOUND4res of PUTFH and READDIR, and add the
+        entries to columns. Returns (res, last cookie, cookieverf, eof),
+        where res is the unpacked COMPOUND4res if the call failed, and
+        None otherwise."""
+        unpacker = self.unpacker
+        start = unpacker.get_position()
+        if unpacker.unpack_nfsstat4() != NFS4_OK:
+            unpacker.set_position(start)
+            res = COMPOUND4res(self)
+            res.unpack()
+            return (res, None, None, None)
+        unpacker.unpack_utf8string()
+        sent_operations = [OP_PUTFH, OP_READDIR]
+        if unpacker.unpack_uint() != len(sent_operations):
+            raise InvalidCompoundRes("res.status was OK, but operations are missing")
+        for op in sent_operations:
+            resop = unpacker.unpack_uint()
+            if resop != op:
+                raise InvalidCompoundRes("sent=%s, got %s" \
+                                         % (str(sent_operations), resop))
+            if unpacker.unpack_nfsstat4() != NFS4_OK:
+                raise InvalidCompoundRes("res.status was OK, but some operations"
+                                         "returned errors")
+        cookieverf = unpacker.unpack_fopaque(NFS4_VERIFIER_SIZE)
+
+        # The entries are decoded straight from the buffer
+        buf = unpacker.get_buffer()
+        pos = unpacker.get_position()
+        cookie = None
+        try:
+            (more,) = struct.unpack(">L", buf[pos:pos+4])
+            pos = pos + 4
+            while more:
+                cookie = buf[pos:pos+8]
+                (namelen,) = struct.unpack(">L", buf[pos+8:pos+12])
+                pos = pos + 12
+                name = buf[pos:pos+namelen]
+                pos = pos + (namelen+3)/4*4
+                (masklen,) = struct.unpack(">L", buf[pos:pos+4])
+                rawmask = buf[pos+4:pos+4+4*masklen]
+                pos = pos + 4 + 4*masklen
+                (vallen,) = struct.unpack(">L", buf[pos:pos+4])
+                attr_vals = buf[pos+4:pos+4+vallen]
+                pos = pos + 4 + (vallen+3)/4*4
+                if pos > len(buf):
+                    raise EOFError
+                columns.add(cookie, name, rawmask, attr_vals)
+                (more,) = struct.unpack(">L", buf[pos:pos+4])
+                pos = pos + 4
+            (eof,) = struct.unpack(">L", buf[pos:pos+4])
+            pos = pos + 4
+        except struct.error:
+            raise EOFError
+        unpacker.set_position(pos)
+        if cookie is not None:
+            (cookie,) = struct.unpack(">Q", cookie)
+        return (None, cookie, cookieverf, eof)
+
     # def do_readlink
     
     def do_remove(self, pathcomps):
         # Lookup all but last component
-        lookupops = self.lookup_path(pathcomps[:-1])
-        operations = [self.putrootfh_op()] + lookupops
-        operations.append(self.remove_op(pathcomps[-1]))
-        res = self.compound(operations)
+        res = self.path_compound(pathcomps[:-1], [self.remove_op(pathcomps[-1])])
+        self.dcache.forget(pathcomps)
         check_result(res)
     
     # def do_rename
@@ -717,22 +1294,20 @@ class PartialNFS4Client:
     # def do_verify
 
     def do_write(self, fh, data, stateid, offset=0, stable=FILE_SYNC4):
-        putfhop = self.putfh_op(fh)
-	writeop = self.write(data, stateid, offset=offset, stable=stable)
-	res = self.compound([putfhop, writeop])
-	check_result(res)
+	self.fast_write(fh, stateid, offset, data, stable)
 
     #
     # Misc. convenience methods. 
     #
     def get_ftype(self, pathcomps):
         """Get file type attribute"""
-        lookupops = self.lookup_path(pathcomps)
-        operations = [self.putrootfh_op()] + lookupops
+        fh = self.dcache.lookup(pathcomps)
+        if fh is not None:
+            attrs = self.attrcache.lookup(fh, ["type"])
+            if attrs:
+                return attrs["type"]
         getattrop = self.getattr([FATTR4_TYPE])
-        operations.append(getattrop)
-
-        res = self.compound(operations)
+        res = self.path_compound(pathcomps, [getattrop])
         check_result(res)
         obj_type = opaque2long(res.resarray[-1].arm.arm.obj_attributes.attr_vals)
 
@@ -819,6 +1394,184 @@ def comps2unixpath(comps):
         result += "/" + component
     return result
 
+def copy_into(buffer, pos, data):
+    """Copy the string data into buffer at pos. buffer can be an array
+    of bytes, or anything which supports slice assignment with strings,
+    like a bytearray or an mmap object."""
+    end = pos + len(data)
+    if isinstance(buffer, array.array):
+        buffer[pos:end] = array.array(buffer.typecode, data)
+    else:
+        buffer[pos:end] = data
+
+#
+# Fast paths
+#
+# Encoders and decoders for the most common COMPOUND shapes, which use
+# struct directly instead of the generated types. The encoders return
+# the encoded COMPOUND4args, with an empty tag and minor version 0.
+# The decoders take the reply buffer and the position of the
+# COMPOUND4res, and return (result, end position), or None if the
+# COMPOUND failed or the reply has another shape. fastpathbench.py
+# checks that they agree with the generic code, and times them.
+#
+
+def xdr_opaque(data):
+    """Encode variable length opaque data"""
+    return struct.pack(">L", len(data)) + data + "\0" * (-len(data) % 4)
+
+def fast_expected(ops):
+    """The start of a successful COMPOUND4res for the operations ops,
+    with an empty tag: the status, the tag, the number of results, and
+    the operation and status of each result."""
+    words = [NFS4_OK, 0, len(ops)]
+    for op in ops:
+        words.extend([op, NFS4_OK])
+    return struct.pack(">%dL" % len(words), *words)
+
+def fast_results(buffer, pos, expected):
+    """Return the position of the last result of a COMPOUND4res at pos,
+    after its status, if the reply starts like expected (from
+    fast_expected). Otherwise returns None. Only the last operation
+    may have results besides the status."""
+    if buffer[pos:pos+len(expected)] == expected:
+        return pos + len(expected)
+    (status, taglen) = struct.unpack(">LL", buffer[pos:pos+8])
+    if status != NFS4_OK or not taglen:
+        return None
+    # Skip a tag echoed by the server
+    start = pos + 8 + (taglen + 3) / 4 * 4
+    if buffer[start:start+len(expected)-8] != expected[8:]:
+        return None
+    return start + len(expected) - 8
+
+_fast_args_read = struct.pack(">LLLL", 0, 0, 2, OP_PUTFH)
+_fast_args_lookup = struct.pack(">LLLL", 0, 0, 3, OP_PUTFH)
+_fast_reply_read = fast_expected([OP_PUTFH, OP_READ])
+_fast_reply_write = fast_expected([OP_PUTFH, OP_WRITE])
+_fast_reply_getattr = fast_expected([OP_PUTFH, OP_GETATTR])
+_fast_reply_lookup = fast_expected([OP_PUTFH, OP_LOOKUP, OP_GETFH])
+
+def fast_encode_read(fh, stateid, offset, count):
+    return _fast_args_read + xdr_opaque(fh) + \
+           struct.pack(">LL12sQL", OP_READ, stateid.seqid, stateid.other,
+                       offset, count)
+
+def fast_decode_read(buffer, pos):
+    """Returns ((eof, data), end)"""
+    pos = fast_results(buffer, pos, _fast_reply_read)
+    if pos is None:
+        return None
+    (eof, count) = struct.unpack(">LL", buffer[pos:pos+8])
+    data = buffer[pos+8:pos+8+count]
+    if len(data) < count:
+        return None
+    return ((eof != 0, data), pos + 8 + (count + 3) / 4 * 4)
+
+def fast_encode_write(fh, stateid, offset, data, stable=FILE_SYNC4):
+    return fast_encode_write_head(fh, stateid, offset, stable, len(data)) + \
+           data + "\0" * (-len(data) % 4)
+
+def fast_encode_write_head(fh, stateid, offset, stable, count):
+    """Like fast_encode_write, up to the count bytes of data, which
+    follow with padding to a multiple of four bytes"""
+    return _fast_args_read + xdr_opaque(fh) + \
+           struct.pack(">LL12sQLL", OP_WRITE, stateid.seqid, stateid.other,
+                       offset, stable, count)
+
+def fast_decode_write(buffer, pos):
+    """Returns ((count, committed, writeverf), end)"""
+    pos = fast_results(buffer, pos, _fast_reply_write)
+    if pos is None:
+        return None
+    (count, committed, writeverf) = struct.unpack(">LL8s", buffer[pos:pos+16])
+    return ((count, committed, writeverf), pos + 16)
+
+def fast_encode_getattr(fh, attrmask):
+    return _fast_args_read + xdr_opaque(fh) + \
+           struct.pack(">LL%dL" % len(attrmask), OP_GETATTR, len(attrmask),
+                       *attrmask)
+
+def fast_decode_getattr(buffer, pos):
+    """Returns (dictionary like fattr2dict, end)"""
+    pos = fast_results(buffer, pos, _fast_reply_getattr)
+    if pos is None:
+        return None
+    n = struct.unpack(">L", buffer[pos:pos+4])[0]
+    pos = pos + 4
+    attrmask = list(struct.unpack(">%dL" % n, buffer[pos:pos+4*n]))
+    pos = pos + 4 * n
+    length = struct.unpack(">L", buffer[pos:pos+4])[0]
+    attr_vals = buffer[pos+4:pos+4+length]
+    if len(attr_vals) < length:
+        return None
+    return (get_attrcodec().decode(attrmask, attr_vals),
+            pos + 4 + (length + 3) / 4 * 4)
+
+def fast_encode_lookup(dirfh, name):
+    return _fast_args_lookup + xdr_opaque(dirfh) + \
+           struct.pack(">L", OP_LOOKUP) + xdr_opaque(name) + \
+           struct.pack(">L", OP_GETFH)
+
+def fast_decode_lookup(buffer, pos):
+    """Returns (filehandle, end)"""
+    pos = fast_results(buffer, pos, _fast_reply_lookup)
+    if pos is None:
+        return None
+    length = struct.unpack(">L", buffer[pos:pos+4])[0]
+    if length > NFS4_FHSIZE:
+        return None
+    fh = buffer[pos+4:pos+4+length]
+    if len(fh) < length:
+        return None
+    return (fh, pos + 4 + (length + 3) / 4 * 4)
+
+class CompoundTemplate:
+    """A COMPOUND with a fixed prefix of operations, like PUTROOTFH and
+    the LOOKUPs of a path, which is encoded once. call() encodes only
+    the operations following the prefix. Made by
+    PartialNFS4Client.template(), and used with that client only,
+    since operations are packed by the packer of their client.
+    """
+    def __init__(self, ncl, prefix_ops, tag="", minorversion=0):
+        self.ncl = ncl
+        self.prefix_ops = prefix_ops[:]
+        self.head = xdr_opaque(tag) + struct.pack(">L", minorversion)
+        packer = ncl.packer
+        packer.reset()
+        for op in prefix_ops:
+            op.pack()
+        self.prefix = packer.get_buffer()
+        packer.reset()
+
+    def encode(self, extra_ops=[]):
+        """Return the encoded COMPOUND4args, with extra_ops after the
+        prefix"""
+        packer = self.ncl.packer
+        packer.reset()
+        for op in extra_ops:
+            op.pack()
+        extra = packer.get_buffer()
+        packer.reset()
+        return self.head + \
+               struct.pack(">L", len(self.prefix_ops) + len(extra_ops)) + \
+               self.prefix + extra
+
+    def call(self, extra_ops=[]):
+        """Send the COMPOUND, with extra_ops after the prefix. Returns
+        the COMPOUND4res, like PartialNFS4Client.compound()."""
+        ncl = self.ncl
+        ncl.raw_compound(self.encode(extra_ops))
+        res = COMPOUND4res(ncl)
+        res.unpack()
+        try:
+            ncl.unpacker.done()
+        except xdrlib.Error:
+            raise rpc.RPCUnextractedData()
+        ncl.finish_compound(self.prefix_ops + extra_ops, res)
+        return res
+
+
 def opaque2long(data):
     import struct
     result = 0L
@@ -880,23 +1633,11 @@ def int2binstring(val):
 def get_attrbitnum_dict():
     """Get dictionary with attribute bit positions.
 
-    Note: This function uses introspection. It will fail if nfs4constants.py has
-    an attribute named FATTR4_<something>. 
+    Note: The table is built by AttrCodec, with introspection. 
 
-    Returns {"fattr4_type": 1, "fattr4_change": 3 ...}
+    Returns {"type": 1, "change": 3 ...}
     """
-    
-    import nfs4constants
-    attrbitnum_dict = {}
-    for name in dir(nfs4constants):
-        if name.startswith("FATTR4_"):
-            value = getattr(nfs4constants, name)
-            # Sanity checking. Must be integer. 
-            assert(type(value) == type(0))
-	    attrname = name[7:].lower()
-	    attrbitnum_dict[attrname] = value
-	    
-    return attrbitnum_dict
+    return get_attrcodec().bitnums.copy()
 
 def get_bitnumattr_dict():
     """Get dictionary with attribute bit positions.
@@ -956,30 +1697,1409 @@ def get_attrpackers(packer):
 
     return attrpackers
 
-def dict2fattr(dict, ncl):
-    """Convert a dictionary to a fattr4 object.
+def _pack_bool(value):
+    if value:
+        return 1
+    return 0
 
-    Returns a fattr4 object.  
+def _mask_hyper(value):
+    return value & 0xffffffffffffffffL
+
+
+class AttrCodec:
+    """Encoder and decoder of the attr_vals of fattr4, used by
+    fattr2dict and dict2fattr.
+
+    The table of attributes is built when the codec is created. Use the
+    shared instance from get_attrcodec(). For every attribute mask, the
+    codec compiles a plan, in which runs of fixed size attributes are
+    encoded and decoded with a single struct call.
     """
 
-    attrs = dict.keys()
-    attrs.sort()
+    # Struct formats and conversions for fixed size basic types, by
+    # their rpc.Unpacker method: (unpack format, decoder, pack format,
+    # encoder). The conversions give the same values as xdrlib.
+    basic_formats = {
+        "unpack_uint": ("L", int, "L", None),
+        "unpack_int": ("l", None, "l", None),
+        "unpack_enum": ("l", None, "l", None),
+        "unpack_bool": ("l", bool, "L", _pack_bool),
+        "unpack_uhyper": ("Q", long, "Q", _mask_hyper),
+        "unpack_hyper": ("q", long, "Q", _mask_hyper),
+        }
+
+    # Number of compiled plans to keep
+    max_plans = 64
 
-    attr_vals = ""
-    rstncl = DummyNcl() 
-    import nfs4packer;
-    packer = nfs4packer.NFS4Packer(rstncl)
-    attrpackers = get_attrpackers(packer) 
-    
-    for attr in attrs:
-        value = dict[attr];
-        packerfun = attrpackers[attr];
-        packer.reset()
-        packerfun(value)
-        attr_vals+=packer.get_buffer()
-    attrmask = list2attrmask(attrs)
-    return fattr4(ncl, attrmask, attr_vals); 
+    def __init__(self):
+        import nfs4constants
+        unpacker_class = nfs4packer.NFS4Unpacker
+        basics = {}
+        for name in self.basic_formats.keys():
+            basics[getattr(rpc.Unpacker, name).im_func] = name
+
+        # {"type": 1, "change": 3, ...}
+        self.bitnums = {}
+        # {1: (name, packer method, unpacker method, fixed size, formats)}
+        # where fixed size and formats are None unless the attribute is a
+        # fixed size basic type.
+        self.table = {}
+        for constname in dir(nfs4constants):
+            if not constname.startswith("FATTR4_"):
+                continue
+            bitnum = getattr(nfs4constants, constname)
+            name = constname[7:].lower()
+            self.bitnums[name] = bitnum
+            unpacker = "unpack_fattr4_" + name
+            if not hasattr(unpacker_class, unpacker):
+                continue
+            formats = self.basic_formats.get(
+                basics.get(getattr(unpacker_class, unpacker).im_func))
+            if formats:
+                size = struct.calcsize(">" + formats[0])
+            else:
+                size = None
+            self.table[bitnum] = (name, "pack_fattr4_" + name, unpacker,
+                                  size, formats)
+        self.decode_plans = {}
+        self.encode_plans = {}
+
+    def compile(self, bitnums, encode):
+        """Return the plan for the attributes bitnums, in increasing
+        order. The plan is a list of steps, either (format, size, fields)
+        for a run of fixed size attributes, where fields is a list of
+        (key, conversion), or (None, method, key) for other attributes.
+        Keys are attribute numbers when encoding and names when
+        decoding."""
+        plan = []
+        format = ""
+        runsize = 0
+        fields = []
+        for bitnum in bitnums:
+            (name, packer, unpacker, size, formats) = self.table[bitnum]
+            if encode:
+                (key, method) = (bitnum, packer)
+            else:
+                (key, method) = (name, unpacker)
+            if formats:
+                if encode:
+                    format = format + formats[2]
+                    fields.append((key, formats[3]))
+                else:
+                    format = format + formats[0]
+                    fields.append((key, formats[1]))
+                runsize = runsize + size
+                continue
+            if fields:
+                plan.append((">" + format, runsize, fields))
+                (format, runsize, fields) = ("", 0, [])
+            plan.append((None, method, key))
+        if fields:
+            plan.append((">" + format, runsize, fields))
+        return plan
+
+    def remember(self, plans, key, plan):
+        if len(plans) >= self.max_plans:
+            plans.clear()
+        plans[key] = plan
+
+    def decode(self, attrmask, attr_vals):
+        """Decode attr_vals, holding the attributes in attrmask.
+
+        Returns a dictionary like {"size": 4711}. Attributes unknown to
+        nfs4constants are ignored.
+        """
+        key = tuple(attrmask)
+        plan = self.decode_plans.get(key)
+        if plan is None:
+            bitnums = filter(self.table.has_key, attrmask2list(attrmask))
+            plan = self.compile(bitnums, 0)
+            self.remember(self.decode_plans, key, plan)
+
+        result = {}
+        ncl = None
+        pos = 0
+        for step in plan:
+            if step[0] is None:
+                (unused, method, name) = step
+                if ncl is None:
+                    ncl = DummyNcl(attr_vals)
+                unpacker = ncl.unpacker
+                unpacker.set_position(pos)
+                result[name] = getattr(unpacker, method)()
+                pos = unpacker.get_position()
+                continue
+            (format, size, fields) = step
+            data = attr_vals[pos:pos+size]
+            if len(data) < size:
+                raise EOFError
+            values = struct.unpack(format, data)
+            for i in range(len(fields)):
+                (name, convert) = fields[i]
+                if convert:
+                    result[name] = convert(values[i])
+                else:
+                    result[name] = values[i]
+            pos = pos + size
+        return result
+
+    def encode(self, dict):
+        """Encode the values in dict, keyed by attribute number.
+
+        Returns (attrmask, attr_vals).
+        """
+        attrs = dict.keys()
+        attrs.sort()
+        key = tuple(attrs)
+        entry = self.encode_plans.get(key)
+        if entry is None:
+            entry = (list2attrmask(attrs), self.compile(attrs, 1))
+            self.remember(self.encode_plans, key, entry)
+        (attrmask, plan) = entry
+
+        chunks = []
+        packer = None
+        for step in plan:
+            if step[0] is None:
+                (unused, method, attr) = step
+                if packer is None:
+                    packer = DummyNcl().packer
+                packer.reset()
+                getattr(packer, method)(dict[attr])
+                chunks.append(packer.get_buffer())
+                continue
+            (format, size, fields) = step
+            values = []
+            try:
+                for (attr, convert) in fields:
+                    if convert:
+                        values.append(convert(dict[attr]))
+                    else:
+                        values.append(dict[attr])
+                chunks.append(struct.pack(format, *values))
+            except (TypeError, struct.error), e:
+                raise xdrlib.ConversionError(e.args[0])
+        return (attrmask[:], "".join(chunks))
+
+_attrcodec = None
+
+def get_attrcodec():
+    """Return the shared AttrCodec"""
+    global _attrcodec
+    if _attrcodec is None:
+        _attrcodec = AttrCodec()
+    return _attrcodec
+
+
+class DirColumns:
+    """Attributes of directory entries, stored in columns.
+
+    Filled by PartialNFS4Client.do_readdir_columns. names is a list of
+    the entry names, and cookies an array of their cookies. The
+    attribute columns are indexed by attribute name, like
+    columns["size"]. Fixed size attributes are stored in arrays (or
+    NumPy arrays, if rpc.bulk_numpy is set), and "type" is narrowed to
+    unsigned bytes. A time attribute, like "time_modify", gives two
+    columns: the seconds, and the nanoseconds in "time_modify_nseconds".
+    Other attributes are stored as lists of decoded values.
+
+    Attributes which the server did not return for an entry are stored
+    as 0, or None in lists.
+    """
+
+    time_attrs = [FATTR4_TIME_ACCESS, FATTR4_TIME_BACKUP, FATTR4_TIME_CREATE,
+                  FATTR4_TIME_DELTA, FATTR4_TIME_METADATA, FATTR4_TIME_MODIFY]
+
+    # Layouts, by requested attributes and returned attribute mask. The
+    # layouts are shared by all instances.
+    shared_layouts = {}
+
+    def __init__(self, attrs):
+        codec = get_attrcodec()
+        self.attrs = attrs[:]
+        self.attrs.sort()
+        self.names = []
+        self.cookies = []
+        self.columns = {}
+        # Encoded values of fixed size attributes, as lists of strings,
+        # with struct formats and column names
+        self.raw = []
+        self.raw_formats = []
+        self.raw_names = []
+        # Decoded values of other attributes, with unpacker methods and
+        # column names
+        self.values = []
+        self.value_names = []
+        # {attribute number: ("raw", [(raw column, size)]) or
+        #                    ("value", value column)}
+        self.specs = {}
+        for attr in self.attrs:
+            (name, packer, unpacker, size, formats) = codec.table[attr]
+            if attr in self.time_attrs:
+                parts = [("q", name, 8), ("L", name + "_nseconds", 4)]
+            elif formats:
+                parts = [(formats[0], name, size)]
+            else:
+                self.specs[attr] = ("value", len(self.values))
+                self.values.append([])
+                self.value_names.append(name)
+                continue
+            cols = []
+            for (format, colname, size) in parts:
+                cols.append((len(self.raw), size))
+                self.raw.append([])
+                self.raw_formats.append(format)
+                self.raw_names.append(colname)
+            self.specs[attr] = ("raw", cols)
+        self.layouts = self.shared_layouts.setdefault(tuple(self.attrs), {})
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def layout(self, rawmask):
+        """Return the layout for entries with the encoded bitmap4
+        rawmask: (steps, missing raw columns, missing value columns).
+        Each step is (size, raw column) for fixed size data, or
+        (unpacker method, value column), in the order on the wire. The
+        column is None for attributes which were not requested."""
+        codec = get_attrcodec()
+        mask = struct.unpack(">%dL" % (len(rawmask) / 4), rawmask)
+        steps = []
+        present = {}
+        for attr in attrmask2list(mask):
+            if not codec.table.has_key(attr):
+                # Unknown to nfs4constants; ignored, like fattr2dict does
+                continue
+            (name, packer, unpacker, size, formats) = codec.table[attr]
+            spec = self.specs.get(attr)
+            present[attr] = 1
+            if spec is None:
+                # Not requested; skip over it
+                if attr in self.time_attrs:
+                    steps.append((12, None))
+                elif formats:
+                    steps.append((size, None))
+                else:
+                    steps.append((unpacker, None))
+            elif spec[0] == "raw":
+                for (col, size) in spec[1]:
+                    steps.append((size, col))
+            else:
+                steps.append((unpacker, spec[1]))
+        missing_raw = []
+        missing_values = []
+        for attr in self.attrs:
+            if present.has_key(attr):
+                continue
+            spec = self.specs[attr]
+            if spec[0] == "raw":
+                missing_raw.extend(spec[1])
+            else:
+                missing_values.append(spec[1])
+        return (steps, missing_raw, missing_values)
+
+    def add(self, cookie, name, rawmask, attr_vals):
+        """Add an entry. cookie, rawmask and attr_vals are encoded."""
+        layout = self.layouts.get(rawmask)
+        if layout is None:
+            layout = self.layouts[rawmask] = self.layout(rawmask)
+        (steps, missing_raw, missing_values) = layout
+        self.names.append(name)
+        self.cookies.append(cookie)
+        pos = 0
+        ncl = None
+        for (size, col) in steps:
+            if type(size) == type(""):
+                # Decode with the unpacker method size
+                if ncl is None:
+                    ncl = DummyNcl(attr_vals)
+                unpacker = ncl.unpacker
+                unpacker.set_position(pos)
+                value = getattr(unpacker, size)()
+                pos = unpacker.get_position()
+                if col is not None:
+                    self.values[col].append(value)
+                continue
+            if col is not None:
+                self.raw[col].append(attr_vals[pos:pos+size])
+            pos = pos + size
+        if pos > len(attr_vals):
+            raise EOFError
+        for (col, size) in missing_raw:
+            self.raw[col].append("\0" * size)
+        for col in missing_values:
+            self.values[col].append(None)
+
+    def finish(self):
+        """Decode the fixed size columns"""
+        self.cookies = rpc.decode_bulk("Q", "".join(self.cookies))
+        for i in range(len(self.raw)):
+            column = rpc.decode_bulk(self.raw_formats[i], "".join(self.raw[i]))
+            if self.raw_names[i] == "type":
+                if rpc.bulk_numpy and rpc.numpy:
+                    column = column.astype(rpc.numpy.uint8)
+                else:
+                    column = array.array("B", column)
+            self.columns[self.raw_names[i]] = column
+        for i in range(len(self.values)):
+            self.columns[self.value_names[i]] = self.values[i]
+        self.raw = []
+        self.values = []
+
+def transfer_size(ncls, fh, attr):
+    """Return the server's maximum READ or WRITE size for fh, given by
+    attr (FATTR4_MAXREAD or FATTR4_MAXWRITE), limited by what the
+    transports of the clients ncls can carry"""
+    ncl = ncls[0]
+    res = ncl.compound([ncl.putfh_op(fh), ncl.getattr([attr])])
+    check_result(res)
+    name = get_attrcodec().table[attr][0]
+    size = fattr2dict(res.resarray[1].arm.arm.obj_attributes).get(name)
+    if not size:
+        size = BUFSIZE
+    for ncl in ncls:
+        if ncl.max_call_size is not None:
+            size = min(size, ncl.max_call_size - TRANSFER_OVERHEAD)
+    return int(size)
+
+
+class PipelinedCalls:
+    """Base class for ParallelReader, TreeWalker and TreeRemover, which
+    keep calls outstanding on the connections self.ncls. For every
+    connection, self.outstanding has a dictionary {xid: data of the
+    call}, and handle_reply(i) receives a reply on connection i and
+    handles it."""
+
+    def receive(self):
+        """Wait for at least one reply, and handle it"""
+        busy = [i for i in range(len(self.ncls)) if self.outstanding[i]]
+        for i in busy:
+            for xid in self.ncls[i].replies.keys():
+                if self.outstanding[i].has_key(xid):
+                    # Already received while waiting for another call
+                    self.handle_reply(i)
+                    return
+        if len(busy) > 1:
+            socks = [self.ncls[i].sock for i in busy]
+            r, w, x = select.select(socks, [], [], 1)
+            ready = [i for i in busy if self.ncls[i].sock in r]
+            # If nothing arrived, block on the first connection, which
+            # retransmits on UDP.
+            busy = ready or busy[:1]
+        for i in busy:
+            self.handle_reply(i)
+
+    def drain(self):
+        """Wait for the replies of outstanding calls, so that the
+        connections can be used for other calls"""
+        for i in range(len(self.ncls)):
+            ncl = self.ncls[i]
+            xids = self.outstanding[i].keys()
+            for unused in xids:
+                try:
+                    ncl.recv_reply(self.outstanding[i])
+                except rpc.TimeoutError:
+                    break
+                except rpc.RPCException:
+                    pass
+            for xid in xids:
+                ncl.forget_call(xid)
+            self.outstanding[i] = {}
+
+    def connection_stats(self):
+        """Return a list with (calls, bytes, bytes per second) for every
+        connection. For classes which count them in connection_calls,
+        connection_bytes and elapsed."""
+        stats = []
+        for i in range(len(self.ncls)):
+            rate = 0.0
+            if self.elapsed:
+                rate = self.connection_bytes[i] / self.elapsed
+            stats.append((self.connection_calls[i], self.connection_bytes[i],
+                          rate))
+        return stats
+
+
+class ParallelReader(PipelinedCalls):
+    """Read a file with several READ calls outstanding, on one or more
+    connections. Each READ asks for the server's maximum transfer
+    size. The replies may arrive in any order; chunks() reassembles
+    them by offset. Short reads are completed with additional READs.
+
+    After reading, the attributes calls, short_reads, bytes and elapsed
+    and the methods throughput() and connection_stats() tell how it
+    went.
+    """
+    def __init__(self, ncls, fh, stateid, offset=0, size=None,
+                 window=PARALLEL_WINDOW, chunk=None):
+        if not isinstance(ncls, type([])):
+            ncls = [ncls]
+        self.ncls = ncls
+        self.fh = fh
+        # Types pack with the packer of their client, so each
+        # connection needs its own copy of the stateid
+        self.stateids = []
+        for ncl in ncls:
+            self.stateids.append(stateid4(ncl, stateid.seqid, stateid.other))
+        self.window = window
+        if chunk is None:
+            chunk = transfer_size(ncls, fh, FATTR4_MAXREAD)
+        self.chunk = chunk
+        # End of the requested range, or None for end of file
+        self.end = None
+        if size is not None:
+            self.end = offset + size
+        # End of file, when known
+        self.eof = None
+        # Next offset to return from chunks(), and to send a READ for
+        self.next_offset = offset
+        self.send_offset = offset
+        # Remainders of short reads, as (offset, count), to send first
+        self.retries = []
+        # Outstanding READs for each connection, as {xid: (offset, count)}
+        self.outstanding = []
+        for unused in ncls:
+            self.outstanding.append({})
+        # Received data not yet returned, by offset
+        self.received = {}
+        # Statistics
+        self.calls = 0
+        self.short_reads = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.connection_calls = [0] * len(ncls)
+        self.connection_bytes = [0] * len(ncls)
+
+    def limit(self):
+        """The offset at which to stop sending READs, or None"""
+        if self.eof is None:
+            return self.end
+        elif self.end is None:
+            return self.eof
+        else:
+            return min(self.eof, self.end)
 
+    def done(self):
+        limit = self.limit()
+        return limit is not None and self.next_offset >= limit
+
+    def chunks(self):
+        """Yield the data, in order of offset"""
+        start = time.time()
+        try:
+            while 1:
+                data = self.received.get(self.next_offset)
+                if data is not None:
+                    del self.received[self.next_offset]
+                    limit = self.limit()
+                    if limit is not None:
+                        data = data[:limit - self.next_offset]
+                    self.next_offset = self.next_offset + len(data)
+                    self.bytes = self.bytes + len(data)
+                    self.elapsed = time.time() - start
+                    yield data
+                    continue
+                if self.done():
+                    break
+                self.fill()
+                self.receive()
+        except:
+            self.close()
+            raise
+        self.close()
+        self.elapsed = time.time() - start
+
+    def fill(self):
+        """Send READs until the window of every connection is full"""
+        for i in range(len(self.ncls)):
+            ncl = self.ncls[i]
+            outstanding = self.outstanding[i]
+            while len(outstanding) < self.window:
+                range_ = self.next_range()
+                if range_ is None:
+                    return
+                (offset, count) = range_
+                xid = ncl.send_compound([ncl.putfh_op(self.fh),
+                                         ncl.read(self.stateids[i], offset, count)])
+                outstanding[xid] = range_
+                self.calls = self.calls + 1
+                self.connection_calls[i] = self.connection_calls[i] + 1
+
+    def next_range(self):
+        """Return (offset, count) for the next READ, or None"""
+        limit = self.limit()
+        while self.retries:
+            (offset, count) = self.retries.pop(0)
+            if limit is None or offset < limit:
+                return (offset, count)
+        if limit is not None and self.send_offset >= limit:
+            return None
+        offset = self.send_offset
+        count = self.chunk
+        if self.end is not None:
+            count = min(count, self.end - offset)
+        self.send_offset = offset + count
+        return (offset, count)
+
+    def handle_reply(self, i):
+        (xid, res) = self.ncls[i].recv_compound(self.outstanding[i])
+        range_ = self.outstanding[i].get(xid)
+        if range_ is None:
+            return
+        del self.outstanding[i][xid]
+        check_result(res)
+        (offset, count) = range_
+        resok = res.resarray[1].arm.arm
+        data = resok.data[:count]
+        self.connection_bytes[i] = self.connection_bytes[i] + len(data)
+        if data:
+            self.received[offset] = data
+        if resok.eof or not data:
+            # An empty reply without eof would make us loop forever
+            eof = offset + len(data)
+            if self.eof is None or eof < self.eof:
+                self.eof = eof
+        elif len(data) < count:
+            self.retries.append((offset + len(data), count - len(data)))
+            self.short_reads = self.short_reads + 1
+
+    def close(self):
+        """Wait for the replies of outstanding READs, so that the
+        connections can be used for other calls"""
+        self.drain()
+
+    def throughput(self):
+        """Bytes per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.bytes / self.elapsed
+
+
+class WriteBehind(PipelinedCalls):
+    """Write-behind for a file. Small writes are coalesced into WRITEs
+    of the server's maximum size, which are sent UNSTABLE4 with up to
+    window of them outstanding on each of one or more connections.
+    flush() waits for them and sends a COMMIT. If the write verifier
+    changes, which means that the server has restarted, all
+    uncommitted data is written again.
+
+    The clients must not be used for other calls while writes are
+    outstanding, so call flush() first.
+    """
+    def __init__(self, ncls, fh, stateid, window=PARALLEL_WINDOW, wsize=None):
+        if not isinstance(ncls, type([])):
+            ncls = [ncls]
+        self.ncls = ncls
+        self.ncl = ncls[0]
+        self.fh = fh
+        # Types pack with the packer of their client, so each
+        # connection needs its own copy of the stateid
+        self.stateids = []
+        for ncl in ncls:
+            self.stateids.append(stateid4(ncl, stateid.seqid, stateid.other))
+        self.window = window
+        if wsize is None:
+            wsize = transfer_size(ncls, fh, FATTR4_MAXWRITE)
+        self.wsize = wsize
+        # Data not sent yet, which starts at buffer_offset
+        self.buffer = []
+        self.buffer_offset = 0
+        self.buffer_len = 0
+        # Sent WRITEs for each connection, as {xid: seq}
+        self.outstanding = []
+        for unused in ncls:
+            self.outstanding.append({})
+        # Written but not committed data, as {seq: (offset, data, verf)},
+        # where verf is None until the WRITE reply has arrived
+        self.uncommitted = {}
+        self.seq = 0
+        # Write verifier of the server
+        self.verifier = None
+        # Statistics
+        self.writes = 0
+        self.commits = 0
+        self.rewrites = 0
+        self.bytes = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.connection_calls = [0] * len(ncls)
+        self.connection_bytes = [0] * len(ncls)
+
+    def write(self, offset, data):
+        """Write data at offset"""
+        if self.buffer_len and offset != self.buffer_offset + self.buffer_len:
+            self.send_buffer()
+        if not self.buffer_len:
+            self.buffer_offset = offset
+        self.buffer.append(data)
+        self.buffer_len = self.buffer_len + len(data)
+        self.bytes = self.bytes + len(data)
+        if self.buffer_len >= self.wsize:
+            data = "".join(self.buffer)
+            pos = 0
+            while len(data) - pos >= self.wsize:
+                self.send(self.buffer_offset + pos, data[pos:pos+self.wsize])
+                pos = pos + self.wsize
+            self.buffer = [data[pos:]]
+            self.buffer_offset = self.buffer_offset + pos
+            self.buffer_len = len(data) - pos
+
+    def send_buffer(self):
+        """Send the data not sent yet"""
+        if self.buffer_len:
+            self.send(self.buffer_offset, "".join(self.buffer))
+        self.buffer = []
+        self.buffer_len = 0
+
+    def busy(self):
+        """True if there are outstanding WRITEs"""
+        for outstanding in self.outstanding:
+            if outstanding:
+                return 1
+        return 0
+
+    def send(self, offset, data, seq=None):
+        """Send a WRITE on the connection with the fewest outstanding"""
+        while 1:
+            i = 0
+            for j in range(1, len(self.ncls)):
+                if len(self.outstanding[j]) < len(self.outstanding[i]):
+                    i = j
+            if len(self.outstanding[i]) < self.window:
+                break
+            self.receive()
+        ncl = self.ncls[i]
+        if self.started is None:
+            self.started = time.time()
+        xid = ncl.send_compound([ncl.putfh_op(self.fh),
+                                 ncl.write(data, self.stateids[i], offset,
+                                           UNSTABLE4)])
+        ncl.attrcache.invalidate(self.fh)
+        if seq is None:
+            self.seq = self.seq + 1
+            seq = self.seq
+        self.outstanding[i][xid] = seq
+        self.uncommitted[seq] = (offset, data, None)
+        self.writes = self.writes + 1
+        self.connection_calls[i] = self.connection_calls[i] + 1
+
+    def handle_reply(self, i):
+        """Receive a WRITE reply on connection i, and handle it"""
+        try:
+            (xid, res) = self.ncls[i].recv_compound(self.outstanding[i])
+            check_result(res)
+        except:
+            self.abort()
+            raise
+        seq = self.outstanding[i].get(xid)
+        if seq is None:
+            return
+        del self.outstanding[i][xid]
+        resok = res.resarray[1].arm.arm
+        (offset, data, unused) = self.uncommitted[seq]
+        self.connection_bytes[i] = self.connection_bytes[i] + \
+                                   min(resok.count, len(data))
+        self.elapsed = time.time() - self.started
+        if resok.count < len(data):
+            # Short write; send the rest separately
+            self.uncommitted[seq] = (offset, data[:resok.count], None)
+            self.send(offset + resok.count, data[resok.count:])
+        if resok.committed != UNSTABLE4:
+            del self.uncommitted[seq]
+        else:
+            (offset, data, unused) = self.uncommitted[seq]
+            self.uncommitted[seq] = (offset, data, resok.writeverf)
+        self.check_verifier(resok.writeverf)
+
+    def check_verifier(self, verf):
+        """Write all uncommitted data again, if the verifier has
+        changed since it was written"""
+        self.verifier = verf
+        busy = {}
+        for outstanding in self.outstanding:
+            for seq in outstanding.values():
+                busy[seq] = 1
+        for (seq, (offset, data, written)) in self.uncommitted.items():
+            if written is not None and written != verf and not busy.has_key(seq):
+                self.rewrites = self.rewrites + 1
+                busy[seq] = 1
+                self.send(offset, data, seq)
+
+    def flush(self):
+        """Write all data, and COMMIT it"""
+        self.send_buffer()
+        while self.busy() or self.uncommitted:
+            while self.busy():
+                self.receive()
+            if not self.uncommitted:
+                break
+            ncl = self.ncl
+            res = ncl.compound([ncl.putfh_op(self.fh), ncl.commit_op(0, 0)])
+            check_result(res)
+            self.commits = self.commits + 1
+            verf = res.resarray[1].arm.arm.writeverf
+            self.check_verifier(verf)
+            if not self.busy():
+                self.uncommitted = {}
+        if self.started is not None:
+            self.elapsed = time.time() - self.started
+
+    def abort(self):
+        """Forget all outstanding WRITEs and uncommitted data"""
+        self.drain()
+        self.uncommitted = {}
+        self.buffer = []
+        self.buffer_len = 0
+
+
+def walk(ncls, top=[], attrs=[], workers=1, window=PARALLEL_WINDOW,
+         maxready=64, onerror=None):
+    """Walk the directory tree below the path top, like os.walk. For
+    every directory, yields a tuple (pathcomps, dirnames, filenames,
+    attrs), where attrs is a dictionary with the attributes of every
+    entry (a dictionary like fattr2dict, with the attributes attrs and
+    "type" and "filehandle" if the server returns them) by name.
+    Directories are yielded before their subdirectories, and removing
+    names from dirnames stops the walk from entering them. Symbolic
+    links are not followed.
+
+    ncls is a client or a list of clients. If workers is larger than
+    the number of clients, more connections are made with clone(). See
+    TreeWalker for window and maxready. Errors reading a directory are
+    passed to onerror(pathcomps, exception) if given, or raised."""
+    if not isinstance(ncls, type([])):
+        ncls = [ncls]
+    fh = ncls[0].do_getfh(top)
+    clones = []
+    while len(ncls) + len(clones) < workers:
+        clones.append(ncls[0].clone())
+    walker = TreeWalker(ncls + clones, top, fh, attrs, window, maxready,
+                        onerror, clones)
+    return walker.walk()
+
+
+class TreeWalker(PipelinedCalls):
+    """Read a directory tree with several READDIRs outstanding, on one
+    or more connections. Up to window calls are outstanding on each
+    connection. The entries come with their filehandles if the server
+    supports that attribute; otherwise a LOOKUP is sent with the
+    READDIR. Directories which are already on the path from the top are
+    not read again, so a looping tree is walked only once.
+
+    Directories to read are kept as a stack, so that its size depends
+    on the depth of the tree rather than its size. No more than
+    maxready listings are read ahead of the caller.
+    """
+    def __init__(self, ncls, top, fh, attrs=[], window=PARALLEL_WINDOW,
+                 maxready=64, onerror=None, clones=[]):
+        self.ncls = ncls
+        self.window = window
+        self.maxready = maxready
+        self.onerror = onerror
+        # Connections to close when done
+        self.clones = clones
+        request = attrs[:]
+        for attr in [FATTR4_TYPE, FATTR4_FILEHANDLE]:
+            if attr not in request:
+                request.append(attr)
+        self.attr_request = list2attrmask(request)
+        # Directories to read, as [pathcomps, fh, name, ancestors,
+        # cookie, cookieverf, entries]. If name is not None, the
+        # directory is name in the directory fh. ancestors is a tuple
+        # with the filehandles of the directories above.
+        self.pending = [[list(top), fh, None, (), 0, "", []]]
+        # Directories with more entries to read
+        self.continued = []
+        # Read directories, not yet returned
+        self.ready = []
+        # Outstanding READDIRs for each connection, as {xid: directory}
+        self.outstanding = []
+        for unused in ncls:
+            self.outstanding.append({})
+        # Statistics
+        self.calls = 0
+        self.dirs = 0
+        self.entries = 0
+
+    def walk(self):
+        """Yield (pathcomps, dirnames, filenames, attrs) for every
+        directory, as described for walk()"""
+        for (pathcomps, fh, dirnames, filenames, attrs) in self.listings():
+            yield (pathcomps, dirnames, filenames, attrs)
+
+    def listings(self):
+        """Like walk, but yield (pathcomps, fh, dirnames, filenames,
+        attrs), with the filehandle of the directory"""
+        try:
+            while 1:
+                self.fill()
+                if self.ready:
+                    (pathcomps, fh, unused, ancestors, unused, unused,
+                     entries) = self.ready.pop(0)
+                    (dirnames, filenames, attrs) = self.split(entries)
+                    yield (pathcomps, fh, dirnames, filenames, attrs)
+                    # Read the subdirectories which are left in order
+                    ancestors = ancestors + (fh,)
+                    subdirs = dirnames[:]
+                    subdirs.reverse()
+                    for name in subdirs:
+                        if not attrs.has_key(name):
+                            continue
+                        subfh = attrs[name].get("filehandle")
+                        if subfh is None:
+                            self.pending.append([pathcomps + [name], fh, name,
+                                                 ancestors, 0, "", []])
+                        elif subfh not in ancestors:
+                            self.pending.append([pathcomps + [name], subfh,
+                                                 None, ancestors, 0, "", []])
+                    continue
+                if not self.busy():
+                    break
+                self.receive()
+        except:
+            self.close()
+            raise
+        self.close()
+
+    def split(self, entries):
+        """Return (dirnames, filenames, attrs) for a list of entry4"""
+        dirnames = []
+        filenames = []
+        attrs = {}
+        for entry in entries:
+            entry_attrs = fattr2dict(entry.attrs)
+            attrs[entry.name] = entry_attrs
+            if entry_attrs.get("type") == NF4DIR:
+                dirnames.append(entry.name)
+            else:
+                filenames.append(entry.name)
+        return (dirnames, filenames, attrs)
+
+    def busy(self):
+        """True if there are outstanding READDIRs"""
+        for outstanding in self.outstanding:
+            if outstanding:
+                return 1
+        return 0
+
+    def next_dir(self):
+        """Return the next directory to send a READDIR for, or None"""
+        if self.continued:
+            return self.continued.pop(0)
+        if not self.pending:
+            return None
+        outstanding = 0
+        for calls in self.outstanding:
+            outstanding = outstanding + len(calls)
+        if len(self.ready) + outstanding >= self.maxready:
+            # Wait for the caller
+            return None
+        return self.pending.pop()
+
+    def fill(self):
+        """Send READDIRs until the window of every connection is full"""
+        for i in range(len(self.ncls)):
+            ncl = self.ncls[i]
+            outstanding = self.outstanding[i]
+            while len(outstanding) < self.window:
+                directory = self.next_dir()
+                if directory is None:
+                    return
+                (unused, fh, name, unused, cookie, cookieverf,
+                 unused) = directory
+                operations = [ncl.putfh_op(fh)]
+                if name is not None:
+                    operations.extend([ncl.lookup_op(name), ncl.getfh_op()])
+                operations.append(ncl.readdir(cookie, cookieverf,
+                                              attr_request=self.attr_request))
+                xid = ncl.send_compound(operations)
+                outstanding[xid] = directory
+                self.calls = self.calls + 1
+
+    def handle_reply(self, i):
+        ncl = self.ncls[i]
+        (xid, res) = ncl.recv_compound(self.outstanding[i])
+        directory = self.outstanding[i].get(xid)
+        if directory is None:
+            return
+        del self.outstanding[i][xid]
+        try:
+            check_result(res)
+        except BadCompoundRes, e:
+            if self.onerror is None:
+                raise
+            self.onerror(directory[0], e)
+            return
+        if directory[2] is not None:
+            # Looked up by name
+            fh = res.resarray[2].arm.arm.object
+            if fh in directory[3]:
+                return
+            directory[1] = fh
+            directory[2] = None
+        resok = res.resarray[-1].arm.arm
+        entries = resok.reply.entries
+        ncl.cache_entries(entries)
+        while entries:
+            entry = entries[0]
+            directory[6].append(entry)
+            directory[4] = entry.cookie
+            self.entries = self.entries + 1
+            entries = entry.nextentry
+        if resok.reply.eof or not resok.reply.entries:
+            self.ready.append(directory)
+            self.dirs = self.dirs + 1
+        else:
+            directory[5] = resok.cookieverf
+            self.continued.append(directory)
+
+    def close(self):
+        """Wait for the replies of outstanding READDIRs, so that the
+        connections can be used for other calls, and close the
+        connections made by walk()"""
+        self.drain()
+        for ncl in self.clones:
+            ncl.close()
+        self.clones = []
+
+
+def remove_tree(ncls, pathcomps, workers=1, window=PARALLEL_WINDOW,
+                contents_only=0, progress=None):
+    """Remove the directory pathcomps and everything below it, like
+    rm -r. If contents_only is true, the directory itself is kept.
+
+    The tree is listed once with TreeWalker. Then the directories are
+    emptied bottom-up, deepest first, by TreeRemover, with many REMOVEs
+    in each COMPOUND and the directories of the same depth handled
+    concurrently. ncls, workers and window are as for walk().
+    progress(removed, total) is called after every COMPOUND. Returns
+    the number of names removed. The root directory is never
+    removed."""
+    if not isinstance(ncls, type([])):
+        ncls = [ncls]
+    clones = []
+    while len(ncls) + len(clones) < workers:
+        clones.append(ncls[0].clone())
+    try:
+        fh = ncls[0].do_getfh(pathcomps)
+        walker = TreeWalker(ncls + clones, pathcomps, fh, [], window)
+        remover = TreeRemover(ncls + clones, window, progress)
+        for (dirpath, dirfh, dirnames, filenames, unused) in walker.listings():
+            remover.add(len(dirpath), dirfh, dirnames + filenames)
+        remover.run()
+        if pathcomps and not contents_only:
+            ncl = ncls[0]
+            res = ncl.path_compound(pathcomps[:-1],
+                                    [ncl.remove_op(pathcomps[-1])])
+            check_result(res)
+            remover.removed = remover.removed + 1
+    finally:
+        for ncl in clones:
+            ncl.close()
+    return remover.removed
+
+
+class TreeRemover(PipelinedCalls):
+    """Remove the names of directories, with a COMPOUND of PUTFH and
+    many REMOVEs for each directory, or for each part of a directory
+    which fits in a call. Up to window COMPOUNDs are outstanding on
+    each connection. The directories are added with their depth, and
+    run() empties the deepest ones first, so that subdirectories are
+    empty when they are removed.
+    """
+    def __init__(self, ncls, window=PARALLEL_WINDOW, progress=None):
+        self.ncls = ncls
+        self.window = window
+        self.progress = progress
+        # Names to remove, as {depth: [(dirfh, names)]}
+        self.levels = {}
+        # COMPOUNDs to send, as (dirfh, names)
+        self.batches = []
+        # Outstanding COMPOUNDs for each connection, as
+        # {xid: (argarray, dirfh, names)}
+        self.outstanding = []
+        for unused in ncls:
+            self.outstanding.append({})
+        # Statistics
+        self.calls = 0
+        self.removed = 0
+        self.total = 0
+
+    def add(self, depth, dirfh, names):
+        if names:
+            self.levels.setdefault(depth, []).append((dirfh, names))
+            self.total = self.total + len(names)
+
+    def run(self):
+        depths = self.levels.keys()
+        depths.sort()
+        depths.reverse()
+        try:
+            for depth in depths:
+                for (dirfh, names) in self.levels[depth]:
+                    self.batches.append((dirfh, names))
+                del self.levels[depth]
+                while self.batches or self.busy():
+                    self.fill()
+                    self.receive()
+        except:
+            self.drain()
+            raise
+
+    def busy(self):
+        """True if there are outstanding COMPOUNDs"""
+        for outstanding in self.outstanding:
+            if outstanding:
+                return 1
+        return 0
+
+    def fill(self):
+        """Send COMPOUNDs until the window of every connection is full"""
+        for i in range(len(self.ncls)):
+            ncl = self.ncls[i]
+            outstanding = self.outstanding[i]
+            limit = (ncl.max_call_size or BULK_CALL_SIZE) - \
+                    ncl.callheader_size() - TRANSFER_OVERHEAD
+            while len(outstanding) < self.window and self.batches:
+                (dirfh, names) = self.batches.pop(0)
+                argarray = [ncl.putfh_op(dirfh)]
+                size = argarray[0].xdr_size()
+                for count in range(len(names)):
+                    op = ncl.remove_op(names[count])
+                    size = size + op.xdr_size()
+                    if size > limit and count:
+                        # The rest in another COMPOUND
+                        self.batches.insert(0, (dirfh, names[count:]))
+                        names = names[:count]
+                        break
+                    argarray.append(op)
+                xid = ncl.send_compound(argarray)
+                outstanding[xid] = (argarray, dirfh, names)
+                self.calls = self.calls + 1
+
+    def handle_reply(self, i):
+        ncl = self.ncls[i]
+        (xid, res) = ncl.recv_compound(self.outstanding[i])
+        call = self.outstanding[i].get(xid)
+        if call is None:
+            return
+        del self.outstanding[i][xid]
+        (argarray, dirfh, names) = call
+        ncl.cache_results(argarray, res)
+        removed = 0
+        for resop in res.resarray[1:]:
+            if resop.arm.status == NFS4_OK:
+                removed = removed + 1
+        self.removed = self.removed + removed
+        if res.status == NFS4ERR_NOENT and removed + 1 < len(names):
+            # Already removed. Go on with the rest.
+            self.batches.insert(0, (dirfh, names[removed + 1:]))
+        elif res.status != NFS4ERR_NOENT:
+            check_result(res)
+        if self.progress is not None:
+            self.progress(self.removed, self.total)
+
+
+class LRUCache:
+    """A dictionary with at most maxsize entries. When it is full, the
+    least recently used quarter of the entries is evicted. Counts hits
+    and misses of get()."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        # {key: [value, time of last use]}
+        self.entries = {}
+        self.clock = 0
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return default
+        self.hits = self.hits + 1
+        self.clock = self.clock + 1
+        entry[1] = self.clock
+        return entry[0]
+
+    def peek(self, key, default=None):
+        """Like get, without counting or marking as used"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def stale(self):
+        """Count the last hit as a miss, since the value was unusable"""
+        self.hits = self.hits - 1
+        self.misses = self.misses + 1
+
+    def put(self, key, value):
+        if not self.entries.has_key(key) and len(self.entries) >= self.maxsize:
+            self.evict()
+        self.clock = self.clock + 1
+        self.entries[key] = [value, self.clock]
+
+    def evict(self):
+        items = [(entry[1], key) for (key, entry) in self.entries.items()]
+        items.sort()
+        for (unused, key) in items[:max(1, len(items) / 4)]:
+            del self.entries[key]
+            self.evictions = self.evictions + 1
+
+    def invalidate(self, key):
+        if self.entries.has_key(key):
+            del self.entries[key]
+
+    def clear(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_ratio(self):
+        if not self.hits + self.misses:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+
+class DentryCache(LRUCache):
+    """Filehandles by path, as tuples of components. Entries are used
+    for ttl seconds."""
+    def __init__(self, maxsize=1024, ttl=30):
+        LRUCache.__init__(self, maxsize)
+        self.ttl = ttl
+
+    def add(self, pathcomps, fh):
+        self.put(tuple(pathcomps), (fh, time.time()))
+
+    def lookup(self, pathcomps):
+        """Return the filehandle of pathcomps, or None"""
+        entry = self.get(tuple(pathcomps))
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self.ttl:
+            self.stale()
+            return None
+        return entry[0]
+
+    def peek_fresh(self, pathcomps):
+        """Like lookup, without counting or marking as used. Entries
+        older than ttl are ignored."""
+        entry = self.peek(tuple(pathcomps))
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def lookup_prefix(self, pathcomps):
+        """Find the longest prefix of pathcomps with a filehandle.
+        The empty prefix is the root. Returns a tuple (length of prefix,
+        filehandle), or (0, None)."""
+        for length in range(len(pathcomps), -1, -1):
+            if self.peek_fresh(pathcomps[:length]) is not None:
+                # Count as a hit and mark as used
+                return (length, self.get(tuple(pathcomps[:length]))[0])
+        self.misses = self.misses + 1
+        return (0, None)
+
+    def forget(self, pathcomps):
+        """Remove pathcomps and all paths below it"""
+        prefix = tuple(pathcomps)
+        for key in self.entries.keys():
+            if key[:len(prefix)] == prefix:
+                del self.entries[key]
+
+    def forget_child(self, dirfh, name):
+        """Remove the entry name in the directory dirfh, and the paths
+        below it. If dirfh is None, or the path of a directory is not
+        cached, entries called name are removed from all of them."""
+        for key in self.entries.keys():
+            if key and key[-1] == name and self.entries.has_key(key):
+                parent = self.entries.get(key[:-1])
+                if dirfh is None or parent is None or parent[0][0] == dirfh:
+                    self.forget(key)
+
+
+class DirCache(LRUCache):
+    """Directory listings by filehandle, as lists of entry4, with the
+    change attribute of the directory and the attributes requested.
+    Changes made by this client are applied to the cached listing if
+    the server reports them as atomic, and the listing was current
+    before the change."""
+    def __init__(self, maxsize=256):
+        LRUCache.__init__(self, maxsize)
+
+    def add(self, dirfh, change, attr_request, entries):
+        self.put(dirfh, (change, list(attr_request), entries[:]))
+
+    def lookup(self, dirfh, change, attr_request):
+        """Return the listing of dirfh, if it was made with the change
+        attribute change and the same attr_request, or None"""
+        entry = self.get(dirfh)
+        if entry is None:
+            return None
+        (cached_change, cached_request, entries) = entry
+        if cached_change != change or cached_request != list(attr_request):
+            self.stale()
+            return None
+        return entries[:]
+
+    def find(self, dirfh, name):
+        """Return the cached entry4 of name in dirfh, or None"""
+        entry = self.peek(dirfh)
+        if entry is not None:
+            for dirent in entry[2]:
+                if dirent.name == name:
+                    return dirent
+        return None
+
+    def changed(self, dirfh, cinfo, removed, added):
+        """Apply a change of dirfh described by the change_info4 cinfo:
+        the names removed were removed, and the entry4 added, if not
+        None, was added."""
+        entry = self.peek(dirfh)
+        if entry is None:
+            return
+        (change, attr_request, entries) = entry
+        if cinfo.before == cinfo.after == change:
+            return
+        if not cinfo.atomic or cinfo.before != change or \
+               (added is not None and attr_request and
+                list(added.attrs.attrmask) != attr_request):
+            # Read it again next time
+            self.invalidate(dirfh)
+            return
+        names = removed[:]
+        if added is not None:
+            names.append(added.name)
+        entries = [dirent for dirent in entries if dirent.name not in names]
+        if added is not None:
+            entries.append(added)
+        self.put(dirfh, (cinfo.after, attr_request, entries))
+
+
+class NegativeCache(LRUCache):
+    """Names known not to exist, by (directory filehandle, name). An
+    entry is used for ttl seconds, and only while the change attribute
+    of the directory in attrcache is the same as when it was added.
+    Names are not added while the change attribute is unknown."""
+    def __init__(self, attrcache, maxsize=1024, ttl=5):
+        LRUCache.__init__(self, maxsize)
+        self.attrcache = attrcache
+        self.ttl = ttl
+
+    def dir_change(self, dirfh):
+        entry = self.attrcache.peek(dirfh)
+        if entry is None:
+            return None
+        return entry[0].get("change")
+
+    def add(self, dirfh, name):
+        change = self.dir_change(dirfh)
+        if change is not None:
+            self.put((dirfh, name), (change, time.time()))
+
+    def lookup(self, dirfh, name):
+        """Return true if name is known not to exist in dirfh"""
+        entry = self.get((dirfh, name))
+        if entry is None:
+            return 0
+        (change, added) = entry
+        if time.time() - added > self.ttl or self.dir_change(dirfh) != change:
+            self.stale()
+            self.invalidate((dirfh, name))
+            return 0
+        return 1
+
+    def forget_dir(self, dirfh):
+        """Forget the names in dirfh, or in all directories if dirfh is
+        None"""
+        if dirfh is None:
+            self.clear()
+            return
+        for key in self.entries.keys():
+            if key[0] == dirfh:
+                del self.entries[key]
+
+
+class AttrCache(LRUCache):
+    """File attributes by filehandle. Like in the Linux client, the
+    attributes of a file are trusted for acregmin seconds after they
+    are fetched. Each time they are fetched again and have not changed,
+    the timeout is doubled, up to acregmax. acdirmin and acdirmax are
+    used for directories. A different change attribute throws away
+    everything cached about the object."""
+    def __init__(self, maxsize=1024, acregmin=3, acregmax=60,
+                 acdirmin=30, acdirmax=60):
+        LRUCache.__init__(self, maxsize)
+        self.acregmin = acregmin
+        self.acregmax = acregmax
+        self.acdirmin = acdirmin
+        self.acdirmax = acdirmax
+
+    def lookup(self, fh, names):
+        """Return a dictionary with the attributes names of fh, or None
+        if they are not all cached or have timed out"""
+        entry = self.get(fh)
+        if entry is None:
+            return None
+        (attrs, fetched, timeout) = entry
+        if time.time() - fetched > timeout:
+            self.stale()
+            return None
+        result = {}
+        for name in names:
+            if not attrs.has_key(name):
+                self.stale()
+                return None
+            result[name] = attrs[name]
+        return result
+
+    def update(self, fh, attrs):
+        """Add fetched attributes of fh"""
+        now = time.time()
+        entry = self.peek(fh)
+        if entry is None or self.changed(entry[0], attrs):
+            merged = attrs.copy()
+            (timeout, unused) = self.timeouts(merged)
+        else:
+            (old, unused, timeout) = entry
+            merged = old.copy()
+            merged.update(attrs)
+            (unused, maxtimeout) = self.timeouts(merged)
+            timeout = min(timeout * 2, maxtimeout)
+        self.put(fh, (merged, now, timeout))
+
+    def timeouts(self, attrs):
+        if attrs.get("type") == NF4DIR:
+            return (self.acdirmin, self.acdirmax)
+        return (self.acregmin, self.acregmax)
+
+    def changed(self, old, new):
+        """Return true if the attributes new show that the object has
+        changed since old was fetched"""
+        if old.has_key("change") and new.has_key("change"):
+            return old["change"] != new["change"]
+        for name in new.keys():
+            if name != "time_access" and old.has_key(name) \
+                   and old[name] != new[name]:
+                return 1
+        return 0
+
+
+def dict2fattr(dict, ncl):
+    """Convert a dictionary to a fattr4 object.
+
+    The dictionary is keyed by attribute number, like {FATTR4_SIZE: 4711}.
+    Returns a fattr4 object.  
+    """
+    (attrmask, attr_vals) = get_attrcodec().encode(dict)
+    return fattr4(ncl, attrmask, attr_vals)
 
 
 def fattr2dict(obj):
@@ -987,40 +3107,7 @@ def fattr2dict(obj):
 
     Returns a dictionary like {"size": 4711}
     """
-
-    attrbitnum_dict = get_attrbitnum_dict()
-
-    # Construct a dictionary with the attributes to unpack.
-    # Example: {53: 'time_modify', 4: 'size', 8: 'fsid'}
-    unpack_these = {}
-
-    # Construct one long integer from the integer list.
-    attrmask = 0L
-    for intpos in range(len(obj.attrmask)):
-        integer = long(obj.attrmask[intpos])
-        attrmask = attrmask | (integer << (intpos*32))
-
-    # Loop over all known attributes and check if they were returned. 
-    for attr in attrbitnum_dict.keys():
-        bitnum = attrbitnum_dict[attr]
-        bitvalue = 1L << bitnum
-        if bitvalue & attrmask:
-            unpack_these[bitnum] = attr
-
-    # Construct a dummy Client. 
-    ncl = DummyNcl(obj.attr_vals)
-
-    result = {}
-    attrunpackers = get_attrunpackers(ncl.unpacker)
-    bitnums_to_unpack = unpack_these.keys()
-    # The data on the wire is ordered according to attribute bit number. 
-    bitnums_to_unpack.sort()
-    for bitnum in bitnums_to_unpack:
-	attrname = unpack_these[bitnum]
-	unpack_method = attrunpackers[attrname]
-	result[attrname] = unpack_method()
-
-    return result
+    return get_attrcodec().decode(obj.attrmask, obj.attr_vals)
 
 
 def list2attrmask(attrlist):
@@ -1039,17 +3126,24 @@ def list2attrmask(attrlist):
         attr_request[arrintpos] = arrint
     return attr_request
 
+# Position of the lowest set bit, by its value
+_lowbit_pos = {}
+for _bit in range(32):
+    _lowbit_pos[1L << _bit] = _bit
+del _bit
+
 def attrmask2list(attrmask):
     """Construct a list of attribute constants from the bitmap4 attrmask.
     This is intended as the conjugate function to list2attrmask."""
-    offset = 0;
-    attrs = [];
-    for uint in attrmask:
-        for bit in range(32):
-            value = 1L << bit
-            if uint & value:
-                attrs.append(bit+offset*32)
-        offset += 1
+    attrs = []
+    for intpos in range(len(attrmask)):
+        word = long(attrmask[intpos])
+        offset = intpos * 32
+        # Visit the set bits only, lowest first
+        while word:
+            lowbit = word & -word
+            attrs.append(offset + _lowbit_pos[lowbit])
+            word = word ^ lowbit
     return attrs
 
 def attrmask2attrs(attrmask):
@@ -1128,6 +3222,7 @@ class UDPNFS4Client(PartialNFS4Client, rpc.RawUDPClient):
     def __init__(self, host, port=NFS_PORT, uid=os.getuid(), gid=os.getgid()):
         rpc.RawUDPClient.__init__(self, host, NFS4_PROGRAM, NFS_V4, port)
         PartialNFS4Client.__init__(self)
+        self.max_call_size = UDP_MAXSIZE
         self.uid = uid
         self.gid = gid
         
@@ -1139,14 +3234,110 @@ class TCPNFS4Client(PartialNFS4Client, rpc.RawTCPClient):
         self.uid = uid
         self.gid = gid
 
+    #
+    # Zero-copy READ and WRITE. The data goes between the socket and
+    # the caller's buffer without Python strings in between. Only when
+    # no calls are outstanding, since other replies may come first.
+    #
+
+    def read_into(self, fh, stateid, offset, count, buffer, pos=0):
+        if self.pending:
+            return PartialNFS4Client.read_into(self, fh, stateid, offset,
+                                               count, buffer, pos)
+        call = self.raw_call(fast_encode_read(fh, stateid, offset, count))
+        rpc.sendrecord(self.sock, call)
+        while 1:
+            (last, n) = rpc.recvmark(self.sock)
+            (head, start) = self.recv_read_head(n)
+            if len(head) >= 4 and \
+                   struct.unpack(">L", head[:4])[0] == self.lastxid:
+                break
+            # Reply to a forgotten call
+            self.recv_rest(head, last, n)
+        if start is not None:
+            end = fast_results(head, start, _fast_reply_read)
+            if end is not None and end + 8 == len(head):
+                (eof, datalen) = struct.unpack(">LL", head[end:])
+                padded = (datalen + 3) / 4 * 4
+                if last and n == len(head) + padded and \
+                       datalen <= min(count, len(buffer) - pos):
+                    rpc.recvall_into(self.sock, buffer, pos, datalen)
+                    rpc.recvall(self.sock, padded - datalen)
+                    return (eof != 0, datalen)
+        # Not the expected reply; decode it the usual way
+        self.unpacker.reset(self.recv_rest(head, last, n))
+        self.unpacker.unpack_replyheader()
+        (eof, data) = self.fast_result(fast_decode_read)
+        data = data[:min(count, len(buffer) - pos)]
+        copy_into(buffer, pos, data)
+        return (eof, len(data))
+
+    def recv_read_head(self, n):
+        """Receive the start of a fragment of n bytes with a READ reply:
+        the RPC reply header, and if the call succeeded, the COMPOUND4res
+        up to the data. Returns (head, position of the COMPOUND4res), or
+        (head, None) if the reply has another shape."""
+        head = rpc.recvall(self.sock, min(n, 20))
+        if len(head) < 20:
+            return (head, None)
+        (xid, msg_type, stat, flavor, verflen) = struct.unpack(">LLLLL", head)
+        if msg_type != rpc.REPLY or stat != rpc.MSG_ACCEPTED:
+            return (head, None)
+        # The verifier, accept_stat, and the status and tag length of
+        # the COMPOUND4res
+        size = 20 + (verflen + 3) / 4 * 4 + 12
+        if size > n:
+            return (head, None)
+        head = head + rpc.recvall(self.sock, size - 20)
+        (accept, status, taglen) = struct.unpack(">LLL", head[-12:])
+        start = size - 8
+        # The tag, the results of PUTFH and READ, eof and the data length
+        size = size + (taglen + 3) / 4 * 4 + len(_fast_reply_read)
+        if accept != rpc.SUCCESS or status != NFS4_OK or size > n:
+            return (head, None)
+        head = head + rpc.recvall(self.sock, size - len(head))
+        return (head, start)
+
+    def recv_rest(self, head, last, n):
+        """Receive the rest of a record, of which the fragment header
+        (last, n) and head have been received. Returns the record."""
+        record = head + rpc.recvall(self.sock, n - len(head))
+        if not last:
+            record = record + rpc.recvrecord(self.sock)
+        return record
+
+    def write_from(self, fh, stateid, offset, buffer, pos, count,
+                   stable=FILE_SYNC4):
+        if self.pending:
+            return PartialNFS4Client.write_from(self, fh, stateid, offset,
+                                                buffer, pos, count, stable)
+        call = self.raw_call(fast_encode_write_head(fh, stateid, offset,
+                                                    stable, count))
+        try:
+            self.do_call_parts([call, rpc.readonly_view(buffer, pos, count),
+                                "\0" * (-count % 4)])
+            return self.fast_result(fast_decode_write)
+        finally:
+            self.attrcache.invalidate(fh)
+
 
 class NFS4OpenFile:
     __pychecker__ = 'no-classattr'
     """Emulates a Python file object.
+
+    Reads are buffered, in READs of bufsize bytes. When the file is
+    read sequentially, up to readahead READs are kept outstanding.
+    Writes are coalesced by a WriteBehind. With connections > 1,
+    sequential reads and all writes are striped over that many
+    connections to the server, which share the clientid of ncl; the
+    READs are then of the server's maximum size. The methods readinto,
+    readable, writable and seekable make it usable as the raw file of
+    io.BufferedReader and io.TextIOWrapper.
     """
     # BUGS: If pos is set beyond file size and data is later written,
     # we should fill in zeros. 
-    def __init__(self, ncl):
+    def __init__(self, ncl, bufsize=BUFSIZE, readahead=PARALLEL_WINDOW,
+                 connections=1):
         self.ncl = ncl
         self.__set_priv("closed", 1)
         self.__set_priv("mode", "")
@@ -1159,6 +3350,28 @@ class NFS4OpenFile:
         self.stateid = None
         # Owner
         self.owner = None
+        # WriteBehind, created by the first write
+        self.writer = None
+        # Size of READs, and number of READs to keep outstanding when
+        # reading sequentially (0 disables read-ahead)
+        self.bufsize = bufsize
+        self.readahead = readahead
+        # Read buffer, with data from offset rbuf_offset
+        self.rbuf = ""
+        self.rbuf_offset = 0L
+        # End of the last READ, to detect sequential reads
+        self.last_end = None
+        # ParallelReader for read-ahead, its chunks() generator, and
+        # the offset of the next chunk. last_reader is kept for its
+        # statistics.
+        self.reader = None
+        self.last_reader = None
+        self.reader_chunks = None
+        self.reader_offset = 0L
+        # Number of connections to stripe over, and the clones of ncl
+        # made for them
+        self.connections = connections
+        self.clones = []
 
     def __setattr__(self, name, val):
         if name in ["closed", "mode", "name"]:
@@ -1169,11 +3382,10 @@ class NFS4OpenFile:
     def __set_priv(self, name, val):
         self.__dict__[name] = val
 
-    def open(self, filename, mode="r", unused_bufsize=BUFSIZE):
+    def open(self, filename, mode="r", bufsize=None):
         # filename is a normal unix-path, relative to self.ncl.cwd.
-        operations = [self.ncl.putrootfh_op()]
+        operations = []
 	pathcomps = self.ncl.get_pathcomps_rel(filename)
-        operations.extend(self.ncl.lookup_path(pathcomps[:-1]))
         filename = pathcomps[-1]
 
         self.owner = self.ncl.get_open_owner(self.ncl.default_owner)
@@ -1196,9 +3408,11 @@ class NFS4OpenFile:
 	else:
 	    # FIXME: More modes allowed. 
 	    raise TypeError("Invalid mode")
+        if bufsize:
+            self.bufsize = bufsize
 	
         operations.append(self.ncl.getfh_op())
-        res = self.ncl.compound(operations)
+        res = self.ncl.path_compound(pathcomps[:-1], operations)
 
         check_result(res)
         
@@ -1225,13 +3439,99 @@ class NFS4OpenFile:
 
     def close(self):
         if not self.closed:
+            self.stop_readahead()
+            self.sync_writes()
             self.__set_priv("closed", 1)
+            for ncl in self.clones:
+                ncl.close()
+            self.clones = []
             self.ncl.do_close(self.fh, self.owner.get_seqid(), self.stateid)
 
+    def get_connections(self):
+        """Return the clients to use for READs and WRITEs"""
+        while len(self.clones) < self.connections - 1:
+            self.clones.append(self.ncl.clone())
+        return [self.ncl] + self.clones
+
+    def connection_stats(self):
+        """Return the connection_stats() of the last read-ahead reader
+        and of the WriteBehind, or None for those not used"""
+        reader_stats = writer_stats = None
+        if self.last_reader:
+            reader_stats = self.last_reader.connection_stats()
+        if self.writer:
+            writer_stats = self.writer.connection_stats()
+        return (reader_stats, writer_stats)
+
     def flush(self):
         if self.closed:
             raise ValueError("I/O operation on closed file")
-        raise NotImplementedError()
+        self.sync_writes()
+
+    def sync_writes(self):
+        """Write and COMMIT the written data, so that the client can be
+        used for other calls"""
+        if self.writer:
+            self.writer.flush()
+
+    def stop_readahead(self):
+        """Wait for outstanding read-ahead READs, and forget them"""
+        if self.reader:
+            self.reader.close()
+        self.reader = None
+        self.reader_chunks = None
+
+    def readable(self):
+        return self.mode == "r"
+
+    def writable(self):
+        return self.mode == "w"
+
+    def seekable(self):
+        return 1
+
+    def _fill(self):
+        """Return a tuple (buffer, index), where buffer[index:] is the
+        buffered data at pos. Reads more if there is none. At end of
+        file, index is len(buffer)."""
+        index = self.pos - self.rbuf_offset
+        if 0 <= index < len(self.rbuf):
+            return (self.rbuf, int(index))
+        self.sync_writes()
+        self.rbuf = self._read_chunk()
+        self.rbuf_offset = self.pos
+        return (self.rbuf, 0)
+
+    def _read_chunk(self):
+        """Read up to bufsize bytes at pos"""
+        if self.reader is not None and self.reader_offset == self.pos:
+            try:
+                data = self.reader_chunks.next()
+            except StopIteration:
+                # End of file. Do not start read-ahead again there.
+                self.stop_readahead()
+                self.last_end = None
+                return ""
+            self.reader_offset = self.reader_offset + len(data)
+            self.last_end = self.reader_offset
+            return data
+        self.stop_readahead()
+        if self.readahead and self.last_end == self.pos:
+            # Sequential access; keep READs outstanding from now on
+            chunk = self.bufsize
+            if self.connections > 1:
+                chunk = None
+            self.reader = ParallelReader(self.get_connections(), self.fh,
+                                         self.stateid, self.pos,
+                                         window=self.readahead, chunk=chunk)
+            self.last_reader = self.reader
+            self.reader_chunks = self.reader.chunks()
+            self.reader_offset = self.pos
+            return self._read_chunk()
+        data = "".join(self.ncl.iter_read(self.fh, self.stateid, self.pos,
+                                          self.bufsize, self.bufsize))
+        self.last_end = self.pos + len(data)
+        return data
 
     # isatty() should not be implemented.
 
@@ -1240,39 +3540,77 @@ class NFS4OpenFile:
     def read(self, size=None):
         if self.closed:
             raise ValueError("I/O operation on closed file")
-        data = self.ncl.do_read(self.stateid, self.fh, self.pos, size)
-        # do_read_fast is about 40% faster. But:
-        # FIXME: do_read_fast is currently broken. 
-        # FIXME: Verify that do_read_fast is robust. 
-        #data = self.ncl.do_read_fast(self.fh, self.pos, size)
-        self.pos += len(data)
-        return data
+        if size is not None and size < 0:
+            size = None
+        chunks = []
+        while size is None or size > 0:
+            (buffer, start) = self._fill()
+            end = len(buffer)
+            if start == end:
+                break
+            if size is not None:
+                end = min(end, start + size)
+                size = size - (end - start)
+            chunks.append(buffer[start:end])
+            self.pos += end - start
+        return "".join(chunks)
+
+    def iter_read(self, size=None, chunk=BUFSIZE):
+        """Yield the data from the current position, without moving
+        it or using the buffer. See PartialNFS4Client.iter_read."""
+        self.sync_writes()
+        return self.ncl.iter_read(self.fh, self.stateid, self.pos, size, chunk)
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        data = self.read(len(buffer))
+        copy_into(buffer, 0, data)
+        return len(data)
 
     def readline(self, size=None):
         if self.closed:
             raise ValueError("I/O operation on closed file")
-        data = self.ncl.do_read(self.fh, self.pos, size)
-        
-        if data:
-            line = data.split("\n", 1)[0] + "\n"
-            self.pos += len(line)
-            return line
-        else:
-            return ""
+        if size is not None and size < 0:
+            size = None
+        chunks = []
+        while size is None or size > 0:
+            (buffer, start) = self._fill()
+            end = len(buffer)
+            if start == end:
+                break
+            if size is not None:
+                end = min(end, start + size)
+            newline = buffer.find("\n", start, end)
+            if newline != -1:
+                end = newline + 1
+            chunks.append(buffer[start:end])
+            self.pos += end - start
+            if size is not None:
+                size = size - (end - start)
+            if newline != -1:
+                break
+        return "".join(chunks)
 
     def readlines(self, unused_sizehint=None):
         if self.closed:
             raise ValueError("I/O operation on closed file")
-        data = self.ncl.do_read(self.fh, self.pos)
+        lines = []
+        while 1:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
 
-        self.pos += len(data)
+    def __iter__(self):
+        return self
 
-        lines = data.split("\n")
-        if lines[len(lines)-1] == "":
-            lines = lines[:-1]
-        
-        # Append \n on all lines.
-        return map(lambda line: line + "\n", lines)
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
 
     def xreadlines(self):
         if self.closed:
@@ -1291,11 +3629,8 @@ class NFS4OpenFile:
             newpos = self.pos + offset
         elif whence == 2:
             # seek relative to the file's end
-	    putfhop = self.ncl.putfh_op(self.fh)
-	    getattrop = self.ncl.getattr([FATTR4_SIZE])
-	    res =  self.ncl.compound([putfhop, getattrop])
-	    check_result(res)
-	    size = opaque2long(res.resarray[1].arm.arm.obj_attributes.attr_vals)
+            self.sync_writes()
+            size = self.ncl.do_getattr(self.fh, [FATTR4_SIZE])["size"]
 	    newpos = size + offset
         else:
             raise IOError("[Errno 22] Invalid argument")
@@ -1318,7 +3653,14 @@ class NFS4OpenFile:
         if self.closed:
             raise ValueError("I/O operation on closed file")
 
-	self.ncl.do_write(self.fh, data, stateid=self.stateid, offset=self.pos)
+        # Forget buffered data, which may be overwritten
+        self.stop_readahead()
+        self.rbuf = ""
+        self.last_end = None
+        if self.writer is None:
+            self.writer = WriteBehind(self.get_connections(), self.fh,
+                                      self.stateid)
+        self.writer.write(self.pos, data)
 	self.pos += len(data)
 
     def writelines(self, list):
@@ -10,7 +10,7 @@
 
 from nfs4constants import *
 from nfs4types import *
-import nfs4packer
+import nfs4dispatch
 import rpc
 import nfs4lib
 import os
@@ -57,23 +57,11 @@ class NFSServer:
                 self.fs = filesystem
 
 	def O_Compound(self, ncl, cmp4args):
-		try:
-			cmp4args.unpack()
-		except BadDiscriminant:
-			print " ! BAD DISCRIMINANT unpacking COMPOUND4args"
-			print " ! error NFS4ERR_NOTSUPP"
-			self.turn_around()
-			cmp4res = COMPOUND4res(self, NFS4ERR_NOTSUPP, '', [])
-			cmp4res.pack()
-			return
          	print " UDP NFSv4 COMPOUND call, tag: '%s', minor: %d, n_ops: %d from %s" % (cmp4args.tag, cmp4args.minorversion, len(cmp4args.argarray), self.remote)
 		if cmp4args.minorversion <> 0:
 			print "  ! MINOR VERSION MISMATCH"
 			print "  ! error NFS4ERR_MINOR_VERS_MISMATCH"
-			self.turn_around()
-			cmp4res = COMPOUND4res(self, NFS4ERR_MINOR_VERS_MISMATCH, '', [])
-			cmp4res.pack()
-			return
+			return (NFS4ERR_MINOR_VERS_MISMATCH, [])
 		self.prep_client(self.sender_port)			
 		results = []
 		ok = NFS4_OK
@@ -181,6 +169,17 @@ class NFSServer:
 		argop = nfs_resop4(ncl, resop=OP_CLOSE, opclose=c4res)
 		return (NFS4_OK, argop)
 	
+	def O_Commit(self, ncl, op):
+		print "SERVER COMMIT"
+		print "  CURRENT FILEHANDLE: %s" % self.curr_fh.ref
+		print "  OFFSET: %d COUNT %d" % (op.opcommit.offset, op.opcommit.count)
+		# Writes are not cached, so there is nothing to do. The
+		# verifier is the same as in O_Write.
+		c4resok = COMMIT4resok(ncl, "")
+		c4res = COMMIT4res(ncl, NFS4_OK, c4resok)
+		argop = nfs_resop4(ncl, resop=OP_COMMIT, opcommit=c4res)
+		return (NFS4_OK, argop)
+
 	def O_Create(self, ncl, op):
 		print "SERVER CREATE"
 		print "  CURRENT FILEHANDLE: %s" % self.curr_fh.ref
@@ -347,28 +346,59 @@ class NFSServer:
                 print "  COOKIEVERF: %s, %s" % ( op.opreaddir.cookieverf, op.opreaddir.cookie)
                 print "  ATTRMASK: %s" % str(nfs4lib.attrmask2attrs(op.opreaddir.attr_request))
 
+		# Cookies 0, 1 and 2 are reserved; entry i gets cookie i+3
                 if op.opreaddir.cookie == 0:
                         cookie = str(int(time.time()))[2:]
                         self.client.dirlist[cookie] = self.curr_fh.read_dir()
-                        ncoky = 1 
                         start = 0
+                elif op.opreaddir.cookie in (1, 2):
+			cookie = None
                 else:
                         cookie = op.opreaddir.cookieverf
-                        start = op.opreaddir.cookie*50
-                        ncoky = op.opreaddir.cookie+1
-                
-		# FIXME: Bad system for counting the size of the readdir requests
+                        start = op.opreaddir.cookie - 2
+		if cookie is None or not self.client.dirlist.has_key(cookie):
+			print "  ! error NFS4ERR_BAD_COOKIE"
+			rdres = READDIR4res(ncl, NFS4ERR_BAD_COOKIE)
+			argop = nfs_resop4(ncl, resop=OP_READDIR, opreaddir=rdres)
+			return (NFS4ERR_BAD_COOKIE, argop)
+		dirlist = self.client.dirlist[cookie]
+
+		# Fill the reply up to maxcount (whole READDIR4resok) using the
+		# encoded sizes. The base is cookieverf, the entries flag and
+		# eof. dircount (cookie and name of each entry) is only a hint:
+		# 0 means no limit, and it never stops the first entry.
                 attrs = nfs4lib.attrmask2list(op.opreaddir.attr_request)
-		e4 = []
-                cnt = 100
-                while len(self.client.dirlist[cookie])>(start) and cnt >0:
-                        cnt = cnt - 1
-                        entry = self.client.dirlist[cookie][start]
+		size = 16
+		dirsize = 0
+		entries = []
+		while start < len(dirlist):
+			entry = dirlist[start]
 			attrvals = entry.get_attributes(ncl, attrs) 
 			f4 = nfs4lib.dict2fattr(attrvals, ncl)
-			e4 = [ entry4(ncl, ncoky, name=entry.ref, attrs=f4, nextentry=e4)]
-                        start = start + 1
-                if start < len(self.client.dirlist[cookie]):
+			e4 = entry4(ncl, start + 3, name=entry.ref, attrs=f4, nextentry=[])
+			entsize = e4.xdr_size()
+			namesize = 8 + ncl.packer.size_component4(entry.ref)
+			if size + entsize > op.opreaddir.maxcount:
+				break
+			if entries and op.opreaddir.dircount and \
+			   dirsize + namesize > op.opreaddir.dircount:
+				break
+			size = size + entsize
+			dirsize = dirsize + namesize
+			entries.append(e4)
+			start = start + 1
+		if not entries and start < len(dirlist):
+			print "  ! error NFS4ERR_TOOSMALL"
+			rdres = READDIR4res(ncl, NFS4ERR_TOOSMALL)
+			argop = nfs_resop4(ncl, resop=OP_READDIR, opreaddir=rdres)
+			return (NFS4ERR_TOOSMALL, argop)
+
+		# Link the entries in directory order
+		e4 = []
+		for i in range(len(entries)-1, -1, -1):
+			entries[i].nextentry = e4
+			e4 = [entries[i]]
+                if start < len(dirlist):
                         d4 = dirlist4(ncl, e4, eof=0)
                 else:
                         del self.client.dirlist[cookie]
@@ -430,14 +460,10 @@ class NFSServer:
 		return (NFS4_OK, argop)
 
 
-class UDPServer(rpc.UDPServer):
+class UDPServer(nfs4dispatch.NFS_V4Server, rpc.UDPServer):
 	def addserver(self, server):
 		self.server = server
 
-	def addpackers(self):
-		self.packer = nfs4packer.NFS4Packer(self)
-		self.unpacker = nfs4packer.NFS4Unpacker(self,'')
-
         def bindsocket(self, sock=853):
 	        if self.prog <0x200000:
 	                try:
@@ -447,18 +473,29 @@ class UDPServer(rpc.UDPServer):
 	        else:
         	        self.sock.bind(('', 0))
 	
-	def handle_1(self):
+	def handle_NFSPROC4_COMPOUND(self):
+		# Like the generated handler, but a COMPOUND with an undefined
+		# operation gets NFS4ERR_NOTSUPP instead of GARBAGE_ARGS
 		cmp4args = COMPOUND4args(self)
+		try:
+			cmp4args.unpack()
+		except BadDiscriminant:
+			print " ! BAD DISCRIMINANT unpacking COMPOUND4args"
+			print " ! error NFS4ERR_NOTSUPP"
+			res = COMPOUND4res(self, NFS4ERR_NOTSUPP, '', [])
+		else:
+			res = self.NFSPROC4_COMPOUND(cmp4args)
+		self.turn_around()
+		res.pack()
+
+	def NFSPROC4_COMPOUND(self, cmp4args):
 		print "UDP RPC CALL"
 		print " Credentials: %s" % repr(self.recv_cred)
                 print " Verifier: %s" % repr(self.recv_verf)
 		self.server.sender_port = self.sender_port
 		self.server.remote = "%s %s" % self.sender_port
 		ok, results = self.server.O_Compound(self, cmp4args)
-		self.turn_around()
-		cmp4res = COMPOUND4res(self, ok, cmp4args.tag, results)
-                cmp4res.pack()
-                return
+		return COMPOUND4res(self, ok, cmp4args.tag, results)
 		
 def main():
         udpserver = UDPServer('', NFS4_PROGRAM, NFS_V4, 2049)
@@ -275,25 +275,16 @@ class NFSSuite(unittest.TestCase):
     def clean_dir(self, directory):
         """Clean directory. Raises SkipException on failure"""
         fh = self.do_rpc(self.ncl.do_getfh, directory)
-        entries = self.do_rpc(self.ncl.do_readdir, fh)
-        
-        names = [entry.name for entry in entries]
-
-        for name in names:
-            lookup_dir_ops = self.ncl.lookup_path(directory)
-            operations = [self.ncl.putrootfh_op()] + lookup_dir_ops
-            operations.append(self.ncl.remove_op(name))
-            res = self.do_compound(operations)
-
-            if res.status == NFS4ERR_NOTEMPTY:
-                # Recursive deletion
-                self.clean_dir(directory + [name])
-            elif not res.status == NFS4_OK:
-                raise SkipException("Cannot clean directory %s" % directory)
+        try:
+            nfs4lib.remove_tree(self.ncl, directory, contents_only=1)
+        except rpc.RPCException:
+            raise SkipException("Cannot clean directory %s" % directory)
 
-        # Verify that all files were removed
-        entries = self.do_rpc(self.ncl.do_readdir, fh)
-        if entries:
+        # Verify that all files were removed. Ask the server, not the
+        # client caches.
+        operations = [self.ncl.putfh_op(fh), self.ncl.readdir()]
+        res = self.do_compound(operations)
+        if res.status != NFS4_OK or res.resarray[-1].arm.arm.reply.entries:
             raise SkipException("Cannot clean directory %s" % directory)
 
     def create_object(self, name=None, directory=None):
@@ -3114,6 +3105,53 @@ class ReaddirSuite(NFSSuite):
         self.failIf(".." in names,
                     "READDIR in /doc returned ..-entry")
 
+    def testDircountZeroPaging(self):
+        """READDIR with dircount=0 should page through a directory
+
+        Extra test
+
+        Comments: dircount is only a hint. With dircount=0, the reply
+        is limited by maxcount alone, and the server must not return
+        NFS4ERR_TOOSMALL. maxcount is kept small, so that /doc needs
+        more than one reply.
+        """
+        fh = self.do_rpc(self.ncl.do_getfh, self.dirfile)
+        expected = [entry.name for entry in self.do_rpc(self.ncl.do_readdir, fh)]
+
+        cookie = 0
+        cookieverf = "\x00"
+        names = []
+        calls = 0
+        while 1:
+            readdirop = self.ncl.readdir_op(cookie=cookie, cookieverf=cookieverf,
+                                            dircount=0, maxcount=128,
+                                            attr_request=[])
+            res = self.do_compound([self.ncl.putfh_op(fh), readdirop])
+            self.assert_OK(res)
+            calls = calls + 1
+            reply = res.resarray[-1].arm.arm.reply
+            entry = None
+            if reply.entries:
+                entry = reply.entries[0]
+            while entry:
+                names.append(entry.name)
+                last_cookie = entry.cookie
+                if not entry.nextentry:
+                    break
+                entry = entry.nextentry[0]
+            if reply.eof:
+                break
+            self.failIf(not reply.entries,
+                        "READDIR with dircount=0 returned no entries before eof")
+            cookie = last_cookie
+            cookieverf = res.resarray[-1].arm.arm.cookieverf
+
+        if calls == 1:
+            self.info_message("/doc fits in one reply, paging not tested")
+        self.failIf(names != expected,
+                    "READDIR with dircount=0 returned %s, expected %s" \
+                    % (repr(names), repr(expected)))
+
     def testStrangeNames(self):
         """READDIR should obey OPEN naming policy
 
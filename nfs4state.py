@@ -113,7 +113,7 @@ class VirtualHandle(NFSFileHandle):
                                 else:
                                         ret_dict[attr] = NF4REG
         		elif attr == FATTR4_CHANGE:
-                                ret_dict[attr] = nfstime4(ncl, self.st_ctime, 0);
+                                ret_dict[attr] = long(self.st_ctime)
         		elif attr == FATTR4_SIZE:
                                 ret_dict[attr] = self.st_size
                         elif attr == FATTR4_FSID:
@@ -181,7 +181,7 @@ class HardHandle(NFSFileHandle):
 				elif S_ISLNK(stat_struct.st_mode):
 					ret_dict[attr] = NF4LNK
         		elif attr == FATTR4_CHANGE:
-                                ret_dict[attr] = nfstime4(ncl, stat_struct.st_ctime, 0);
+                                ret_dict[attr] = long(stat_struct.st_ctime * 1000000)
         		elif attr == FATTR4_SIZE:
                                 ret_dict[attr] = stat_struct.st_size
                         elif attr == FATTR4_FSID:
@@ -40,7 +40,18 @@ __pychecker__ = 'no-callinit'
 import xdrlib
 import socket
 import os
+import sys
 import time
+import struct
+import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 
 RPCVERSION = 2
 
@@ -60,6 +71,7 @@ PROG_UNAVAIL  = 1			# remote hasn't exported program
 PROG_MISMATCH = 2			# remote can't support version #
 PROC_UNAVAIL  = 3			# program can't support procedure
 GARBAGE_ARGS  = 4			# procedure can't decode params
+SYSTEM_ERR    = 5			# errors like memory allocation failure
 
 RPC_MISMATCH = 0			# RPC version number != 2
 AUTH_ERROR = 1				# remote can't authenticate caller
@@ -187,9 +199,73 @@ class Packer(xdrlib.Packer):
 	self.pack_string(machinename)
 	self.pack_uint(uid)
 	self.pack_uint(gid)
-	self.pack_uint(len(gids))
-	for i in gids:
-	    self.pack_uint(i)
+	self.pack_uint_array(gids)
+
+    # Bulk codecs for variable length arrays of fixed width
+    # primitives. The items are encoded with a single struct.pack
+    # call instead of one pack_<type> call per item. 
+
+    def pack_bulk(self, format, list):
+	n = len(list)
+	self.pack_uint(n)
+	data = struct.pack(">%d%s" % (n, format), *list)
+	self.pack_fopaque(len(data), data)
+
+    def pack_uint_array(self, list):
+	self.pack_bulk("L", list)
+
+    def pack_int_array(self, list):
+	self.pack_bulk("l", list)
+
+    def pack_uhyper_array(self, list):
+	self.pack_bulk("Q", list)
+
+    def pack_hyper_array(self, list):
+	self.pack_bulk("q", list)
+
+    def pack_float_array(self, list):
+	self.pack_bulk("f", list)
+
+    def pack_double_array(self, list):
+	self.pack_bulk("d", list)
+
+    # Encoded sizes. These return the number of bytes the corresponding
+    # pack_<type> method would produce, without packing anything. 
+
+    def size_uint(self, unused_x):
+	return 4
+
+    size_int = size_enum = size_bool = size_float = size_uint
+
+    def size_uhyper(self, unused_x):
+	return 8
+
+    size_hyper = size_double = size_uhyper
+
+    def size_fopaque(self, n, unused_s=None):
+	return (n+3)/4*4
+
+    def size_opaque(self, s):
+	return 4 + (len(s)+3)/4*4
+
+    size_string = size_opaque
+
+    def size_farray(self, n, list, size_item):
+	size = 0
+	for item in list:
+	    size = size + size_item(item)
+	return size
+
+    def size_array(self, list, size_item):
+	return 4 + self.size_farray(len(list), list, size_item)
+
+    def size_auth(self, auth):
+	flavor, stuff = auth
+	return 4 + self.size_opaque(stuff)
+
+    def size_callheader(self, cred, verf):
+	# xid, msg_type, rpcvers, prog, vers, proc
+	return 24 + self.size_auth(cred) + self.size_auth(verf)
 
     def pack_callheader(self, xid, prog, vers, proc, cred, verf):
 	self.pack_uint(xid)
@@ -227,13 +303,36 @@ class Unpacker(xdrlib.Unpacker):
         print "machinename: %s" % machinename
         uid=self.unpack_uint()
         gid=self.unpack_uint()
-        n_gids=self.unpack_uint()
-        gids = []
-        print "n_gids: %d" % n_gids
-        for i in range(n_gids):
-            gids.append(self.unpack_uint())
+        gids = self.unpack_uint_array()
+        print "n_gids: %d" % len(gids)
         return stamp, machinename, uid, gid, gids
 
+    # Bulk decoders, see Packer.pack_bulk. These return array objects
+    # (or NumPy arrays, see decode_bulk) rather than lists. Such objects
+    # never compare equal to a list, so use list() before comparing.
+
+    def unpack_bulk(self, format):
+	n = self.unpack_uint()
+	return decode_bulk(format, self.unpack_fopaque(n*struct.calcsize(">" + format)))
+
+    def unpack_uint_array(self):
+	return self.unpack_bulk("L")
+
+    def unpack_int_array(self):
+	return self.unpack_bulk("l")
+
+    def unpack_uhyper_array(self):
+	return self.unpack_bulk("Q")
+
+    def unpack_hyper_array(self):
+	return self.unpack_bulk("q")
+
+    def unpack_float_array(self):
+	return self.unpack_bulk("f")
+
+    def unpack_double_array(self):
+	return self.unpack_bulk("d")
+
 
     def unpack_callheader(self):
 	xid = self.unpack_uint()
@@ -286,6 +385,87 @@ class Unpacker(xdrlib.Unpacker):
 	return xid, verf
 	# Caller must get procedure-specific part of reply
 
+    # Skipping. These advance the position past an encoded item without
+    # building any Python objects. Used by the generated skip_<type>
+    # methods, which allows lazy decoding of large replies.
+
+    def skip_fopaque(self, n):
+	pos = self.get_position() + (n+3)/4*4
+	if pos > len(self.get_buffer()):
+	    raise EOFError
+	self.set_position(pos)
+
+    def skip_opaque(self):
+	self.skip_fopaque(self.unpack_uint())
+
+    skip_string = skip_opaque
+
+    def skip_uint(self):
+	self.skip_fopaque(4)
+
+    skip_int = skip_enum = skip_bool = skip_float = skip_uint
+
+    def skip_uhyper(self):
+	self.skip_fopaque(8)
+
+    skip_hyper = skip_double = skip_uhyper
+
+    def skip_farray(self, n, skip_item):
+	for i in range(n):
+	    skip_item()
+
+    def skip_array(self, skip_item):
+	self.skip_farray(self.unpack_uint(), skip_item)
+
+    def skip_uint_array(self):
+	self.skip_fopaque(self.unpack_uint()*4)
+
+    skip_int_array = skip_float_array = skip_uint_array
+
+    def skip_uhyper_array(self):
+	self.skip_fopaque(self.unpack_uint()*8)
+
+    skip_hyper_array = skip_double_array = skip_uhyper_array
+
+
+# Decoding of bulk arrays
+
+# Set to return NumPy arrays from the bulk decoders, if NumPy is
+# available. These are read-only views of the received data. 
+bulk_numpy = 0
+
+_numpy_dtypes = {"L": ">u4", "l": ">i4", "Q": ">u8", "q": ">i8",
+                 "f": ">f4", "d": ">f8"}
+
+def _find_typecode(format, typecodes):
+    for typecode in typecodes:
+	try:
+	    if array.array(typecode).itemsize == struct.calcsize(">" + format):
+		return typecode
+	except ValueError:
+	    # Typecode not supported by this Python
+	    pass
+    return None
+
+# array typecodes with the same width as each struct format, or None
+_array_typecodes = {}
+for _format, _typecodes in [("L", "IL"), ("l", "il"), ("Q", "LQ"),
+                            ("q", "lq"), ("f", "f"), ("d", "d")]:
+    _array_typecodes[_format] = _find_typecode(_format, _typecodes)
+
+def decode_bulk(format, data):
+    """Decode big endian items of struct format character format"""
+    if bulk_numpy and numpy:
+	return numpy.frombuffer(data, _numpy_dtypes[format])
+    typecode = _array_typecodes[format]
+    if typecode is None:
+	n = len(data) / struct.calcsize(">" + format)
+	return list(struct.unpack(">%d%s" % (n, format), data))
+    a = array.array(typecode, data)
+    if sys.byteorder == "little":
+	a.byteswap()
+    return a
+
 
 # Subroutines to create opaque authentication objects
 
@@ -354,6 +534,10 @@ class Client:
 	self.addpackers()
 	self.cred = None
 	self.verf = None
+	# Calls sent with send_call, by xid, which have no reply yet
+	self.pending = {}
+	# Replies to pending calls, received while waiting for another
+	self.replies = {}
 
     def close(self):
 	self.sock.close()
@@ -394,6 +578,79 @@ class Client:
             
 	return result
 
+    def send_call(self, proc, args, pack_func):
+	# Send a call without waiting for the reply, so that several
+	# calls can be outstanding. Returns the xid. The replies are
+	# received with recv_reply. 
+	if pack_func is None and args is not None:
+	    raise TypeError("non-null args with null pack_func")
+	self.start_call(proc)
+	if pack_func:
+	    pack_func(args)
+	call = self.packer.get_buffer()
+	self.pending[self.lastxid] = call
+	self.send_buffer(call)
+	return self.lastxid
+
+    def recv_reply(self, wanted=None):
+	# Wait for the reply to a call sent with send_call. Returns the
+	# xid, with the unpacker positioned at the results. If wanted
+	# is given, only replies with xids in it are returned, and
+	# replies to other pending calls are kept for later. Replies
+	# to calls which are not pending are dropped. 
+	while 1:
+	    reply = None
+	    for xid in self.replies.keys():
+		if wanted is None or wanted.has_key(xid):
+		    reply = self.replies[xid]
+		    del self.replies[xid]
+		    break
+	    if reply is not None:
+		break
+	    reply = self.recv_buffer()
+	    if len(reply) < 4:
+		continue
+	    xid = struct.unpack(">L", reply[:4])[0]
+	    if not self.pending.has_key(xid):
+		continue
+	    if wanted is None or wanted.has_key(xid):
+		break
+	    self.replies[xid] = reply
+	del self.pending[xid]
+	self.unpacker.reset(reply)
+	self.unpacker.unpack_replyheader()
+	return xid
+
+    def forget_call(self, xid):
+	# Stop waiting for the reply to a call sent with send_call
+	if self.pending.has_key(xid):
+	    del self.pending[xid]
+	if self.replies.has_key(xid):
+	    del self.replies[xid]
+
+    def keep_reply(self, reply):
+	# Keep a reply which do_call received for a call sent with
+	# send_call, for recv_reply. Returns true if it was kept. 
+	if len(reply) < 4:
+	    return 0
+	xid = struct.unpack(">L", reply[:4])[0]
+	if xid <> self.lastxid and self.pending.has_key(xid):
+	    self.replies[xid] = reply
+	    return 1
+	return 0
+
+    def send_buffer(self, call):
+	# This MUST be overridden for send_call
+	raise RuntimeError("send_buffer not defined")
+
+    def recv_buffer(self):
+	# This MUST be overridden for recv_reply
+	raise RuntimeError("recv_buffer not defined")
+
+    def callheader_size(self):
+	# Encoded size of the call header start_call would produce
+	return self.packer.size_callheader(self.mkcred(), self.mkverf())
+
     def start_call(self, proc):
 	# Don't override this
 	self.lastxid = xid = self.lastxid + 1
@@ -425,6 +682,12 @@ class Client:
 
 # Record-Marking standard support
 
+# Flag to send, telling that more data follows. The socket module of
+# Python 2 lacks the constant; this is its value on Linux.
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+if not MSG_MORE and sys.platform.startswith("linux"):
+    MSG_MORE = 0x8000
+
 def sendfrag(sock, last, frag):
     x = len(frag)
     if last: x = x | 0x80000000L
@@ -435,7 +698,8 @@ def sendfrag(sock, last, frag):
 def sendrecord(sock, record):
     sendfrag(sock, 1, record)
 
-def recvfrag(sock):
+def recvmark(sock):
+    # Receive the header of a fragment. Returns (last, length)
     header = sock.recv(4)
     if len(header) < 4:
 	raise EOFError
@@ -443,6 +707,10 @@ def recvfrag(sock):
 	ord(header[2])<<8 | ord(header[3])
     last = ((x & 0x80000000) != 0)
     n = int(x & 0x7fffffff)
+    return last, n
+
+def recvfrag(sock):
+    last, n = recvmark(sock)
     frag = ''
     while n > 0:
 	buf = sock.recv(n)
@@ -459,6 +727,85 @@ def recvrecord(sock):
 	record = record + frag
     return record
 
+def sendfrag_parts(sock, last, parts):
+    """Send one fragment, with the concatenation of the strings or
+    buffer objects parts as data, without joining them. Where there
+    is MSG_MORE, it keeps the parts from going out as small packets."""
+    n = 0
+    for part in parts:
+        n = n + len(part)
+    if last:
+        n = n | 0x80000000L
+    header = struct.pack(">L", n)
+    if parts and type(parts[0]) == type(""):
+        parts = [header + parts[0]] + parts[1:]
+    else:
+        parts = [header] + parts
+    parts = [part for part in parts if len(part)]
+    for part in parts[:-1]:
+        sock.sendall(part, MSG_MORE)
+    sock.sendall(parts[-1])
+
+def readonly_view(data, pos, n):
+    """Return n bytes of data from pos, for sending. A buffer object
+    is used when possible, so that the bytes are not copied."""
+    try:
+        return buffer(data, pos, n)
+    except (NameError, TypeError):
+        view = data[pos:pos+n]
+        if isinstance(view, array.array):
+            view = view.tostring()
+        return view
+
+def recvall(sock, n):
+    """Receive exactly n bytes"""
+    data = ''
+    while len(data) < n:
+        buf = sock.recv(n - len(data))
+        if not buf:
+            raise EOFError
+        data = data + buf
+    return data
+
+def writable_view(buffer, pos):
+    """Return an object which recv_into can fill, starting at buffer[pos],
+    or None if there is no way to make one. buffer can be a bytearray,
+    an array or an mmap object."""
+    if not pos:
+        return buffer
+    try:
+        return memoryview(buffer)[pos:]
+    except (NameError, TypeError):
+        pass
+    if ctypes is not None:
+        try:
+            return (ctypes.c_char * (len(buffer) - pos)).from_buffer(buffer, pos)
+        except TypeError:
+            pass
+    return None
+
+def recvall_into(sock, buffer, pos, n):
+    """Receive exactly n bytes into buffer at pos. The data is received
+    straight into buffer when the socket has recv_into, and falls back
+    to slice assignment otherwise."""
+    view = None
+    if hasattr(sock, "recv_into"):
+        view = writable_view(buffer, pos)
+    if view is None:
+        data = recvall(sock, n)
+        if isinstance(buffer, array.array):
+            data = array.array(buffer.typecode, data)
+        buffer[pos:pos+n] = data
+        return
+    done = 0
+    while done < n:
+        if done:
+            view = writable_view(buffer, pos + done)
+        count = sock.recv_into(view, n - done)
+        if not count:
+            raise EOFError
+        done = done + count
+
 
 # Try to bind to a reserved port (must be root)
 
@@ -488,9 +835,16 @@ class RawTCPClient(Client):
 	self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     def do_call(self):
-	call = self.packer.get_buffer()
-	sendrecord(self.sock, call)
-	reply = recvrecord(self.sock)
+	self.do_call_parts([self.packer.get_buffer()])
+
+    def do_call_parts(self, parts):
+	# Like do_call, but the call is the concatenation of parts,
+	# strings or buffer objects, which are sent without joining them
+	sendfrag_parts(self.sock, 1, parts)
+	while 1:
+	    reply = recvrecord(self.sock)
+	    if not self.keep_reply(reply):
+		break
 	u = self.unpacker
 	u.reset(reply)
 	xid, verf = u.unpack_replyheader()
@@ -498,6 +852,12 @@ class RawTCPClient(Client):
 	    # Can't really happen since this is TCP...
 	    raise XidMismatch(xid, self.lastxid)
 
+    def send_buffer(self, call):
+	sendrecord(self.sock, call)
+
+    def recv_buffer(self):
+	return recvrecord(self.sock)
+
 # Client using UDP to a specific port
 
 class RawUDPClient(Client):
@@ -528,6 +888,8 @@ class RawUDPClient(Client):
 		self.sock.send(call)
 		continue
 	    reply = self.sock.recv(BUFSIZE)
+	    if self.keep_reply(reply):
+		continue
 	    u = self.unpacker
 	    u.reset(reply)
 	    xid, verf = u.unpack_replyheader()
@@ -536,6 +898,26 @@ class RawUDPClient(Client):
 		continue
 	    break
 
+    def send_buffer(self, call):
+	self.sock.send(call)
+
+    def recv_buffer(self):
+	# Like do_call, but resends all pending calls on timeouts
+	from select import select
+	BUFSIZE = 8192 # Max UDP buffer size
+	timeout = 1
+	count = 5
+	while 1:
+	    r, w, x = select([self.sock], [], [], timeout)
+	    if self.sock in r:
+		return self.sock.recv(BUFSIZE)
+	    count = count - 1
+	    if count < 0: raise TimeoutError()
+	    if timeout < 25: timeout = timeout *2
+	    for (xid, call) in self.pending.items():
+		if not self.replies.has_key(xid):
+		    self.sock.send(call)
+
 
 # Client using UDP broadcast to a specific port
 
@@ -798,6 +1180,10 @@ class BroadcastUDPClient(Client):
 
 class Server:
 
+    # Procedure numbers mapped to handler method names. Procedures
+    # not listed are handled by handle_<proc>, if it exists. 
+    procedures = {}
+
     def __init__(self, host, prog, vers, port):
 	self.host = host # Should normally be '' for default interface
 	self.prog = prog
@@ -809,6 +1195,8 @@ class Server:
 	self.bindsocket()
 	self.host, self.port = self.sock.getsockname()
 	self.addpackers()
+	# Bound handler methods by procedure number, filled in by handle()
+	self.handlers = {}
 
     def register(self):
 	mapping = self.prog, self.vers, self.prot, self.port
@@ -853,12 +1241,13 @@ class Server:
 	    self.packer.pack_uint(self.vers)
 	    return self.packer.get_buffer()
 	proc = self.unpacker.unpack_uint()
-	methname = 'handle_' + `proc`
-	try:
-	    meth = getattr(self, methname)
-	except AttributeError:
-	    self.packer.pack_uint(PROC_UNAVAIL)
-	    return self.packer.get_buffer()
+	meth = self.handlers.get(proc)
+	if meth is None:
+	    meth = getattr(self, self.procedures.get(proc, 'handle_' + `proc`), None)
+	    if meth is None:
+		self.packer.pack_uint(PROC_UNAVAIL)
+		return self.packer.get_buffer()
+	    self.handlers[proc] = meth
 	self.recv_cred = self.unpacker.unpack_auth()
 	self.recv_verf = self.unpacker.unpack_auth()
 	try:
@@ -871,6 +1260,14 @@ class Server:
 	    self.packer.pack_uint(MSG_ACCEPTED)
 	    self.packer.pack_auth((AUTH_NULL, make_auth_null()))
 	    self.packer.pack_uint(GARBAGE_ARGS)
+	except NotImplementedError:
+	    # Procedure method not overridden
+	    self.packer.reset()
+	    self.packer.pack_uint(xid)
+	    self.packer.pack_uint(REPLY)
+	    self.packer.pack_uint(MSG_ACCEPTED)
+	    self.packer.pack_auth((AUTH_NULL, make_auth_null()))
+	    self.packer.pack_uint(SYSTEM_ERR)
 	return self.packer.get_buffer()
 
     def turn_around(self):
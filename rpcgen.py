@@ -44,10 +44,11 @@
 # rpcgen.py does not handle this case either, but it probably should. 
 
 import sys
+import getopt
 import keyword
 import StringIO
-import time
 import os
+import md5
 import yacc
 
 #
@@ -143,6 +144,44 @@ known_basics = {"int" : "pack_int",
 
 known_types = {}
 
+# Values of constants and enums, for computing sizes.
+const_values = {}
+
+# Encoded size of types which always have the same size.
+fixed_sizes = {"int" : 4,
+               "enum" : 4,
+               "unsigned_int" : 4,
+               "unsigned" : 4,
+               "hyper" : 8,
+               "unsigned_hyper" : 8,
+               "float" : 4,
+               "double" : 8,
+               "quadruple" : 8,
+               "bool" : 4}
+
+# Types whose arrays are encoded with the bulk codecs in rpc.py,
+# mapped to the suffix of the codec: pack_<suffix>_array etc. 
+bulk_types = {"int" : "int",
+              "unsigned_int" : "uint",
+              "unsigned" : "uint",
+              "hyper" : "hyper",
+              "unsigned_hyper" : "uhyper",
+              "float" : "float",
+              "double" : "double"}
+
+# Members of enums, as (name, value)
+enum_members = {}
+
+# Procedures and versions parsed, but not yet generated
+parsed_procedures = []
+parsed_versions = []
+
+# Command line options
+# Generate types which decode nested data on first access
+lazy_types = 0
+# Generate types without ncl, which are given the codec when packed
+context_free = 0
+
 constheader = """
 __all__ = %s
 
@@ -157,23 +196,41 @@ import rpc
 
 __all__ = %s
 
+def assert_not_none(klass, *args):
+    for arg in args:
+	if arg == None:
+	    raise TypeError(repr(klass) + " has uninitialized data")
+
+class BadDiscriminant(rpc.RPCException):
+    def __init__(self, value, klass):
+        self.value = value
+        self.klass = klass
+
+    def __str__(self):
+        return "Bad Discriminant %%s in %%s" %% (self.value, self.klass)
+
+""" 
+
+# Helpers for types bound to an ncl, the default
+nclheader = """
 def init_type_class(klass, ncl):
     # Initilize type class
     klass.ncl = ncl
     klass.packer = ncl.packer
     klass.unpacker = ncl.unpacker
 
-def assert_not_none(klass, *args):
-    for arg in args:
-	if arg == None:
-	    raise TypeError(repr(klass) + " has uninitialized data")
-
 def pack_objarray(ncl, list):
     # FIXME: Support for length assertion. 
     ncl.packer.pack_uint(len(list))
     for item in list:
 	item.pack()
 
+def size_objarray(list):
+    size = 4
+    for item in list:
+        size = size + item.xdr_size()
+    return size
+
 def unpack_objarray(ncl, klass):
     n = ncl.unpacker.unpack_uint()
     list = []
@@ -183,16 +240,117 @@ def unpack_objarray(ncl, klass):
 	list.append(obj)
     return list
 
+"""
 
-class BadDiscriminant(rpc.RPCException):
-    def __init__(self, value, klass):
-        self.value = value
-        self.klass = klass
+# Helpers for types generated with --context-free
+contextfreeheader = """
+def pack_objarray(packer, list):
+    packer.pack_uint(len(list))
+    for item in list:
+	item.pack(packer)
 
-    def __str__(self):
-        return "Bad Discriminant %%s in %%s" %% (self.value, self.klass)
+def size_objarray(list, packer):
+    size = 4
+    for item in list:
+        size = size + item.xdr_size(packer)
+    return size
 
-""" 
+def unpack_objarray(unpacker, klass):
+    n = unpacker.unpack_uint()
+    list = []
+    for i in range(n):
+	obj = klass()
+	obj.unpack(unpacker)
+	list.append(obj)
+    return list
+
+"""
+
+# Extra helpers for types generated with --lazy
+lazyheader = """
+def lazy_skip(obj, id, skipper, *args):
+    # Skip over the encoding of obj.<id>, but remember where it was, so
+    # that it can be decoded when it is first accessed.
+    if not obj.__dict__.has_key("_lazy"):
+        obj._lazy = {}
+        obj._lazy_buf = obj.unpacker.get_buffer()
+        obj._lazy_ctx = None
+    start = obj.unpacker.get_position()
+    skipper(*args)
+    # The encoded extent is cached, so the field never needs to be
+    # scanned again.
+    obj._lazy[id] = (start, obj.unpacker.get_position())
+    if obj.__dict__.has_key(id):
+        del obj.__dict__[id]
+
+def lazy_skip_arm(obj, id, skipper, *args):
+    lazy_skip(obj, id, skipper, *args)
+    obj._lazy_arm = id
+    if obj.__dict__.has_key("arm"):
+        del obj.__dict__["arm"]
+
+def lazy_arm(obj):
+    id = obj.__dict__.get("_lazy_arm")
+    if id is None:
+        raise AttributeError("arm")
+    obj.arm = getattr(obj, id)
+    return obj.arm
+
+def lazy_unpacker(obj, id):
+    # Return an unpacker positioned at the encoding of obj.<id>
+    lazy = obj.__dict__.get("_lazy")
+    if lazy is None or not lazy.has_key(id):
+        raise AttributeError(id)
+    (start, unused_end) = lazy[id]
+    del lazy[id]
+    if obj._lazy_ctx is None:
+        obj._lazy_ctx = LazyContext(obj)
+    unpacker = obj._lazy_ctx.unpacker
+    unpacker.set_position(start)
+    return unpacker
+
+
+class LazyContext:
+    # Stands in for the ncl when decoding deferred fields. The reply
+    # buffer kept by the object is decoded with a private unpacker, since
+    # the shared one has probably been reset by later calls. 
+    def __init__(self, obj):
+        self.ncl = obj.ncl
+        self.packer = obj.packer
+        self.unpacker = obj.unpacker.__class__(self, obj._lazy_buf)
+
+"""
+
+benchheader = """
+import xdrbench
+import %s
+import %s
+import %s
+
+build_int = build_enum = xdrbench.int_value
+build_unsigned_int = build_unsigned = xdrbench.uint_value
+build_hyper = xdrbench.hyper_value
+build_unsigned_hyper = xdrbench.uhyper_value
+build_float = build_double = build_quadruple = xdrbench.float_value
+build_bool = xdrbench.bool_value
+
+"""
+
+benchfooter = """
+if __name__ == "__main__":
+    xdrbench.main(builders, %s.%sPacker, %s.%sUnpacker, types,
+                  context_free=%d)
+"""
+
+dispatchheader = """
+import rpc
+import %s
+import %s
+import %s
+
+__all__ = %s
+
+"""
 
 packerheader = """
 import rpc
@@ -211,6 +369,113 @@ def check_not_reserved(*args):
             raise "Invalid identifier %s is a reserved word" % str(arg)
 
 
+def qualify_const(value):
+    """Return value (a number or constant name) as an expression
+    valid in <prefix>packer.py"""
+    if value[0].isdigit():
+        return value
+    else:
+        return "%s.%s" % (constants_file, value)
+
+def is_lazy_decl(typedecl):
+    """Should this declaration be decoded on first access, in lazy mode?
+    Nested structs, unions, arrays and variable length data are. Scalars
+    and small fixed-length opaques are not."""
+    if typedecl.base_type == "void":
+        return 0
+    base_type = known_types.get(typedecl.base_type)
+    if base_type and base_type.composite:
+        return 1
+    if typedecl.isarray:
+        return not (typedecl.base_type == "opaque" and typedecl.fixarray)
+    if base_type and base_type.isarray:
+        return not (base_type.base_type == "opaque" and base_type.fixarray)
+    return 0
+
+
+def const_value(value):
+    """Return the integer value of a number or constant name, or None
+    if it is not known"""
+    value = const_values.get(value, value)
+    try:
+        return int(value, 0)
+    except ValueError:
+        return None
+
+def bulk_type(typedecl):
+    """Return the bulk codec suffix for an array of fixed width
+    primitives, or None."""
+    if typedecl.isarray:
+        return bulk_types.get(typedecl.base_type)
+    return None
+
+def fixed_size(typedecl):
+    """Return the encoded size of typedecl if it is the same for all
+    values, None otherwise"""
+    if typedecl.void:
+        return 0
+    if typedecl.base_type == "opaque":
+        if typedecl.fixarray:
+            n = const_value(typedecl.arraylen)
+            if n is not None:
+                return (n+3)/4*4
+        return None
+    if typedecl.base_type == "string" or typedecl.isarray:
+        # Note: Arrays are always encoded with a length, see
+        # gen_pack_code.
+        return None
+    return fixed_sizes.get(typedecl.base_type)
+
+def codec(name):
+    """Return the expression for the packer or unpacker in the methods
+    of the type classes"""
+    if context_free:
+        return name
+    return "self." + name
+
+def codec_arg(name):
+    """Return the arguments for passing the packer or unpacker on to
+    nested objects"""
+    if context_free:
+        return name
+    return ""
+
+def method_args(name):
+    """Return the argument list of the pack, unpack and xdr_size
+    methods of the type classes"""
+    if context_free:
+        return "self, " + name
+    return "self"
+
+def size_terms(value, typedecl):
+    """Return (constant, expressions), which adds up to the encoded size of
+    value, when encoded as typedecl. Code for <prefix>types.py."""
+    size = fixed_size(typedecl)
+    if size is not None:
+        return (size, [])
+    base_type = known_types.get(typedecl.base_type)
+    if typedecl.base_type in ("opaque", "string"):
+        if typedecl.fixarray:
+            return (0, ["%s.size_fopaque(%s)" % (codec("packer"), typedecl.arraylen)])
+        return (4, ["(len(%s)+3)/4*4" % value])
+    if typedecl.isarray:
+        item_size = fixed_sizes.get(typedecl.base_type)
+        if item_size is not None:
+            return (4, ["len(%s)*%d" % (value, item_size)])
+        if base_type.composite:
+            if context_free:
+                return (0, ["size_objarray(%s, packer)" % value])
+            return (0, ["size_objarray(%s)" % value])
+        return (0, ["%s.size_array(%s, %s.size_%s)" \
+                    % (codec("packer"), value, codec("packer"), typedecl.base_type)])
+    if base_type.composite:
+        return (0, ["%s.xdr_size(%s)" % (value, codec_arg("packer"))])
+    if base_type.base_type:
+        # Typedef; use its definition directly
+        return size_terms(value, base_type)
+    return (0, ["%s.size_%s(%s)" % (codec("packer"), typedecl.base_type, value)])
+
+
 class IndentPrinter:
     def __init__(self, writer):
         self.indent = 0
@@ -303,33 +568,40 @@ for typename in known_basics.keys():
 # Code generation for <prefix>types.py
 def gen_pack_code(ip, id, typedecl):
     base_type = known_types[typedecl.base_type]
+    packer = codec("packer")
     if base_type.composite:
         if typedecl.isarray:
-            ip.pr("pack_objarray(self, self.%s)" % id)
+            ip.pr("pack_objarray(%s, self.%s)" % (codec_arg("packer") or "self", id))
         else:
-            ip.pr("self.%s.pack()" % id)
+            ip.pr("self.%s.pack(%s)" % (id, codec_arg("packer")))
     else:
         # Simple data types, like strings, ints and floats
         if typedecl.base_type == "opaque":
             if typedecl.fixarray:
                 # Fixed length opaque data
-                ip.pr("self.packer.pack_fopaque(%s, self.%s)" % (typedecl.arraylen, id))
+                ip.pr("%s.pack_fopaque(%s, self.%s)" % (packer, typedecl.arraylen, id))
             else:
                 # Variable length opaque data
-                ip.pr("self.packer.pack_opaque(self.%s)" % id)
+                ip.pr("%s.pack_opaque(self.%s)" % (packer, id))
         elif typedecl.base_type == "string":
-            ip.pr("self.packer.pack_string(self.%s)" % id)
+            ip.pr("%s.pack_string(self.%s)" % (packer, id))
+        elif bulk_type(typedecl):
+            ip.pr("%s.pack_%s_array(self.%s)" % (packer, bulk_type(typedecl), id))
         elif typedecl.isarray:
-            ip.pr("self.packer.pack_array(self.%s, self.pack_%s)" % (id, typedecl.base_type))
+            ip.pr("%s.pack_array(self.%s, %s.pack_%s)" % (packer, id, packer, typedecl.base_type))
         else:
-            ip.pr("self.packer.pack_%s(self.%s)" % (typedecl.base_type, id))
+            ip.pr("%s.pack_%s(self.%s)" % (packer, typedecl.base_type, id))
 
 # Code generation for <prefix>types.py
 def gen_unpack_code(ip, id, typedecl):
     base_type = known_types[typedecl.base_type]
+    unpacker = codec("unpacker")
     if base_type.composite:
         if typedecl.isarray:
-            ip.pr("self.%s = unpack_objarray(self, %s)" % (id, typedecl.base_type))
+            ip.pr("self.%s = unpack_objarray(%s, %s)" % (id, codec_arg("unpacker") or "self", typedecl.base_type))
+        elif context_free:
+            ip.pr("self.%s = %s()" % (id, typedecl.base_type))
+            ip.pr("self.%s.unpack(unpacker)" % id)
         else:
             ip.pr("self.%s = %s(self)" % (id, typedecl.base_type))
             ip.pr("self.%s.unpack()" % id)
@@ -338,16 +610,341 @@ def gen_unpack_code(ip, id, typedecl):
         if typedecl.base_type == "opaque":
             if typedecl.fixarray:
                 # Fixed length opaque data
-                ip.pr("self.%s = self.unpacker.unpack_fopaque(%s)" % (id, typedecl.arraylen))
+                ip.pr("self.%s = %s.unpack_fopaque(%s)" % (id, unpacker, typedecl.arraylen))
             else:
                 # Variable length opaque data
-                ip.pr("self.%s = self.unpacker.unpack_opaque()" % id)
+                ip.pr("self.%s = %s.unpack_opaque()" % (id, unpacker))
         elif typedecl.base_type == "string":
-            ip.pr("self.%s = self.unpacker.unpack_string()" % id)
+            ip.pr("self.%s = %s.unpack_string()" % (id, unpacker))
+        elif bulk_type(typedecl):
+            ip.pr("self.%s = %s.unpack_%s_array()" % (id, unpacker, bulk_type(typedecl)))
         elif typedecl.isarray:
-            ip.pr("self.%s = self.unpacker.unpack_array(self.unpacker.unpack_%s)" %  (id, typedecl.base_type))
+            ip.pr("self.%s = %s.unpack_array(%s.unpack_%s)" %  (id, unpacker, unpacker, typedecl.base_type))
         else:
-            ip.pr("self.%s = self.unpacker.unpack_%s()" % (id, typedecl.base_type))
+            ip.pr("self.%s = %s.unpack_%s()" % (id, unpacker, typedecl.base_type))
+
+# Code generation for both files
+def skip_call(unpacker, typedecl, qualify=str):
+    """Return (function, args) which skips over typedecl when
+    called. unpacker is the expression for the unpacker to use."""
+    if typedecl.base_type == "opaque":
+        if typedecl.fixarray:
+            # Fixed length opaque data
+            return ("%s.skip_fopaque" % unpacker, [qualify(typedecl.arraylen)])
+        else:
+            # Variable length opaque data
+            return ("%s.skip_opaque" % unpacker, [])
+    elif typedecl.base_type == "string":
+        return ("%s.skip_string" % unpacker, [])
+    elif bulk_type(typedecl):
+        return ("%s.skip_%s_array" % (unpacker, bulk_type(typedecl)), [])
+    elif typedecl.isarray:
+        # Note: Arrays are always encoded with a length, see
+        # gen_unpack_code.
+        return ("%s.skip_array" % unpacker,
+                ["%s.skip_%s" % (unpacker, typedecl.base_type)])
+    else:
+        return ("%s.skip_%s" % (unpacker, typedecl.base_type), [])
+
+# Code generation for <prefix>packer.py
+def gen_skip_code(ip, typedecl):
+    (func, args) = skip_call("self", typedecl, qualify_const)
+    ip.pr("%s(%s)" % (func, ", ".join(args)))
+
+# Code generation for both files
+def gen_case_code(ip, union_body, subject, gen_arm, raise_code, qualify=str):
+    """Generate an if/elif chain comparing subject with the case values
+    of union_body. gen_arm(ip, declaration) generates the code for each
+    arm, including void arms."""
+    switch_body = union_body.switch_body
+    keyword = "if"
+    conditions = []
+    for case_declaration in [switch_body.first_declaration] + switch_body.case_list:
+        conditions.append("%s == %s" % (subject, qualify(case_declaration.value)))
+        declaration = case_declaration.declaration
+        if not declaration:
+            # Falls through to next case
+            continue
+        ip.pr("%s %s:" % (keyword, " or ".join(conditions)))
+        keyword = "elif"
+        conditions = []
+        ip.change(4)
+        gen_arm(ip, declaration)
+        ip.change(-4)
+
+    if keyword == "if":
+        ip.pr("if 1:")
+    else:
+        ip.pr("else:")
+    ip.change(4)
+    default_declaration = switch_body.default_declaration
+    if default_declaration:
+        gen_arm(ip, default_declaration.declaration)
+    else:
+        ip.pr(raise_code)
+    ip.change(-4)
+    ip.pr("")
+
+# Code generation for <prefix>packer.py
+def gen_skip_switch_code(ip, classname, union_body):
+    (switch_id, typedecl) = union_body.declaration
+    ip.pr("discriminant = self.unpack_%s()" % typedecl.base_type)
+
+    def gen_arm(ip, declaration):
+        if declaration[0] != "void":
+            gen_skip_code(ip, declaration[1])
+        else:
+            ip.pr("pass")
+
+    gen_case_code(ip, union_body, "discriminant", gen_arm,
+                  'raise %s.BadDiscriminant(discriminant, "%s")' % (types_file, classname),
+                  qualify_const)
+
+# Code generation for <prefix>types.py
+def gen_size_code(ip, struct_body):
+    """Generate a return statement with the encoded size of the
+    declarations in struct_body"""
+    constant = 0
+    terms = []
+    for (id, typedecl) in struct_body:
+        (c, t) = size_terms("self.%s" % id, typedecl)
+        constant += c
+        terms.extend(t)
+    if constant or not terms:
+        terms.insert(0, str(constant))
+    ip.pr("return %s" % " + ".join(terms))
+
+# Code generation for <prefix>types.py
+def gen_size_switch_code(ip, union_body):
+    (switch_id, typedecl) = union_body.declaration
+
+    def gen_arm(ip, declaration, switch_decl=union_body.declaration):
+        if declaration[0] != "void":
+            gen_size_code(ip, [switch_decl, declaration])
+        else:
+            gen_size_code(ip, [switch_decl])
+
+    gen_case_code(ip, union_body, "self.%s" % switch_id, gen_arm,
+                  "raise BadDiscriminant(self.%s, self)" % switch_id)
+
+# Code generation for <prefix>types.py
+def gen_init_line(ip, declarations):
+    if context_free:
+        ip.prcomma("def __init__(self")
+    else:
+        ip.prcomma("def __init__(self, ncl")
+    for (id, typedecl) in declarations:
+        check_not_reserved(id)
+        ip.cont(", %s=None" % id)
+    ip.cont("):\n")
+
+# Code generation for <prefix>types.py, in lazy mode
+def gen_lazy_unpack_code(ip, id, typedecl, arm=0):
+    (func, args) = skip_call("self.unpacker", typedecl)
+    if arm:
+        helper = "lazy_skip_arm"
+    else:
+        helper = "lazy_skip"
+    ip.pr('%s(self, "%s", %s)' % (helper, id, ", ".join([func] + args)))
+
+# Code generation for <prefix>types.py, in lazy mode
+def gen_lazy_getattr(ip, lazy_decl, union=0):
+    ip.pr("def __getattr__(self, name):")
+    ip.change(4)
+    if union:
+        ip.pr('if name == "arm":')
+        ip.pr("    return lazy_arm(self)")
+    ip.pr("unpacker = lazy_unpacker(self, name)")
+    ip.pr("saved_unpacker = self.unpacker")
+    ip.pr("self.unpacker = unpacker")
+    ip.pr("try:")
+    ip.change(4)
+    keyword = "if"
+    for (id, typedecl) in lazy_decl:
+        ip.pr('%s name == "%s":' % (keyword, id))
+        keyword = "elif"
+        ip.change(4)
+        gen_unpack_code(ip, id, typedecl)
+        ip.change(-4)
+    ip.change(-4)
+    ip.pr("finally:")
+    ip.pr("    self.unpacker = saved_unpacker")
+    ip.pr("return self.__dict__[name]")
+    ip.change(-4)
+    ip.cont("\n")
+
+# Code generation for <prefix>bench.py
+def bench_expr(typedecl):
+    """Return an expression which builds a value for typedecl, given
+    ncl and size"""
+    if typedecl.arraylen is None:
+        maxlen = "None"
+    else:
+        maxlen = qualify_const(str(typedecl.arraylen))
+    if typedecl.base_type in ("opaque", "string"):
+        if typedecl.fixarray:
+            return "xdrbench.fixed_opaque(%s)" % maxlen
+        else:
+            return "xdrbench.opaque_value(size, %s)" % maxlen
+    elif typedecl.isarray:
+        return "xdrbench.list_value(ncl, size, build_%s, %s, %d)" \
+               % (typedecl.base_type, maxlen, typedecl.fixarray is not None)
+    else:
+        return "build_%s(ncl, size)" % typedecl.base_type
+
+def bench_args():
+    """Return the leading constructor arguments of the type classes"""
+    if context_free:
+        return []
+    return ["ncl"]
+
+def gen_bench_typedef(id, typeobj):
+    ip = IndentPrinter(bench_out)
+    ip.pr("def build_%s(ncl, size):" % id)
+    ip.pr("    return %s" % bench_expr(typeobj))
+    ip.pr("")
+
+def gen_bench_enum(id, enum_list):
+    ip = IndentPrinter(bench_out)
+    values = [qualify_const(name) for (name, value) in enum_list]
+    ip.pr("def build_%s(ncl, size):" % id)
+    ip.pr("    return xdrbench.choose(size, [%s])" % ", ".join(values))
+    ip.pr("")
+
+def gen_bench_struct(classname, struct_body):
+    ip = IndentPrinter(bench_out)
+    bench_types.append(classname)
+    ip.pr("def build_%s(ncl, size):" % classname)
+    ip.change(4)
+    args = bench_args()
+    for (id, typedecl) in struct_body:
+        args.append("%s=%s" % (id, bench_expr(typedecl)))
+    ip.pr("return %s.%s(%s)" % (types_file, classname, ",\n        ".join(args)))
+    ip.change(-4)
+    ip.pr("")
+
+def gen_bench_union(classname, union_body):
+    ip = IndentPrinter(bench_out)
+    bench_types.append(classname)
+    (switch_id, switch_decl) = union_body.declaration
+    switch_body = union_body.switch_body
+
+    # Arms as (value, declaration). Small instances use a void arm if
+    # there is one, typical and maximal ones the first non-void arm.
+    arms = []
+    case_values = []
+    for case_declaration in [switch_body.first_declaration] + switch_body.case_list:
+        case_values.append(case_declaration.value)
+        if case_declaration.declaration:
+            arms.append((qualify_const(case_declaration.value),
+                         case_declaration.declaration))
+    default = switch_body.default_declaration
+    if default and default.declaration:
+        # Find a discriminant which is not handled by the cases
+        used = map(const_value, case_values)
+        candidates = []
+        for (name, value) in enum_members.get(switch_decl.base_type, []):
+            candidates.append((const_value(name), qualify_const(name)))
+        candidates = candidates + map(lambda x: (x, str(x)), range(len(used) + 1))
+        for (value, expr) in candidates:
+            if value not in used:
+                arms.append((expr, default.declaration))
+                break
+    void_arms = filter(lambda arm: arm[1][1].void, arms)
+    other_arms = filter(lambda arm: not arm[1][1].void, arms)
+    small_arm = (void_arms + other_arms)[0]
+    big_arm = (other_arms + void_arms)[0]
+
+    ip.pr("def build_%s(ncl, size):" % classname)
+    ip.change(4)
+    keyword = "if"
+    for (condition, (value, (id, typedecl))) in [('size == "small"', small_arm),
+                                                 (None, big_arm)]:
+        args = bench_args() + ["%s=%s" % (switch_id, value)]
+        if not typedecl.void:
+            args.append("%s=%s" % (id, bench_expr(typedecl)))
+        code = "return %s.%s(%s)" % (types_file, classname, ", ".join(args))
+        if condition:
+            ip.pr("if %s:" % condition)
+            ip.pr("    " + code)
+        else:
+            ip.pr(code)
+    ip.change(-4)
+    ip.pr("")
+
+
+# Code generation for <prefix>dispatch.py
+def gen_server_class(prog_id, version_id, procedures):
+    ip = IndentPrinter(dispatch_out)
+    classname = "%sServer" % version_id
+    dispatch_all.append(classname)
+    ip.pr("class %s:" % classname)
+    ip.change(4)
+    ip.pr("# Server for program %s, version %s. Mix in before" % (prog_id, version_id))
+    ip.pr("# rpc.TCPServer or rpc.UDPServer, and override the procedure methods.")
+    ip.pr("prog = %s" % qualify_const(prog_id))
+    ip.pr("vers = %s" % qualify_const(version_id))
+    ip.pr("")
+    ip.pr("def addpackers(self):")
+    ip.pr("    self.packer = %s.%sPacker(self)" % (packer_file, name_base.upper()))
+    ip.pr("    self.unpacker = %s.%sUnpacker(self, '')" % (packer_file, name_base.upper()))
+    ip.pr("")
+
+    # The procedure table, used by rpc.Server.handle
+    ip.pr("procedures = {")
+    for (id, res_type, arg_types) in procedures:
+        ip.pr("    %s: 'handle_%s'," % (qualify_const(id), id))
+    ip.pr("    }")
+    ip.pr("")
+
+    for (id, res_type, arg_types) in procedures:
+        # Decode arguments, call the procedure method, encode result
+        ip.pr("def handle_%s(self):" % id)
+        ip.change(4)
+        args = []
+        if arg_types:
+            ip.pr("try:")
+            ip.change(4)
+            for i in range(len(arg_types)):
+                arg = "arg%d" % (i + 1)
+                args.append(arg)
+                base_type = known_types.get(arg_types[i])
+                if base_type and base_type.composite:
+                    ip.pr("%s = %s.%s(self)" % (arg, types_file, arg_types[i]))
+                    ip.pr("%s.unpack()" % arg)
+                else:
+                    ip.pr("%s = self.unpacker.unpack_%s()" % (arg, arg_types[i]))
+            ip.change(-4)
+            ip.pr("except %s.BadDiscriminant:" % types_file)
+            ip.pr("    raise rpc.RPCGarbageArgs()")
+        if res_type == "void":
+            ip.pr("self.%s(%s)" % (id, ", ".join(args)))
+            ip.pr("self.turn_around()")
+        else:
+            ip.pr("res = self.%s(%s)" % (id, ", ".join(args)))
+            ip.pr("self.turn_around()")
+            base_type = known_types.get(res_type)
+            if base_type and base_type.composite:
+                ip.pr("res.pack()")
+            else:
+                ip.pr("self.packer.pack_%s(res)" % res_type)
+        ip.change(-4)
+        ip.pr("")
+
+    for (id, res_type, arg_types) in procedures:
+        params = ["self"]
+        for i in range(len(arg_types)):
+            params.append("arg%d" % (i + 1))
+        ip.pr("def %s(%s):" % (id, ", ".join(params)))
+        if not arg_types and res_type == "void":
+            # Like the NULL procedure, does nothing by default
+            ip.pr("    pass")
+        else:
+            ip.pr("    raise NotImplementedError(\"%s\")" % id)
+        ip.pr("")
+    ip.change(-4)
+    ip.pr("")
+
 
 # Code generation for <prefix>packer.py
 def gen_packers(id, typeobj):
@@ -371,9 +968,9 @@ yet. Assuming '%s' is composite (struct/union).""" \
         if base_type.composite:
             # Struct or Union type
             if typeobj.isarray:
-                ip.pr("%s.pack_objarray(self, data)" % types_file)
+                ip.pr("%s.pack_objarray(%s, data)" % (types_file, codec_arg("self") or "self.ncl"))
             else:
-                ip.pr("data.pack()")
+                ip.pr("data.pack(%s)" % codec_arg("self"))
         else:
             if typeobj.base_type == "string":
                 ip.pr("self.pack_string(data)")
@@ -384,6 +981,8 @@ yet. Assuming '%s' is composite (struct/union).""" \
                 else:
                     # Variable length opaque data
                     ip.pr("self.pack_opaque(data)")
+            elif bulk_type(typeobj):
+                ip.pr("self.pack_%s_array(data)" % bulk_type(typeobj))
             else:
                 # Some other kind of array. 
                 ip.pr("self.pack_array(data, self.pack_%s)" % typeobj.base_type)
@@ -402,7 +1001,11 @@ yet. Assuming '%s' is composite (struct/union).""" \
         if base_type.composite:
             # Struct or Union type
             if typeobj.isarray:
-                ip.pr("return %s.unpack_objarray(self.ncl, %s.%s)" % (types_file, types_file, typeobj.base_type))
+                ip.pr("return %s.unpack_objarray(%s, %s.%s)" % (types_file, codec_arg("self") or "self.ncl", types_file, typeobj.base_type))
+            elif context_free:
+                ip.pr("obj = %s.%s()" % (types_file, typeobj.base_type))
+                ip.pr("obj.unpack(self)")
+                ip.pr("return obj")
             else:
                 ip.pr("obj = %s.%s(self.ncl)" % (types_file, typeobj.base_type))
                 ip.pr("obj.unpack()")
@@ -417,10 +1020,58 @@ yet. Assuming '%s' is composite (struct/union).""" \
                 else:
                     # Variable length opaque data
                     ip.pr("return self.unpack_opaque()")
+            elif bulk_type(typeobj):
+                ip.pr("return self.unpack_%s_array()" % bulk_type(typeobj))
             else:
                 # Some other kind of array. 
                 ip.pr("return self.unpack_array(self.unpack_%s)" % typeobj.base_type)
         ip.pr("")
+
+    # Size calculators
+    ip = IndentPrinter(packer_out)
+    ip.change(4)
+    if (not base_type.composite) and (not typeobj.isarray):
+        # Simple alias
+        ip.pr("size_%s = size_%s\n" % (id, typeobj.base_type))
+    else:
+        ip.pr("def size_%s(self, data):" % id)
+        ip.change(4)
+        item_size = fixed_sizes.get(typeobj.base_type)
+        if fixed_sizes.has_key(id):
+            ip.pr("return %d" % fixed_sizes[id])
+        elif base_type.composite:
+            if typeobj.isarray:
+                if item_size is not None:
+                    ip.pr("return 4 + len(data)*%d" % item_size)
+                elif context_free:
+                    ip.pr("return %s.size_objarray(data, self)" % types_file)
+                else:
+                    ip.pr("return %s.size_objarray(data)" % types_file)
+            else:
+                ip.pr("return data.xdr_size(%s)" % codec_arg("self"))
+        elif typeobj.base_type in ("opaque", "string"):
+            if typeobj.fixarray:
+                ip.pr("return self.size_fopaque(%s)" % qualify_const(typeobj.arraylen))
+            else:
+                ip.pr("return self.size_opaque(data)")
+        elif item_size is not None:
+            ip.pr("return 4 + len(data)*%d" % item_size)
+        else:
+            ip.pr("return self.size_array(data, self.size_%s)" % typeobj.base_type)
+        ip.pr("")
+
+    # Skippers
+    ip = IndentPrinter(unpacker_out)
+    ip.change(4)
+    if (not base_type.composite) and (not typeobj.isarray):
+        # Simple alias
+        ip.pr("skip_%s = skip_%s\n" % (id, typeobj.base_type))
+    else:
+        ip.pr("def skip_%s(self):" % id)
+        ip.change(4)
+        gen_skip_code(ip, typeobj)
+        ip.change(-4)
+        ip.pr("")
     
 
 def gen_switch_code(ip, union_body, packer, assertions=0):
@@ -468,8 +1119,10 @@ def gen_switch_code(ip, union_body, packer, assertions=0):
             if declaration[0] != "void":
                 # check_not_reserved(declaration[0]) is done in packer()
                 if assertions: ip.pr("assert_not_none(self, self.%s)" % declaration[0])
-                packer(ip, declaration[0], declaration[1])
-                ip.pr("self.arm = self.%s" % declaration[0])
+                # A true return value means that packer took care of
+                # the arm shortcut.
+                if not packer(ip, declaration[0], declaration[1]):
+                    ip.pr("self.arm = self.%s" % declaration[0])
             else:
                 ip.pr("pass")
             last_empty = 0
@@ -483,8 +1136,8 @@ def gen_switch_code(ip, union_body, packer, assertions=0):
     if default_declaration:
         declaration = default_declaration.declaration
         if declaration[0] != "void":
-            packer(ip, declaration[0], declaration[1])
-            ip.pr("self.arm = self.%s" % declaration[0])
+            if not packer(ip, declaration[0], declaration[1]):
+                ip.pr("self.arm = self.%s" % declaration[0])
         else:
             ip.pr("pass")
     else:
@@ -529,9 +1182,17 @@ def p_type_def_1(t):
     ip = IndentPrinter(unpacker_out)
     ip.change(4)
     ip.pr("unpack_%s = unpack_enum\n" % id)
+    ip.pr("skip_%s = skip_enum\n" % id)
+
+    fixed_sizes[id] = 4
+    ip = IndentPrinter(packer_out)
+    ip.change(4)
+    ip.pr("size_%s = size_enum\n" % id)
 
     # Generate dictionary for translating enum to string
     enum_list = t[3]
+    enum_members[id] = enum_list
+    gen_bench_enum(id, enum_list)
     print >> const_out, "%s_id = {" % t[2]
     const_all.append("%s_id" % t[2])
     # Print first
@@ -550,9 +1211,15 @@ def p_type_def_2(t):
 
     (id, typeobj) = t[2]
     known_types[id] = typeobj
+    size = fixed_size(typeobj)
+    if size is not None:
+        fixed_sizes[id] = size
+    if not typeobj.isarray and bulk_types.has_key(typeobj.base_type):
+        bulk_types[id] = bulk_types[typeobj.base_type]
 
     print "Creating packers for typedef", id
     gen_packers(id, typeobj)
+    gen_bench_typedef(id, typeobj)
     # Returns nothing. 
 
 def p_type_def_3(t):
@@ -568,6 +1235,11 @@ def p_type_def_3(t):
     # Generate class code
     ip = IndentPrinter(types_out)
     struct_body = t[3]
+    gen_bench_struct(classname, struct_body)
+
+    sizes = [fixed_size(typedecl) for (id, typedecl) in struct_body]
+    if None not in sizes:
+        fixed_sizes[classname] = reduce(lambda x, y: x + y, sizes)
 
     # class line
     check_not_reserved(classname)
@@ -583,15 +1255,12 @@ def p_type_def_3(t):
     ip.pr("# };")
 
     # constructor line
-    ip.prcomma("def __init__(self, ncl")
-    for (id, typedecl) in struct_body:
-        check_not_reserved(id)
-        ip.cont(", %s=None" % id)
-    ip.cont("):\n")
+    gen_init_line(ip, struct_body)
 
     # constructor body
     ip.change(4)
-    ip.pr("init_type_class(self, ncl)")
+    if not context_free:
+        ip.pr("init_type_class(self, ncl)")
     for (id, typedecl) in struct_body:
         # check_not_reserved(id) is already done. 
         ip.pr("self.%s = %s" % (id, id))
@@ -615,7 +1284,7 @@ def p_type_def_3(t):
 
     # pack method
     ip.change(-4)
-    ip.pr("def pack(self, dummy=None):")
+    ip.pr("def pack(self, %s):" % (codec_arg("packer") or "dummy=None"))
     ip.change(4)
     # assert_not_none
     ip.prcomma("assert_not_none(self")
@@ -628,13 +1297,39 @@ def p_type_def_3(t):
         gen_pack_code(ip, id, typedecl)
     ip.cont("\n")
 
+    # xdr_size method
+    ip.change(-4)
+    ip.pr("def xdr_size(%s):" % method_args("packer"))
+    ip.change(4)
+    gen_size_code(ip, struct_body)
+    ip.cont("\n")
+
     # unpack method
+    lazy_decl = []
     ip.change(-4)
-    ip.pr("def unpack(self):")
+    ip.pr("def unpack(%s):" % method_args("unpacker"))
     ip.change(4)
     for (id, typedecl) in struct_body:
-        gen_unpack_code(ip, id, typedecl)
+        if lazy_types and is_lazy_decl(typedecl):
+            gen_lazy_unpack_code(ip, id, typedecl)
+            lazy_decl.append((id, typedecl))
+        else:
+            gen_unpack_code(ip, id, typedecl)
     ip.cont("\n")
+
+    # __getattr__ method, for decoding of deferred fields
+    if lazy_decl:
+        ip.change(-4)
+        gen_lazy_getattr(ip, lazy_decl)
+
+    # skip method
+    ip = IndentPrinter(unpacker_out)
+    ip.change(4)
+    ip.pr("def skip_%s(self):" % classname)
+    ip.change(4)
+    for (id, typedecl) in struct_body:
+        gen_skip_code(ip, typedecl)
+    ip.pr("")
     
     # Returns nothing. 
     
@@ -652,6 +1347,19 @@ def p_type_def_4(t):
     union_body = t[3]
     switch_var_declaration = union_body.declaration
     switch_body = union_body.switch_body
+    gen_bench_union(classname, union_body)
+
+    # A union has a fixed size if all arms have the same size
+    arms = [switch_body.first_declaration] + switch_body.case_list
+    if switch_body.default_declaration:
+        arms.append(switch_body.default_declaration)
+    arm_sizes = {}
+    for case_declaration in arms:
+        if case_declaration.declaration:
+            arm_sizes[fixed_size(case_declaration.declaration[1])] = 1
+    switch_size = fixed_size(switch_var_declaration[1])
+    if len(arm_sizes) == 1 and not arm_sizes.has_key(None) and switch_size is not None:
+        fixed_sizes[classname] = switch_size + arm_sizes.keys()[0]
     # RPCcase_declaration
     first_case_declaration = switch_body.first_declaration
     # List of RPCcase_declaration:s
@@ -711,15 +1419,12 @@ def p_type_def_4(t):
     
 
     # constructor line
-    ip.prcomma("def __init__(self, ncl")
-    for (id, typedecl) in all_decl:
-        check_not_reserved(id)
-        ip.cont(", %s=None" % id)
-    ip.cont("):\n")
+    gen_init_line(ip, all_decl)
 
     # constructor body
     ip.change(4)
-    ip.pr("init_type_class(self, ncl)")
+    if not context_free:
+        ip.pr("init_type_class(self, ncl)")
     for (id, typedecl) in all_decl:
         # check_not_reserved(id) already done. 
         ip.pr("self.%s = %s" % (id, id))
@@ -746,15 +1451,47 @@ def p_type_def_4(t):
 
     # pack method
     ip.change(-4)
-    ip.pr("def pack(self, dummy=None):")
+    ip.pr("def pack(self, %s):" % (codec_arg("packer") or "dummy=None"))
     ip.change(4)    
     gen_switch_code(ip, union_body, gen_pack_code, assertions=1)
 
+    # xdr_size method
+    ip.change(-4)
+    ip.pr("def xdr_size(%s):" % method_args("packer"))
+    ip.change(4)
+    if fixed_sizes.has_key(classname):
+        ip.pr("return %d" % fixed_sizes[classname])
+        ip.cont("\n")
+    else:
+        gen_size_switch_code(ip, union_body)
+
     # unpack method
+    lazy_decl = []
+    def lazy_unpack_code(ip, id, typedecl, lazy_decl=lazy_decl):
+        if lazy_types and is_lazy_decl(typedecl):
+            # The arm shortcut is resolved by lazy_arm() on access. 
+            gen_lazy_unpack_code(ip, id, typedecl, arm=1)
+            lazy_decl.append((id, typedecl))
+            return 1
+        else:
+            gen_unpack_code(ip, id, typedecl)
+            return 0
     ip.change(-4)
-    ip.pr("def unpack(self):")
+    ip.pr("def unpack(%s):" % method_args("unpacker"))
+    ip.change(4)
+    gen_switch_code(ip, union_body, lazy_unpack_code)
+
+    # __getattr__ method, for decoding of deferred arms
+    if lazy_decl:
+        ip.change(-4)
+        gen_lazy_getattr(ip, lazy_decl, union=1)
+
+    # skip method
+    ip = IndentPrinter(unpacker_out)
+    ip.change(4)
+    ip.pr("def skip_%s(self):" % classname)
     ip.change(4)
-    gen_switch_code(ip, union_body, gen_unpack_code)
+    gen_skip_switch_code(ip, classname, union_body)
                     
     # Returns nothing. 
 
@@ -766,6 +1503,7 @@ def p_constant_def(t):
     check_not_reserved(t[2], t[3], t[4])
     print >> const_out, t[2], t[3], t[4]
     const_all.append(t[2])
+    const_values[t[2]] = t[4]
 
 
 # union-body
@@ -876,6 +1614,7 @@ def p_enum_constant(t):
     check_not_reserved(t[1], t[2], t[3])
     print >> const_out, t[1], t[2], t[3]
     const_all.append(t[1])
+    const_values[t[1]] = t[3]
 
     # Return (id, number).
     t[0] = (t[1], t[3])
@@ -998,6 +1737,11 @@ def p_program_def(t):
     print >> const_out, "%s = %s" % (id, prog_num)
     const_all.append(id)
 
+    for (version_id, procedures) in parsed_versions:
+        print "Creating server class for version", version_id
+        gen_server_class(id, version_id, procedures)
+    del parsed_versions[:]
+
 
 # version-def
 def p_version_def(t):
@@ -1006,6 +1750,8 @@ def p_version_def(t):
     version = t[8]
     print >> const_out, "%s = %s" % (id, version)
     const_all.append(id)
+    parsed_versions.append((id, parsed_procedures[:]))
+    del parsed_procedures[:]
 
 def p_version_def_list(t):
     '''version_def_list : version_def_list version_def
@@ -1019,18 +1765,28 @@ def p_procedure_def(t):
     proc_num = t[8];
     print >> const_out, "%s = %s" % (id, proc_num)
     const_all.append(id)
+    # Result type and argument types. void means no arguments. 
+    arg_types = [t[4]] + t[5]
+    if arg_types == ["void"]:
+        arg_types = []
+    parsed_procedures.append((id, t[1], arg_types))
 
 def p_procedure_def_list(t):
     '''procedure_def_list : procedure_def_list procedure_def 
                           | empty'''
 
-def p_type_specifier_list(t):
-    '''type_specifier_list : type_specifier_list COMMA rpc_type_specifier
-                           | empty'''
+def p_type_specifier_list_1(t):
+    '''type_specifier_list : type_specifier_list COMMA rpc_type_specifier'''
+    t[0] = t[1] + [t[3]]
+
+def p_type_specifier_list_2(t):
+    '''type_specifier_list : empty'''
+    t[0] = []
 
 def p_rpc_type_specifier(t):
     '''rpc_type_specifier : type_specifier
                           | VOID''' # This is strange and not mentioned in RFC1831/1832. Why?
+    t[0] = t[1]
     
 # special 
 def p_empty(t):
@@ -1046,18 +1802,79 @@ def p_error(t):
 #
 # Section: main
 #
+USAGE = """\
+Usage: %s [options] <base-input-file> [extra-input-file...]
+options:
+-h, --help                   display this help and exit
+-l, --lazy                   generate types which decode nested structs,
+                             unions, arrays and opaque data on first access
+-f, --force                  regenerate even if the output is up to date
+-c, --context-free           generate types which are not bound to an ncl;
+                             the packer or unpacker is given to pack(),
+                             unpack() and xdr_size() instead
+"""
+
+def input_digest(filenames):
+    """Return a hex digest of the generator, the options and the
+    input files. Output generated from the same digest is identical."""
+    digest = md5.new()
+    digest.update(open(__file__.replace(".pyc", ".py")).read())
+    digest.update(repr((lazy_types, context_free)))
+    for filename in filenames:
+        digest.update(filename + "\0" + open(filename).read() + "\0")
+    return "".join(["%02x" % ord(c) for c in digest.digest()])
+
+def output_current(filenames, comment_string):
+    """Check if all output files start with comment_string"""
+    for filename in filenames:
+        try:
+            f = open(filename)
+            head = f.read(len(comment_string))
+            f.close()
+        except IOError:
+            return 0
+        if head != comment_string:
+            return 0
+    return 1
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print "Usage: %s <base-input-file> [extra-input-file...]" % sys.argv[0]
+    force = 0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hlfc",
+                                   ["help", "lazy", "force", "context-free"])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, e
+        args = []
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            args = []
+        if o in ("-l", "--lazy"):
+            lazy_types = 1
+        if o in ("-f", "--force"):
+            force = 1
+        if o in ("-c", "--context-free"):
+            context_free = 1
+
+    if len(args) < 1:
+        print USAGE % sys.argv[0]
+        sys.exit(1)
+
+    if lazy_types and context_free:
+        # Deferred fields are decoded from the reply buffer with the
+        # unpacker of the ncl, which context free types do not have.
+        print >> sys.stderr, "--lazy can not be combined with --context-free"
         sys.exit(1)
 
-    infile = sys.argv[1]
-    extrafiles = sys.argv[2:]
+    infile = args[0]
+    extrafiles = args[1:]
     name_base = os.path.basename(infile[:infile.rfind(".")])
     # File names without .py
     constants_file = name_base + "constants"
     types_file = name_base + "types"
     packer_file = name_base + "packer"
+    dispatch_file = name_base + "dispatch"
+    bench_file = name_base + "bench"
 
     print "Input file is", infile
     if extrafiles:
@@ -1065,77 +1882,132 @@ if __name__ == "__main__":
     print "Writing constants to", constants_file + ".py"
     print "Writing type classes to", types_file + ".py"
     print "Writing packer classes to", packer_file + ".py"
+    print "Writing server classes to", dispatch_file + ".py"
+    print "Writing codec benchmarks to", bench_file + ".py"
+    if lazy_types:
+        print "Generating lazy types"
+    if context_free:
+        print "Generating context free types"
+
+    # The output only depends on the input, so that it is not rewritten
+    # (and .pyc files and build caches stay valid) when nothing changed. 
+    infiles = extrafiles + [infile]
+    comment_string = "# Generated by rpcgen.py from %s. Do not edit.\n" \
+                     "# Input digest: %s\n" \
+                     % (", ".join(infiles), input_digest(infiles))
+    outfiles = [constants_file + ".py", types_file + ".py", packer_file + ".py",
+                dispatch_file + ".py", bench_file + ".py"]
+    if not force and output_current(outfiles, comment_string):
+        print "Output is up to date"
+        sys.exit(0)
 
-    comment_string = "# Generated by rpcgen.py at " + time.asctime() + "\n"
-
-    # Open const file
-    const_file_out = open(constants_file + ".py", "w")
     const_out = StringIO.StringIO()
-    const_all = []
+    const_all = ["FALSE", "TRUE"]
 
-    # Open types file.
-    types_file_out = open(types_file + ".py", "w")
     types_out = StringIO.StringIO()
     types_all = ["BadDiscriminant"]
 
-    # Open packer file, and write beginning
-    packer_file_out = open(packer_file + ".py", "w")
+    dispatch_out = StringIO.StringIO()
+    dispatch_all = []
+
+    bench_out = StringIO.StringIO()
+    bench_types = []
+
     packer_out = StringIO.StringIO()
     unpacker_out = StringIO.StringIO()
-    packer_file_out.write(comment_string)
     packer_all = ["%sPacker" % name_base.upper(),
                   "%sUnpacker" % name_base.upper()]
-    packer_file_out.write(packerheader % (types_file, constants_file,
-                                          str(packer_all)))
     packer_out.write("class %sPacker(rpc.Packer):\n" % name_base.upper())
-    packer_out.write("    def __init__(self, ncl):\n")
+    packer_out.write("    def __init__(self, ncl=None):\n")
     packer_out.write("        xdrlib.Packer.__init__(self)\n")
     packer_out.write("        self.ncl = ncl\n\n")
     
+    basics = known_basics.keys()
+    basics.sort()
     ip = IndentPrinter(packer_out)
     ip.change(4)
-    for t in known_basics.keys():
+    for t in basics:
         packer = known_basics[t]
         ip.pr("pack_%s = rpc.Packer.%s\n" % (t, packer))
+        ip.pr("size_%s = rpc.Packer.%s\n" % (t, "size" + packer[4:]))
 
     unpacker_out.write("class %sUnpacker(rpc.Unpacker):\n" % name_base.upper())
-    unpacker_out.write("    def __init__(self, ncl, data=''):\n")
+    unpacker_out.write("    def __init__(self, ncl=None, data=''):\n")
     unpacker_out.write("        xdrlib.Unpacker.__init__(self, data)\n")
     unpacker_out.write("        self.ncl = ncl\n\n")
     
     ip = IndentPrinter(unpacker_out)
     ip.change(4)
-    for t in known_basics.keys():
+    for t in basics:
         packer = known_basics[t]
         ip.pr("unpack_%s = rpc.Unpacker.%s\n" % (t, "un" + packer))
+        ip.pr("skip_%s = rpc.Unpacker.%s\n" % (t, "skip" + packer[4:]))
 
         
-    # Parse and generate code
+    # Parse and generate code. The parser tables are cached in
+    # parsetab.py, and only rebuilt when the grammar changes. 
     yacc.yacc()
     data = ""
-    for f in extrafiles:
+    for f in infiles:
         data += open(f).read()
-    data += open(infile).read()
     yacc.parse(data, debug=0)
     
+    # The output files are not opened until everything has been
+    # generated, so that a failed run never leaves output which
+    # looks up to date. 
 
     # Write out const code
+    const_file_out = open(constants_file + ".py", "w")
     const_file_out.write(comment_string)
     const_file_out.write(constheader % str(const_all))
     const_file_out.write(const_out.getvalue())
     const_file_out.close()
 
     # Write out types code
+    types_file_out = open(types_file + ".py", "w")
     types_file_out.write(comment_string)
     types_file_out.write(typesheader % (constants_file, packer_file,
                                         str(types_all)))
+    if context_free:
+        types_file_out.write(contextfreeheader)
+    else:
+        types_file_out.write(nclheader)
+    if lazy_types:
+        types_file_out.write(lazyheader)
     types_file_out.write(types_out.getvalue())
     types_out.close()
 
     # Write out packer code
+    packer_file_out = open(packer_file + ".py", "w")
+    packer_file_out.write(comment_string)
+    packer_file_out.write(packerheader % (types_file, constants_file,
+                                          str(packer_all)))
     packer_file_out.write(packer_out.getvalue())
     packer_file_out.write(unpacker_out.getvalue())
     packer_file_out.close()
+
+    # Write out server classes
+    dispatch_file_out = open(dispatch_file + ".py", "w")
+    dispatch_file_out.write(comment_string)
+    dispatch_file_out.write(dispatchheader % (constants_file, types_file,
+                                              packer_file, str(dispatch_all)))
+    dispatch_file_out.write(dispatch_out.getvalue())
+    dispatch_file_out.close()
+
+    # Write out benchmarks
+    bench_file_out = open(bench_file + ".py", "w")
+    bench_file_out.write(comment_string)
+    bench_file_out.write(benchheader % (constants_file, types_file, packer_file))
+    bench_file_out.write(bench_out.getvalue())
+    bench_file_out.write("# Structs and unions to benchmark\n")
+    bench_file_out.write("types = %s\n\n" % str(bench_types))
+    bench_file_out.write("builders = {}\n")
+    bench_file_out.write("for _name in types:\n")
+    bench_file_out.write("    builders[_name] = globals()[\"build_\" + _name]\n")
+    bench_file_out.write(benchfooter % (packer_file, name_base.upper(),
+                                        packer_file, name_base.upper(),
+                                        context_free))
+    bench_file_out.close()
     
 
 # Local variables:
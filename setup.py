@@ -18,6 +18,7 @@ setup(name = "pynfs",
       py_modules = ["nfs4constants",
                     "nfs4packer",
                     "nfs4types",
+                    "nfs4dispatch",
                     "rpc",
                     "nfs4lib",
                     "pynfs_completer"],
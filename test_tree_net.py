@@ -26,31 +26,14 @@ from nfs4constants import *
 from nfs4types import *
 
 def clean_dir(directory):
+    nfs4lib.remove_tree(ncl, directory, contents_only=1)
+
+    # Verify that all files were removed. Ask the server, not the
+    # client caches.
     fh = ncl.do_getfh(directory)
-    entries = ncl.do_readdir(fh)
-    names = [entry.name for entry in entries]
-
-    for name in names:
-        lookup_dir_ops = ncl.lookup_path(directory)
-        operations = [ncl.putrootfh_op()] + lookup_dir_ops
-        operations.append(ncl.remove_op(name))
-        res = ncl.compound(operations)
-
-        if res.status == NFS4ERR_NOTEMPTY:
-            # Recursive deletion
-            clean_dir(directory + [name])
-            # Remove dir itself
-            lookup_dir_ops = ncl.lookup_path(directory)
-            operations = [ncl.putrootfh_op()] + lookup_dir_ops
-            operations.append(ncl.remove_op(name))
-            res = ncl.compound(operations)
-            nfs4lib.check_result(res)
-        elif not res.status == NFS4_OK:
-            raise "Cannot clean directory %s" % directory
-
-    # Verify that all files were removed
-    entries = ncl.do_readdir(fh)
-    if entries:
+    res = ncl.compound([ncl.putfh_op(fh), ncl.readdir()])
+    nfs4lib.check_result(res)
+    if res.resarray[-1].arm.arm.reply.entries:
         raise "Cannot clean directory %s" % directory
 
 def create_dir(ncl, curdir, newdir):
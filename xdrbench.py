@@ -0,0 +1,353 @@
+#!/usr/bin/env python2
+
+# xdrbench.py - Microbenchmarks for the XDR codecs generated by rpcgen.py
+#
+# Copyright (C) 2001 Cendio Systems AB (http://www.cendio.se)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# This module is the benchmark driver. rpcgen.py generates a module
+# <name>bench.py with a builder function for every type, which creates
+# representative instances in the sizes "small", "typical" and
+# "maximal". Running <name>bench.py times pack, unpack and round-trip
+# for every struct and union, and writes the results as JSON.
+
+import sys
+import time
+import getopt
+try:
+    import json
+except ImportError:
+    json = None
+
+SIZES = ["small", "typical", "maximal"]
+
+# Number of items in variable length arrays, and bytes in variable
+# length opaque data and strings, for each size. Limited by the
+# maximum length in the declaration, if any.
+ARRAY_LENGTHS = {"small": 0, "typical": 4, "maximal": 32}
+OPAQUE_LENGTHS = {"small": 0, "typical": 32, "maximal": 1024}
+
+# Metrics compared with a baseline
+OPS_METRICS = ["pack_ops", "unpack_ops", "roundtrip_ops"]
+
+USAGE = """\
+Usage: %s [options] [type...]
+options:
+-h, --help                   display this help and exit
+-o, --output=FILE            write JSON results to FILE instead of stdout
+-c, --compare=FILE           compare with the baseline results in FILE, and
+                             exit with status 1 on regressions
+-t, --threshold=PERCENT      allowed slowdown when comparing (default 10)
+-m, --min-time=SECONDS       minimum time for each measurement (default 0.05)
+-r, --repeat=N               take the best of N measurements (default 3)
+-s, --sizes=LIST             comma separated sizes (default small,typical,maximal)
+"""
+
+
+#
+# Value builders, used by the generated code
+#
+
+def choose(size, values):
+    """Pick the first, middle or last of values"""
+    if size == "small":
+        return values[0]
+    elif size == "typical":
+        return values[len(values)/2]
+    else:
+        return values[-1]
+
+def int_value(ncl, size):
+    return choose(size, [0, 4711, 0x7fffffff])
+
+def uint_value(ncl, size):
+    return choose(size, [0, 4711, 0xffffffffL])
+
+def hyper_value(ncl, size):
+    return choose(size, [0, 4711, 0x7fffffffffffffffL])
+
+def uhyper_value(ncl, size):
+    return choose(size, [0, 4711, 0xffffffffffffffffL])
+
+def bool_value(ncl, size):
+    return choose(size, [0, 1, 1])
+
+def float_value(ncl, size):
+    return choose(size, [0.0, 1.5, 1e30])
+
+def _limit(length, maxlen):
+    if maxlen is not None and length > maxlen:
+        return maxlen
+    return length
+
+def opaque_value(size, maxlen=None):
+    return "x" * _limit(OPAQUE_LENGTHS[size], maxlen)
+
+def fixed_opaque(length):
+    return "x" * length
+
+# Variable length arrays nested deeper than this are left empty, so
+# that recursive types like entry4 (via nextentry) are finite.
+MAX_NESTING = 8
+_nesting = 0
+
+def list_value(ncl, size, build, maxlen=None, fixed=0):
+    global _nesting
+    if fixed:
+        length = maxlen
+    elif _nesting >= MAX_NESTING:
+        length = 0
+    else:
+        length = _limit(ARRAY_LENGTHS[size], maxlen)
+    list = []
+    _nesting = _nesting + 1
+    try:
+        for i in range(length):
+            list.append(build(ncl, size))
+    finally:
+        _nesting = _nesting - 1
+    return list
+
+
+#
+# Measurement
+#
+
+class BenchNcl:
+    def __init__(self, packer_class, unpacker_class):
+        self.packer = packer_class(self)
+        self.unpacker = unpacker_class(self, '')
+
+def measure(func, min_time, repeat):
+    """Return the best number of calls to func per second"""
+    best = 0.0
+    for r in range(repeat):
+        n = 1
+        while 1:
+            start = time.time()
+            for i in xrange(n):
+                func()
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+            n = n * 2
+        best = max(best, n / elapsed)
+    return best
+
+def bench_obj(ncl, obj, min_time, repeat, context_free=0):
+    """Time pack, unpack and round-trip of obj. Returns a dictionary
+    of metrics."""
+    klass = obj.__class__
+    packer = ncl.packer
+    unpacker = ncl.unpacker
+    if context_free:
+        return bench_context_free(obj, packer, unpacker, min_time, repeat)
+    packer.reset()
+    obj.pack()
+    data = packer.get_buffer()
+
+    def pack(packer=packer, obj=obj):
+        packer.reset()
+        obj.pack()
+
+    def unpack(ncl=ncl, unpacker=unpacker, klass=klass, data=data):
+        unpacker.reset(data)
+        klass(ncl).unpack()
+
+    def roundtrip(ncl=ncl, packer=packer, unpacker=unpacker, klass=klass, obj=obj):
+        packer.reset()
+        obj.pack()
+        unpacker.reset(packer.get_buffer())
+        klass(ncl).unpack()
+
+    return bench_funcs(data, pack, unpack, roundtrip, min_time, repeat)
+
+def bench_context_free(obj, packer, unpacker, min_time, repeat):
+    """Like bench_obj, for types generated with --context-free"""
+    klass = obj.__class__
+    packer.reset()
+    obj.pack(packer)
+    data = packer.get_buffer()
+
+    def pack(packer=packer, obj=obj):
+        packer.reset()
+        obj.pack(packer)
+
+    def unpack(unpacker=unpacker, klass=klass, data=data):
+        unpacker.reset(data)
+        klass().unpack(unpacker)
+
+    def roundtrip(packer=packer, unpacker=unpacker, klass=klass, obj=obj):
+        packer.reset()
+        obj.pack(packer)
+        unpacker.reset(packer.get_buffer())
+        klass().unpack(unpacker)
+
+    return bench_funcs(data, pack, unpack, roundtrip, min_time, repeat)
+
+def bench_funcs(data, pack, unpack, roundtrip, min_time, repeat):
+    result = {"bytes": len(data)}
+    for (name, func) in [("pack", pack), ("unpack", unpack),
+                         ("roundtrip", roundtrip)]:
+        ops = measure(func, min_time, repeat)
+        result[name + "_ops"] = ops
+        result[name + "_bytes"] = ops * len(data)
+    return result
+
+def run(builders, packer_class, unpacker_class, names, sizes,
+        min_time=0.05, repeat=3, log=sys.stderr, context_free=0):
+    """Benchmark the types names, using builders. Returns a dictionary
+    with results by "<type>/<size>"."""
+    ncl = BenchNcl(packer_class, unpacker_class)
+    results = {}
+    for name in names:
+        for size in sizes:
+            key = "%s/%s" % (name, size)
+            try:
+                obj = builders[name](ncl, size)
+                results[key] = bench_obj(ncl, obj, min_time, repeat,
+                                         context_free)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, e:
+                results[key] = {"error": "%s: %s" % (e.__class__.__name__, e)}
+                print >> log, "%-40s %s" % (key, results[key]["error"])
+                continue
+            r = results[key]
+            print >> log, "%-40s %6d bytes %10.0f %10.0f %10.0f ops/s" % \
+                  (key, r["bytes"], r["pack_ops"], r["unpack_ops"],
+                   r["roundtrip_ops"])
+    return results
+
+
+#
+# Results
+#
+
+def format_json(obj, indent=0):
+    """Format dictionaries of strings and numbers as JSON, sorted so
+    that the output is stable"""
+    if type(obj) == type({}):
+        keys = obj.keys()
+        keys.sort()
+        items = []
+        for key in keys:
+            items.append("%s%s: %s" % (" " * (indent + 1), format_json(key),
+                                       format_json(obj[key], indent + 1)))
+        return "{\n" + ",\n".join(items) + "\n" + " " * indent + "}"
+    elif type(obj) == type(""):
+        return '"%s"' % obj.replace("\\", "\\\\").replace('"', '\\"')
+    elif type(obj) == type(0.0):
+        return "%.6g" % obj
+    else:
+        return str(obj)
+
+def load_results(filename):
+    data = open(filename).read()
+    if json:
+        results = json.loads(data)
+    else:
+        # Our JSON output is also a valid Python expression
+        results = eval(data, {"__builtins__": {}})
+    return results["results"]
+
+def compare(baseline, results, threshold, log=sys.stderr):
+    """Print the benchmarks which are more than threshold percent
+    slower than baseline. Returns the number of regressions."""
+    regressions = 0
+    keys = results.keys()
+    keys.sort()
+    for key in keys:
+        if not baseline.has_key(key):
+            continue
+        for metric in OPS_METRICS:
+            old = baseline[key].get(metric)
+            new = results[key].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) * 100.0 / old
+            if change < -threshold:
+                print >> log, "REGRESSION %-40s %-14s %10.0f -> %10.0f (%+.1f%%)" % \
+                      (key, metric, old, new, change)
+                regressions = regressions + 1
+    return regressions
+
+def main(builders, packer_class, unpacker_class, types, argv=None,
+         context_free=0):
+    """Command line interface of <name>bench.py. types are the names
+    of the structs and unions to benchmark by default. context_free
+    is true for types generated with --context-free."""
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "ho:c:t:m:r:s:",
+                                   ["help", "output=", "compare=",
+                                    "threshold=", "min-time=", "repeat=",
+                                    "sizes="])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, e
+        print >> sys.stderr, USAGE % argv[0]
+        sys.exit(2)
+
+    output = None
+    baseline_file = None
+    threshold = 10.0
+    min_time = 0.05
+    repeat = 3
+    sizes = SIZES
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print USAGE % argv[0]
+            sys.exit(0)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-c", "--compare"):
+            baseline_file = a
+        elif o in ("-t", "--threshold"):
+            threshold = float(a)
+        elif o in ("-m", "--min-time"):
+            min_time = float(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-s", "--sizes"):
+            sizes = a.split(",")
+
+    names = args or types
+    for name in names:
+        if not builders.has_key(name):
+            print >> sys.stderr, "Unknown type:", name
+            sys.exit(2)
+    for size in sizes:
+        if size not in SIZES:
+            print >> sys.stderr, "Unknown size:", size
+            sys.exit(2)
+
+    results = run(builders, packer_class, unpacker_class, names, sizes,
+                  min_time, repeat, context_free=context_free)
+    doc = {"python": sys.version.split()[0],
+           "min_time": min_time,
+           "results": results}
+    if output:
+        f = open(output, "w")
+        f.write(format_json(doc) + "\n")
+        f.close()
+    else:
+        print format_json(doc)
+
+    if baseline_file:
+        regressions = compare(load_results(baseline_file), results, threshold)
+        if regressions:
+            print >> sys.stderr, "%d regressions beyond %g%%" % (regressions, threshold)
+            sys.exit(1)